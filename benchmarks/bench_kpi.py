@@ -0,0 +1,100 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from etl_common import MONTH_ORDER
+from kpi_engine import KpiThresholds, classify_level, classify_rotation, compute_kpis, rotation_rate
+
+# Benchmark del motore KPI: scalabilità da 10k a 10M righe e confronto con la
+# versione riga per riga (apply), eseguita solo fino a --max-legacy righe.
+
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+
+def synthetic(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_codes = max(n_rows // len(MONTH_ORDER), 1)
+    return pd.DataFrame({
+        "code": "C" + pd.Series(rng.integers(0, n_codes, n_rows)).astype(str),
+        "stock": rng.gamma(2.0, 50.0, n_rows).round(),
+        "real": rng.gamma(2.0, 50.0, n_rows).round(),
+        "outgoing": np.where(rng.random(n_rows) < 0.3, 0.0, rng.gamma(1.5, 20.0, n_rows).round()),
+        "mese_rif": rng.choice(MONTH_ORDER, n_rows),
+    })
+
+def legacy_classes(demand: pd.DataFrame, th: KpiThresholds):
+    # implementazione originale di make_kpi_report.py (apply riga per riga)
+    def classify_level_row(row):
+        G, S, T = row["giacenza_media"], th.safety * row["domanda_media"], th.target * row["domanda_media"]
+        if G < S: return "SOTTO-SCORTA"
+        if G > T: return "OVERSTOCK"
+        return "SCORTA OTTIMALE"
+
+    def classify_rotation_x(x):
+        if x == 0: return "NULLA"
+        if 0 < x <= th.rot_low: return "BASSA"
+        if x > th.rot_high: return "ALTA"
+        return "MEDIA"
+
+    level = demand.apply(classify_level_row, axis=1)
+    rate = np.where(demand["giacenza_media"] > 0, demand["domanda_media"] / demand["giacenza_media"], 0.0)
+    return level, pd.Series(rate).apply(classify_rotation_x)
+
+def check_equivalence(th: KpiThresholds) -> None:
+    # casi limite: soglie esatte, zeri, NaN
+    demand = pd.DataFrame({
+        "domanda_media": [0, 10, 10, 10, 10, 5, np.nan, 1, 2, 0],
+        "giacenza_media": [0, 5, 15, 4, 16, 25, 3, 0, np.nan, 7],
+    }, dtype=float)
+    level_old, rot_old = legacy_classes(demand, th)
+    level_new = classify_level(demand, th)["classe"]
+    rot_new = classify_rotation(rotation_rate(demand), th)
+    assert list(level_old) == list(level_new), "classi di scorta diverse dalla versione riga per riga"
+    assert list(rot_old) == list(rot_new), "classi di rotazione diverse dalla versione riga per riga"
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t0, out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del motore KPI vettoriale.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--max-legacy", type=int, default=1_000_000,
+                        help="dimensione massima per cui eseguire anche la versione con apply")
+    args = parser.parse_args(argv)
+
+    th = KpiThresholds()
+    check_equivalence(th)
+
+    rows = []
+    for n in args.sizes:
+        df = synthetic(n)
+        t_all, k = timed(compute_kpis, df, th)
+        demand = k["demand_mean"][["code", "domanda_media", "giacenza_media"]]
+        t_vec, _ = timed(lambda d: (classify_level(d, th), classify_rotation(rotation_rate(d), th)), demand)
+        t_old = np.nan
+        if n <= args.max_legacy:
+            t_old, (level_old, rot_old) = timed(legacy_classes, demand, th)
+            assert (level_old.to_numpy() == k["demand_mean"]["classe"].to_numpy()).all()
+            assert (rot_old.to_numpy() == k["rot"]["classe_rot"].to_numpy()).all()
+        rows.append({
+            "righe": n,
+            "articoli": len(demand),
+            "kpi_totale_s": round(t_all, 3),
+            "classi_vett_s": round(t_vec, 4),
+            "classi_apply_s": round(t_old, 3) if not np.isnan(t_old) else "",
+            "speedup": round(t_old / t_vec, 1) if not np.isnan(t_old) and t_vec > 0 else "",
+        })
+        print(rows[-1])
+
+    print()
+    print(pd.DataFrame(rows).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
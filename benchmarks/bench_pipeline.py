@@ -0,0 +1,166 @@
+import argparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import etl_charts
+import etl_profile
+import make_kpi_report
+import make_quality_report
+import qa_profile as qa
+import schema_registry
+from etl_common import standardize_columns
+from etl_dataset import write_dataset
+from etl_utils import read_json, write_json_atomic
+from kpi_engine import KpiThresholds
+from qa_reconcile import split_months
+from synth_data import SynthConfig, write_months
+
+# Benchmark della pipeline su dati sintetici (synth_data.py): lettura e
+# standardizzazione dei file, cleaning, profilo QA, riconciliazione tra mesi,
+# ogni KPI e il rendering dei report, a 10k / 1M / 10M righe. Tempi, CPU e
+# memoria vengono dalla strumentazione di etl_profile; i risultati si
+# confrontano con le baseline salvate in baselines.json (--save-baseline per
+# aggiornarle).
+#
+#   python benchmarks/bench_pipeline.py --sizes 10000 1000000
+#   python benchmarks/bench_pipeline.py --sizes 10000 --memory --save-baseline
+
+SIZES = [10_000, 1_000_000, 10_000_000]
+BASELINES = Path(__file__).resolve().parent / "baselines.json"
+PER_ITEM = {"metrics", "qa_profile", "kpi", "chart", "render_html"}   # una voce per item, le altre sommate sui file
+MIN_DELTA_S = 0.05    # sotto questa differenza assoluta non si segnala una regressione
+
+def ingest(files) -> tuple:
+    # (frame integrato, [(file, righe), ...] per la provenienza dei duplicati)
+    frames = []
+    for path, month in files:
+        with etl_profile.stage("read", item=path.name) as st:
+            df = pd.read_parquet(path) if path.suffix == ".parquet" else pd.read_excel(path)
+            st.rows_out = len(df)
+        with etl_profile.stage("standardize_columns", item=path.name, rows_in=len(df)):
+            std = standardize_columns(df, path.name)
+        std["mese_rif"] = month
+        frames.append(std)
+    return pd.concat(frames, ignore_index=True), [(p.name, len(f)) for (p, _), f in zip(files, frames)]
+
+def run_once(files, out_dir: Path) -> None:
+    raw, sources = ingest(files)
+    p_before = qa.profile(raw, name="before")
+    clean, dups = make_quality_report.clean_frame(raw, sources=sources)
+    p_after = qa.profile(clean, name="after")
+    del raw
+    # report QA e report KPI (tabelle, grafici, HTML) nella cartella temporanea
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        recon = make_quality_report.reconcile_months(split_months(clean))
+        make_quality_report.write_reports(qa.to_metrics(p_before, "before"), qa.to_metrics(p_after, "after"),
+                                          qa.month_table(p_after), qa.null_counts(p_after), len(clean),
+                                          clean.head(15), [], dups, recon)
+        # dataset e archivio KPI nella cartella temporanea, non in quelli del progetto
+        with etl_profile.stage("write_dataset", rows_in=len(clean)):
+            root = write_dataset(clean, out_dir / "dataset")
+        make_kpi_report.run(KpiThresholds(), out_dir, store_path=out_dir / "kpi_store.sqlite", root=root)
+    finally:
+        os.chdir(cwd)
+
+def summarize(records: list) -> dict:
+    out = {}
+    for r in records:
+        key = f"{r['stage']}:{r['item']}" if r["stage"] in PER_ITEM and r["item"] else r["stage"]
+        e = out.setdefault(key, {"wall_s": 0.0, "cpu_s": 0.0, "mem_peak_mb": None, "rows_in": None})
+        e["wall_s"] = round(e["wall_s"] + r["wall_s"], 4)
+        e["cpu_s"] = round(e["cpu_s"] + r["cpu_s"], 4)
+        if r.get("mem_peak_mb") is not None:
+            e["mem_peak_mb"] = max(e["mem_peak_mb"] or 0, r["mem_peak_mb"])
+        if r.get("rows_in") is not None and r["stage"] not in ("read", "standardize_columns"):
+            e["rows_in"] = max(e["rows_in"] or 0, r["rows_in"])
+    return out
+
+def bench_size(n_rows: int, months: int, fmt: str, memory: bool, work: Path) -> dict:
+    cfg = SynthConfig(rows_per_month=max(n_rows // months, 1), months=months)
+    data_dir = work / f"dati_{n_rows}"
+    files = write_months(cfg, data_dir, fmt)
+    out_dir = work / f"out_{n_rows}"
+    out_dir.mkdir()
+
+    etl_profile.enable(True, memory)
+    etl_profile.reset()
+    with etl_profile.stage("totale"):
+        run_once(files, out_dir)
+    result = summarize(etl_profile.reset())
+    result["totale"]["rss_peak_mb"] = etl_profile.rss_peak_mb()
+    etl_profile.enable(False)
+    shutil.rmtree(data_dir)
+    return result
+
+def compare(results: dict, baselines: dict, tolerance: float) -> list:
+    regressions = []
+    for size, stages in results.items():
+        base = baselines.get(size, {})
+        for key, r in stages.items():
+            b = base.get(key)
+            if not b:
+                continue
+            r["baseline_s"] = b["wall_s"]
+            r["ratio"] = round(r["wall_s"] / b["wall_s"], 2) if b["wall_s"] > 0 else None
+            if r["wall_s"] > b["wall_s"] * (1 + tolerance) and r["wall_s"] - b["wall_s"] > MIN_DELTA_S:
+                regressions.append(f"{size} righe, {key}: {r['wall_s']:.3f} s (baseline {b['wall_s']:.3f} s)")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark della pipeline su dati sintetici.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="righe totali per esecuzione")
+    parser.add_argument("--months", type=int, default=7)
+    parser.add_argument("--format", choices=["parquet", "xlsx"], default="parquet",
+                        help="formato dei file generati (xlsx solo per volumi piccoli)")
+    parser.add_argument("--memory", action="store_true", help="picco di memoria per stadio (tracemalloc, più lento)")
+    parser.add_argument("--save-baseline", action="store_true", help=f"salva i risultati in {BASELINES.name}")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="rallentamento ammesso rispetto alla baseline (default 0.25 = +25%%)")
+    args = parser.parse_args(argv)
+
+    work = Path(tempfile.mkdtemp(prefix="etl_bench_"))
+    # le intestazioni sintetiche non devono finire nel registro del progetto
+    schema_registry.REGISTRY = work / "schema_registry.json"
+    etl_charts.MANIFEST = work / "charts.json"   # impronte dei grafici: idem
+    try:
+        results = {}
+        for n in args.sizes:
+            print(f"== {n} righe")
+            results[str(n)] = bench_size(n, args.months, args.format, args.memory, work)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    baselines = read_json(BASELINES)
+    regressions = compare(results, baselines, args.tolerance)
+    for size, stages in results.items():
+        print(f"\n{size} righe")
+        print(pd.DataFrame.from_dict(stages, orient="index").to_string())
+
+    if args.save_baseline:
+        baselines.update(results)
+        baselines["_ambiente"] = {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "cpu": os.cpu_count(),
+            "macchina": platform.machine(),
+        }
+        write_json_atomic(BASELINES, baselines)
+        print("\nBaseline salvate in", BASELINES)
+    elif regressions:
+        print("\nRegressioni rispetto alla baseline:")
+        for r in regressions:
+            print(" -", r)
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
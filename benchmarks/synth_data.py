@@ -0,0 +1,154 @@
+import argparse
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from etl_common import MONTH_ORDER
+from etl_utils import read_json, write_json_atomic
+from schema_registry import CANDIDATES, SEED, fingerprint, normalize_header
+
+# Generatore di dati di magazzino sintetici, con le stesse irregolarità dei file
+# mensili reali gestite da standardize_columns e dal cleaning:
+# - intestazioni nelle varianti italiane/inglesi del registro, con maiuscole e
+#   spazi variabili e colonne in più;
+# - quantità nulle e negative;
+# - unità di misura sporche (PAGINA, PAGES, vuote, minuscole);
+# - righe duplicate su code/description, anche con codici scritti in modo diverso
+#   (minuscole, trattini) che la normalizzazione riporta alla stessa chiave.
+# I file (Parquet o xlsx) vengono scritti con un manifest.json file -> mese.
+
+# prima i mesi della pipeline (MONTH_ORDER), poi gli altri
+MONTHS = MONTH_ORDER + [m for m in ["GENNAIO", "FEBBRAIO", "MARZO", "APRILE", "MAGGIO", "GIUGNO", "LUGLIO",
+                                    "AGOSTO", "SETTEMBRE", "OTTOBRE", "NOVEMBRE", "DICEMBRE"]
+                        if m not in MONTH_ORDER]
+ITALIAN_HEADER = {"code": "Codice", "description": "Descrizione", "uom": "UM",
+                  "stock": "Giacenza", "real": "Reale", "outgoing": "Scaricare"}
+UOM_NOISE = np.array(["PAGINA", "PAGES", "", "kg", " KG ", None, "PZ"], dtype=object)
+PREFIXES = np.array(["SL", "CC", "RM", "PK", "MT"], dtype=object)
+EXCEL_MAX_ROWS = 1_048_575
+
+@dataclass(frozen=True)
+class SynthConfig:
+    rows_per_month: int = 10_000
+    months: int = 7
+    n_codes: int = 0            # articoli distinti; 0 = 1.25 volte le righe mensili
+    p_null: float = 0.03        # quantità mancanti
+    p_negative: float = 0.02    # quantità negative
+    p_dup: float = 0.05         # righe che ripetono code/description di un'altra riga del mese
+    p_code_noise: float = 0.05  # codici in minuscolo o con separatori
+    p_uom_noise: float = 0.05
+    seed: int = 0
+
+def header_variants() -> list:
+    # mapping canonico -> intestazione: le varianti registrate (in ordine di impronta,
+    # con le loro colonne extra) e la variante italiana se non è già tra queste
+    variants = []
+    registry = read_json(SEED)
+    for fp, e in sorted(registry.items()):
+        mapping = {c: k for c, k in e["mapping"].items() if k is not None}
+        if len(mapping) == len(CANDIDATES):
+            extra = [k for k in e["columns"] if k not in mapping.values()]
+            variants.append((mapping, extra))
+    if fingerprint(normalize_header(ITALIAN_HEADER.values())) not in registry:
+        variants.append((ITALIAN_HEADER, []))
+    return variants
+
+def code_pool(n_codes: int, rng) -> tuple:
+    num = rng.permutation(n_codes)
+    codes = PREFIXES[num % len(PREFIXES)] + pd.Series(num).astype(str).str.zfill(6).to_numpy(dtype=object)
+    desc = ("ARTICOLO " + pd.Series(codes) + " " + pd.Series(rng.choice(["VITE", "DADO", "LAMIERA", "TUBO", "GUARNIZIONE"],
+                                                                       n_codes))).to_numpy(dtype=object)
+    # varianti "sporche" degli stessi codici: stessa chiave dopo normalize_code
+    sep = pd.Series(codes).str.slice(0, 2) + "-" + pd.Series(codes).str.slice(2)
+    noisy = np.where(rng.random(n_codes) < 0.5, pd.Series(codes).str.lower(), sep).astype(object)
+    return codes, desc, noisy
+
+def month_frame(cfg: SynthConfig, month_idx: int, pool, variant) -> pd.DataFrame:
+    rng = np.random.default_rng((cfg.seed, month_idx))
+    codes, desc, noisy = pool
+    n = cfg.rows_per_month
+    n_codes = len(codes)
+
+    # articoli del mese (distinti); una quota di righe ripete un articolo già presente
+    idx = rng.choice(n_codes, n, replace=False) if n <= n_codes else rng.integers(0, n_codes, n)
+    dup = rng.random(n) < cfg.p_dup
+    if n > 1 and dup.any():
+        idx[dup] = idx[rng.integers(0, n, int(dup.sum()))]
+    code = np.where(rng.random(n) < cfg.p_code_noise, noisy[idx], codes[idx])
+
+    uom = np.full(n, "KG", dtype=object)
+    noise = rng.random(n) < cfg.p_uom_noise
+    uom[noise] = rng.choice(UOM_NOISE, int(noise.sum()))
+
+    def qty(shape, scale):
+        q = rng.gamma(shape, scale, n).round(2)
+        q[rng.random(n) < cfg.p_negative] *= -1
+        q[rng.random(n) < cfg.p_null] = np.nan
+        return q
+
+    stock = qty(2.0, 50.0)
+    data = {
+        "code": code,
+        "description": desc[idx],
+        "uom": uom,
+        "stock": stock,
+        "real": np.where(np.isnan(stock), np.nan, (stock * rng.normal(1.0, 0.02, n)).round(2)),
+        "outgoing": qty(1.5, 20.0),
+    }
+    mapping, extra = variant
+    df = pd.DataFrame({mapping[c]: data[c] for c in CANDIDATES})
+    for col in extra:
+        df[col] = rng.random(n) * 1e-10
+    # intestazioni con maiuscole/spazi variabili: stessa impronta nel registro
+    if month_idx % 2:
+        df.columns = [f" {c.title()} " if i % 2 else c.upper() for i, c in enumerate(df.columns)]
+    return df
+
+def generate(cfg: SynthConfig = SynthConfig()):
+    # (mese, DataFrame grezzo) per ogni mese, intestazioni a rotazione tra le varianti
+    if not 1 <= cfg.months <= len(MONTHS):
+        raise ValueError(f"months deve essere tra 1 e {len(MONTHS)}")
+    rng = np.random.default_rng(cfg.seed)
+    pool = code_pool(cfg.n_codes or max(cfg.rows_per_month * 5 // 4, 1), rng)
+    variants = header_variants()
+    for i in range(cfg.months):
+        yield MONTHS[i], month_frame(cfg, i, pool, variants[i % len(variants)])
+
+def write_months(cfg: SynthConfig, out_dir: Path, fmt: str = "parquet") -> list:
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if fmt == "xlsx" and cfg.rows_per_month > EXCEL_MAX_ROWS:
+        raise ValueError(f"xlsx: al massimo {EXCEL_MAX_ROWS} righe per mese")
+    files = []
+    for month, df in generate(cfg):
+        path = out_dir / f"synth_{month}.{fmt}"
+        if fmt == "xlsx":
+            df.to_excel(path, index=False)
+        else:
+            df.to_parquet(path, index=False)
+        files.append((path, month))
+    write_json_atomic(out_dir / "manifest.json", {p.name: m for p, m in files})
+    return files
+
+def main(argv=None):
+    d = SynthConfig()
+    parser = argparse.ArgumentParser(description="Genera file mensili di magazzino sintetici.")
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--rows", type=int, default=d.rows_per_month, help="righe per mese")
+    parser.add_argument("--months", type=int, default=d.months)
+    parser.add_argument("--codes", type=int, default=d.n_codes, help="articoli distinti (default 1.25 volte le righe per mese)")
+    parser.add_argument("--format", choices=["parquet", "xlsx"], default="parquet")
+    parser.add_argument("--seed", type=int, default=d.seed)
+    args = parser.parse_args(argv)
+
+    cfg = SynthConfig(rows_per_month=args.rows, months=args.months, n_codes=args.codes, seed=args.seed)
+    for path, month in write_months(cfg, args.out_dir, args.format):
+        print(f" - {path.name} ({month}, {cfg.rows_per_month} righe)")
+
+if __name__ == "__main__":
+    main()
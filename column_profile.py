@@ -0,0 +1,221 @@
+import numpy as np
+import pandas as pd
+
+from etl_dedup import column_hash
+
+# Profilo delle colonne a passaggio unico e a blocchi (make_data_dictionary).
+# Ogni colonna ha un accumulatore aggiornato blocco per blocco e combinabile con
+# merge(): conteggi, null, min/max ed esempi in entrambe le modalità; per
+# cardinalità e valori più frequenti:
+#
+#   esatta        conteggio per valore distinto (memoria proporzionale ai distinti)
+#   approssimata  HyperLogLog con 2^HLL_P registri per la cardinalità (errore
+#                 standard 1.04/sqrt(2^HLL_P), circa 0.8%); Misra-Gries con
+#                 TOPK_COUNTERS contatori per i valori più frequenti (ogni
+#                 conteggio sottostimato al più di n/(TOPK_COUNTERS+1), esatto se i
+#                 distinti sono meno dei contatori); come esempi i valori distinti
+#                 con l'hash più piccolo (campione uniforme e riproducibile dei distinti)
+#
+# Memoria costante in modalità approssimata: 16 KB di registri, TOPK_COUNTERS
+# contatori ed EXAMPLES esempi per colonna.
+
+HLL_P = 14
+TOPK_COUNTERS = 64
+EXAMPLES = 5
+
+HLL_ERROR = 1.04 / np.sqrt(2 ** HLL_P)
+
+def _hashes(s: pd.Series) -> np.ndarray:
+    # hash a 64 bit dei valori non nulli
+    s = s.dropna()
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # solo le categorie presenti nel blocco (il dizionario di un file Parquet
+        # può contenere tutti i valori del dataset)
+        codes = s.cat.codes.to_numpy()
+        used, inv = np.unique(codes, return_inverse=True)
+        return column_hash(pd.Series(s.cat.categories[used]))[inv]
+    if pd.api.types.is_numeric_dtype(s):
+        return pd.util.hash_array(s.to_numpy(dtype=np.float64))
+    return column_hash(s)
+
+def _appearance_counts(s: pd.Series) -> pd.Series:
+    # conteggi dei valori non nulli, nell'ordine di prima occorrenza
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        codes = s.cat.codes.to_numpy()
+        codes = codes[codes >= 0]
+        first = pd.unique(codes)
+        counts = np.bincount(codes, minlength=len(s.cat.categories))[first]
+        return pd.Series(counts, index=s.cat.categories[first])
+    return s.dropna().value_counts(sort=False)
+
+def _value_index(values, dtype) -> pd.Index:
+    # valori distinti con il tipo della colonna (stessa resa testuale di astype(str))
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    return pd.Index(values, dtype=dtype)
+
+class HyperLogLog:
+
+    def __init__(self, p: int = HLL_P):
+        self.p = p
+        self.registers = np.zeros(2 ** p, dtype=np.uint8)
+
+    def add(self, h: np.ndarray) -> None:
+        if not len(h):
+            return
+        bits = 64 - self.p
+        idx = (h >> np.uint64(bits)).astype(np.int64)
+        rest = h & np.uint64((1 << bits) - 1)
+        # posizione del primo bit a 1 nei bit restanti (frexp: bit_length esatto fino a 2^53)
+        rank = (bits + 1 - np.frexp(rest.astype(np.float64))[1]).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if e <= 2.5 * m and zeros:
+            e = m * np.log(m / zeros)   # linear counting per cardinalità piccole
+        return int(round(e))
+
+class ColumnProfile:
+
+    def __init__(self, name: str, approx: bool = False, top: bool = False):
+        # top: in modalità approssimata tiene anche i valori più frequenti
+        self.name = name
+        self.approx = approx
+        self.track_top = top
+        self.dtype = None
+        self.rows = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.examples = []          # esatta: primi distinti; approssimata: (hash, valore)
+        self.counts = []            # esatta: totale corrente, poi i conteggi dei blocchi non ancora sommati
+        self.hll = HyperLogLog() if approx else None
+        self.top = pd.Series(dtype="int64")   # approssimata: contatori Misra-Gries
+        self.top_error = 0
+
+    def update(self, s: pd.Series) -> None:
+        if self.dtype is None:
+            self.dtype = s.dtype
+        n_null = int(s.isna().sum())
+        self.rows += len(s)
+        self.nulls += n_null
+        if n_null == len(s):
+            return
+        if pd.api.types.is_numeric_dtype(s) and not isinstance(s.dtype, pd.CategoricalDtype):
+            v = pd.to_numeric(s, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+            lo, hi = float(np.nanmin(v)), float(np.nanmax(v))
+            self.min = lo if self.min is None else min(self.min, lo)
+            self.max = hi if self.max is None else max(self.max, hi)
+
+        if not self.approx:
+            counts = _appearance_counts(s)
+            for v in counts.index:
+                if len(self.examples) >= EXAMPLES:
+                    break
+                if v not in self.examples:
+                    self.examples.append(v)
+            self._add_counts(counts)
+            return
+
+        h = _hashes(s)
+        self.hll.add(h)
+        # esempi: i distinti con gli hash più piccoli (cercati tra i 64 hash minimi,
+        # su tutto il blocco se questi contengono troppi ripetuti)
+        pos = np.argpartition(h, 63)[:64] if len(h) > 64 else np.arange(len(h))
+        u, first = np.unique(h[pos], return_index=True)
+        if len(u) < EXAMPLES and len(pos) < len(h):
+            pos = np.arange(len(h))
+            u, first = np.unique(h, return_index=True)
+        values = s.dropna().iloc[pos[first[:EXAMPLES]]].tolist()
+        self._merge_examples(list(zip(u[:EXAMPLES].tolist(), values)))
+        if self.track_top:
+            self._update_top(_appearance_counts(s))
+
+    def _add_counts(self, counts: pd.Series) -> None:
+        # i blocchi si sommano al totale quando i loro conteggi superano il totale:
+        # memoria entro circa il doppio dei distinti finali, ogni valore sommato
+        # un numero costante di volte in media
+        self.counts.append(counts)
+        if sum(len(c) for c in self.counts[1:]) >= len(self.counts[0]):
+            self._compact()
+
+    def _compact(self) -> None:
+        if len(self.counts) > 1:
+            self.counts = [pd.concat(self.counts).groupby(level=0, sort=False).sum()]
+
+    def _merge_examples(self, examples: list) -> None:
+        self.examples = sorted(dict(self.examples + examples).items())[:EXAMPLES]
+
+    def _update_top(self, counts: pd.Series) -> None:
+        # Misra-Gries: somma dei contatori, poi si sottrae il (k+1)-esimo conteggio
+        top = pd.concat([self.top, counts]).groupby(level=0, sort=False).sum() if len(self.top) else counts
+        if len(top) > TOPK_COUNTERS:
+            cut = int(top.nlargest(TOPK_COUNTERS + 1).iloc[-1])
+            self.top_error += cut
+            top = top[top > cut] - cut
+        self.top = top.astype("int64")
+
+    def merge(self, other: "ColumnProfile") -> None:
+        self.dtype = self.dtype if self.dtype is not None else other.dtype
+        self.rows += other.rows
+        self.nulls += other.nulls
+        for attr, f in (("min", min), ("max", max)):
+            a, b = getattr(self, attr), getattr(other, attr)
+            setattr(self, attr, b if a is None else a if b is None else f(a, b))
+        if not self.approx:
+            self.examples = list(dict.fromkeys(self.examples + other.examples))[:EXAMPLES]
+            for counts in other.counts:
+                self._add_counts(counts)
+            return
+        self.hll.merge(other.hll)
+        self._merge_examples(other.examples)
+        if self.track_top:
+            self.top_error += other.top_error
+            self._update_top(other.top)
+
+    # Risultati
+
+    def value_counts(self) -> pd.Series:
+        # conteggi per valore, decrescenti (a parità, in ordine di prima occorrenza);
+        # in modalità approssimata solo i valori più frequenti
+        if self.approx:
+            vc = self.top
+        elif self.counts:
+            self._compact()
+            vc = self.counts[0]
+        else:
+            vc = pd.Series(dtype="int64")
+        return vc.sort_values(ascending=False, kind="stable")
+
+    def cardinality(self) -> int:
+        if self.approx:
+            return self.hll.estimate()
+        return len(self.value_counts())
+
+    def example_strings(self) -> list:
+        values = [v for _, v in self.examples] if self.approx else self.examples
+        if not values:
+            return []
+        return pd.Series(_value_index(values, self.dtype)).astype(str).tolist()
+
+def profile_batches(batches, approx: bool = False, top_cols=()) -> dict:
+    # un solo passaggio sui blocchi: {colonna: ColumnProfile}, colonne in ordine di apparizione
+    profiles = {}
+    for df in batches:
+        for c in df.columns:
+            if c not in profiles:
+                profiles[c] = ColumnProfile(c, approx, top=c in top_cols)
+            profiles[c].update(df[c])
+    return profiles
+
+def frame_batches(df: pd.DataFrame, batch_size: int):
+    # un frame già in memoria, a blocchi (almeno uno, anche se vuoto)
+    for start in range(0, max(len(df), 1), batch_size):
+        yield df.iloc[start:start + batch_size]
@@ -0,0 +1,126 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from functools import partial
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+import pandas as pd
+
+from etl_common import HERE
+from etl_loader import DEFAULT_WORKERS, map_files
+from etl_profile import stage
+from etl_utils import locked_json, tmp_path
+
+# Rendering dei grafici dei report (make_graphs_report, make_kpi_report).
+# Ogni grafico è descritto da un Chart: tabella di input, funzione di disegno e
+# testi. Il disegno usa l'API a oggetti di matplotlib (Figure + canvas Agg, senza
+# lo stato globale di pyplot), importata solo al primo grafico da disegnare; i
+# grafici sono indipendenti e vengono disegnati in un pool di processi.
+# Per ogni PNG si registra in .cache/charts.json l'impronta dell'input (tabella,
+# testi, funzione, sorgente di questo modulo, versione di matplotlib): se non è
+# cambiata e il file esiste, il grafico non viene ridisegnato.
+
+MANIFEST = HERE / ".cache" / "charts.json"
+USE_CACHE = os.environ.get("ETL_CHART_CACHE", "1") != "0"
+CHARTS_PER_WORKER = 2   # ogni worker importa matplotlib: sotto questa quota non conviene
+
+@dataclass
+class Chart:
+    name: str                        # nome del PNG
+    draw: object                     # draw(ax, data, **opts), funzione di modulo (va nei worker)
+    data: pd.DataFrame
+    title: str = ""
+    xlabel: str = ""
+    ylabel: str = ""
+    figsize: tuple = (10, 6)
+    opts: dict = field(default_factory=dict)
+
+# Funzioni di disegno
+
+def _rotate_labels(ax, rotation: int) -> None:
+    for label in ax.get_xticklabels():
+        label.set_rotation(rotation)
+        label.set_horizontalalignment("right")
+
+def line(ax, data: pd.DataFrame, x: str, y: str, rotation: int = 30) -> None:
+    ax.plot(data[x], data[y], marker="o")
+    _rotate_labels(ax, rotation)
+
+def bars(ax, data: pd.DataFrame, x: str, y: str) -> None:
+    ax.bar(data[x], data[y])
+
+def file_bars(ax, data: pd.DataFrame, labels: str, series: list, width: float = None, rotation: int = 45) -> None:
+    # series: [(colonna, etichetta, opzioni di bar)]; senza width le barre sono
+    # sovrapposte, con width affiancate attorno alla posizione del file
+    x = range(len(data))
+    for i, (col, label, kw) in enumerate(series):
+        if width is None:
+            ax.bar(x, data[col], label=label, **kw)
+        else:
+            off = (i - (len(series) - 1) / 2) * width
+            ax.bar([j + off for j in x], data[col], width=width, label=label, **kw)
+    ax.set_xticks(list(x))
+    ax.set_xticklabels(data[labels])
+    _rotate_labels(ax, rotation)
+    ax.legend()
+
+# Rendering
+
+def render(chart: Chart, out_dir: Path) -> str:
+    # eseguita nei worker
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    with stage("chart", item=chart.name):
+        fig = Figure(figsize=chart.figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        chart.draw(ax, chart.data, **chart.opts)
+        ax.set_title(chart.title)
+        ax.set_xlabel(chart.xlabel)
+        ax.set_ylabel(chart.ylabel)
+        fig.tight_layout()
+        path = Path(out_dir) / chart.name
+        tmp = tmp_path(path)
+        fig.savefig(tmp, format="png")
+        os.replace(tmp, path)
+    return chart.name
+
+def _matplotlib_version() -> str:
+    try:
+        return version("matplotlib")
+    except PackageNotFoundError:
+        return ""
+
+def chart_hash(chart: Chart) -> str:
+    h = hashlib.sha1()
+    h.update(Path(__file__).read_bytes())
+    h.update(_matplotlib_version().encode("utf-8"))
+    h.update(repr((chart.draw.__name__, chart.title, chart.xlabel, chart.ylabel, tuple(chart.figsize),
+                   sorted(chart.opts.items()))).encode("utf-8"))
+    h.update(repr((list(chart.data.columns), [str(t) for t in chart.data.dtypes])).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(chart.data, index=False).to_numpy().tobytes())
+    return h.hexdigest()[:16]
+
+def render_charts(charts: list, out_dir: Path, workers: int = DEFAULT_WORKERS, force: bool = False) -> list:
+    # disegna i grafici con input cambiato; restituisce i nomi dei PNG ridisegnati
+    out_dir = Path(out_dir).resolve()
+    hashes = {c.name: chart_hash(c) for c in charts}
+    with locked_json(MANIFEST) as seen:
+        todo = [c for c in charts
+                if force or not USE_CACHE or seen.get(str(out_dir / c.name)) != hashes[c.name]
+                or not (out_dir / c.name).exists()]
+    names = {c.name for c in todo}
+    for c in charts:
+        if c.name not in names:
+            print(f"Grafico invariato: {c.name}")
+
+    done = list(map_files(partial(render, out_dir=out_dir), todo, min(workers, len(todo) // CHARTS_PER_WORKER)))
+    with locked_json(MANIFEST) as seen:
+        for name in done:
+            seen[str(out_dir / name)] = hashes[name]
+        # voci di PNG non più presenti
+        for key in [k for k in seen if not Path(k).exists()]:
+            seen.pop(key)
+    return done
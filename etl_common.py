@@ -0,0 +1,145 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import schema_registry
+
+# Configurazione e trasformazioni condivise dagli script della pipeline
+# (importabili anche dai processi worker del loader parallelo)
+
+# Cartelle e file di input (ordine cronologico GEN - AGO)
+
+HERE = Path(__file__).resolve().parent
+INPUT_DIR = (HERE / "dati_puliti").resolve()
+
+INPUT_FILES = [
+    INPUT_DIR / "cleaned_dataG.xlsx",          # GENNAIO
+    INPUT_DIR / "cleaned_dataF.xlsx",          # FEBBRAIO
+    INPUT_DIR / "Copia di cleaned_dataA.xlsx", # APRILE
+    INPUT_DIR / "cleaned_dataM.xlsx",          # MAGGIO
+    INPUT_DIR / "cleaned_dataGIU.xlsx",        # GIUGNO
+    INPUT_DIR / "cleaned_dataL.xlsx",          # LUGLIO
+    INPUT_DIR / "cleaned_dataAGO.xlsx",        # AGOSTO
+]
+
+MONTH_LABEL = {
+    "cleaned_dataG.xlsx": "GENNAIO",
+    "cleaned_dataF.xlsx": "FEBBRAIO",
+    "Copia di cleaned_dataA.xlsx": "APRILE",
+    "cleaned_dataM.xlsx": "MAGGIO",
+    "cleaned_dataGIU.xlsx": "GIUGNO",
+    "cleaned_dataL.xlsx": "LUGLIO",
+    "cleaned_dataAGO.xlsx": "AGOSTO",
+}
+MONTH_ORDER = ["GENNAIO","FEBBRAIO","APRILE","MAGGIO","GIUGNO","LUGLIO","AGOSTO"]
+
+# Calendario completo, per gli input partizionati per magazzino/anno/mese (etl_partitions)
+CALENDAR = ["GENNAIO", "FEBBRAIO", "MARZO", "APRILE", "MAGGIO", "GIUGNO",
+            "LUGLIO", "AGOSTO", "SETTEMBRE", "OTTOBRE", "NOVEMBRE", "DICEMBRE"]
+
+def month_number(month: str) -> int:
+    # 1-12 per i mesi del calendario, 13 per etichette sconosciute
+    month = str(month).upper().strip()
+    return CALENDAR.index(month) + 1 if month in CALENDAR else len(CALENDAR) + 1
+
+# Funzioni di supporto
+
+def standardize_columns(df: pd.DataFrame, source: str = None) -> pd.DataFrame:
+    # il mapping delle colonne è risolto (e memorizzato) dal registro delle intestazioni
+    lower = {str(c).lower().strip(): c for c in df.columns}
+    mapping = schema_registry.lookup(df.columns, source)
+
+    out = pd.DataFrame(index=df.index)
+    for new in schema_registry.CANDIDATES:
+        key = mapping.get(new)
+        out[new] = df[lower[key]] if key is not None else np.nan
+    return out
+
+def to_num(s: pd.Series) -> pd.Series:
+    return pd.to_numeric(s, errors="coerce")
+
+# by_distinct: campione per stimare quanti valori distinti ha una colonna
+DISTINCT_SAMPLE = 10_000
+DISTINCT_MAX_RATIO = 0.99
+
+def _repetitive(s: pd.Series) -> bool:
+    # True se nel campione almeno l'1% dei valori si ripete: sotto questa soglia
+    # (codici quasi unici, come in un singolo file mensile) factorize costa più
+    # di quanto si risparmia normalizzando solo i valori distinti
+    if len(s) > DISTINCT_SAMPLE:
+        s = s.iloc[np.random.default_rng(0).choice(len(s), DISTINCT_SAMPLE, replace=False)]
+    return s.nunique(dropna=False) <= DISTINCT_MAX_RATIO * len(s)
+
+def by_distinct(func):
+    # applica func (elemento per elemento) una volta per valore distinto e riporta
+    # il risultato sulle righe con take. Solo per i tipi in cui valori uguali per
+    # factorize hanno la stessa stringa (testo, categorie, interi); per gli object
+    # misti (1 e 1.0, True e 1) e i float (0.0 e -0.0) func si applica a tutte le righe
+    def wrapper(s: pd.Series) -> pd.Series:
+        exact = (isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_integer_dtype(s)
+                 or pd.api.types.is_bool_dtype(s) or pd.api.types.is_string_dtype(s))
+        if s.dtype == object:
+            exact = pd.api.types.infer_dtype(s, skipna=True) in ("string", "empty")
+        if not exact or len(s) == 0 or not _repetitive(s):
+            return func(s)
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        out = func(pd.Series(uniques)).take(codes)
+        out.index, out.name = s.index, s.name
+        return out
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+@by_distinct
+def normalize_code(s: pd.Series) -> pd.Series:
+    s = s.astype(str).str.upper().str.replace(r"[^A-Z0-9]", "", regex=True)
+    return s.replace({"NAN": np.nan})
+
+@by_distinct
+def normalize_uom(s: pd.Series) -> pd.Series:
+    s = s.astype(str).str.upper().str.strip()
+    s = s.replace({"PAGINA": "KG", "PAGES": "KG", "": "KG", "NAN": "KG"}).fillna("KG")
+    return s
+
+def clamp_non_negative(s: pd.Series) -> pd.Series:
+    s = to_num(s)
+    return s.mask(s < 0, 0)
+
+# Schema tipizzato del dataset consolidato
+# code/description/uom come categorie (codici interi + dizionario), mese_rif come
+# categoria ordinata su MONTH_ORDER, quantità in float32 quando la conversione è esatta.
+
+DATASET_COLUMNS = ["code", "description", "uom", "stock", "real", "outgoing", "mese_rif"]
+CATEGORY_COLS = ["code", "description", "uom"]
+QTY_COLS = ["stock", "real", "outgoing"]
+MONTH_DTYPE = pd.CategoricalDtype(MONTH_ORDER, ordered=True)
+
+def month_dtype(values) -> pd.CategoricalDtype:
+    # mesi fuori da MONTH_ORDER (se presenti) vengono aggiunti in ordine di calendario, non persi
+    extra = set(pd.Series(values).dropna().astype(str)) - set(MONTH_ORDER)
+    if not extra:
+        return MONTH_DTYPE
+    return pd.CategoricalDtype(sorted(MONTH_ORDER + list(extra), key=lambda m: (month_number(m), m)), ordered=True)
+
+def downcast_lossless(s: pd.Series) -> pd.Series:
+    if not pd.api.types.is_float_dtype(s) or s.dtype == np.float32:
+        return s
+    f32 = s.astype(np.float32)
+    same = (f32.astype(np.float64) == s) | s.isna()
+    return f32 if bool(same.all()) else s
+
+def apply_typed_schema(df: pd.DataFrame) -> pd.DataFrame:
+    # idempotente: può essere applicata a frame già tipizzati
+    out = df.copy()
+    for c in CATEGORY_COLS:
+        if c in out.columns and not isinstance(out[c].dtype, pd.CategoricalDtype):
+            out[c] = out[c].astype("category")
+    if "mese_rif" in out.columns:
+        m = out["mese_rif"]
+        if not (isinstance(m.dtype, pd.CategoricalDtype) and m.dtype == month_dtype(m.dtype.categories)):
+            m = m.astype(str).str.upper().str.strip().where(m.notna())
+            out["mese_rif"] = m.astype(month_dtype(m))
+    for c in QTY_COLS:
+        if c in out.columns:
+            out[c] = downcast_lossless(pd.to_numeric(out[c], errors="coerce"))
+    return out
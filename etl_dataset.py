@@ -0,0 +1,402 @@
+import os
+import shutil
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from etl_common import CATEGORY_COLS, HERE, QTY_COLS, apply_typed_schema, downcast_lossless, month_number
+from etl_utils import tmp_path
+
+# Dataset consolidato in Parquet, partizionato per mese (layout hive:
+# dataset_finale_ETL_QA/mese_rif=GENNAIO/part-0.parquet). È il formato di
+# scambio tra gli script: conserva i tipi, si legge per colonne e per mese e
+# può essere mappato in memoria. L'.xlsx è solo un'esportazione su richiesta.
+
+DATASET_DIR = HERE / "dataset_finale_ETL_QA"
+DATASET_XLSX = HERE / "dataset_finale_ETL_QA.xlsx"
+PART_FILE = "part-0.parquet"
+EXCEL_MAX_ROWS = 1_048_575
+MEMORY_MAP = os.environ.get("ETL_DATASET_MMAP", "0") == "1"
+
+def partition_dir(month: str, root: Path = DATASET_DIR) -> Path:
+    return Path(root) / f"mese_rif={month}"
+
+def available_months(root: Path = DATASET_DIR) -> list:
+    # mesi presenti, in ordine di calendario (MONTH_ORDER ne è una sottosequenza)
+    root = Path(root)
+    if not root.exists():
+        return []
+    found = [p.name.split("=", 1)[1] for p in root.iterdir()
+             if p.is_dir() and p.name.startswith("mese_rif=") and any(p.glob("*.parquet"))]
+    return sorted(found, key=lambda m: (month_number(m), m))
+
+def _write_partition_files(df: pd.DataFrame, root: Path) -> None:
+    for month, part in df.groupby("mese_rif", observed=True, sort=False):
+        d = partition_dir(str(month), root)
+        d.mkdir(parents=True, exist_ok=True)
+        _own_categories(part).drop(columns="mese_rif").to_parquet(d / PART_FILE, index=False)
+
+def _own_categories(part: pd.DataFrame) -> pd.DataFrame:
+    # ogni partizione salva nel dizionario solo i propri valori, non quelli dell'intero
+    # dataset, e le quantità in float32 se lo consentono i suoi valori: stesse
+    # partizioni in modalità completa, incrementale e a blocchi
+    part = part.copy()
+    for c in CATEGORY_COLS:
+        if c in part.columns and isinstance(part[c].dtype, pd.CategoricalDtype):
+            part[c] = part[c].cat.remove_unused_categories()
+    for c in QTY_COLS:
+        if c in part.columns:
+            part[c] = downcast_lossless(part[c])
+    return part
+
+def _concat(frames: list) -> pd.DataFrame:
+    # le colonne categoriche delle partizioni (dizionari diversi) si uniscono sui codici,
+    # con le categorie ordinate come da astype("category")
+    cats = [c for c in frames[0].columns
+            if all(isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames)]
+    out = pd.concat([f.drop(columns=cats) for f in frames], ignore_index=True)
+    for c in cats:
+        out[c] = union_categoricals([f[c] for f in frames], sort_categories=True)
+    return out[list(frames[0].columns)]
+
+def replace_dir(tmp: Path, root: Path) -> None:
+    # sostituisce la cartella del dataset con quella appena scritta
+    root = Path(root)
+    old = root.with_name(root.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if root.exists():
+        os.replace(root, old)
+    os.replace(tmp, root)
+    shutil.rmtree(old, ignore_errors=True)
+
+def write_dataset(df: pd.DataFrame, root: Path = DATASET_DIR) -> Path:
+    # riscrittura completa, con scambio della cartella a fine scrittura
+    root = Path(root)
+    tmp = root.with_name(root.name + f".{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    _write_partition_files(apply_typed_schema(df), tmp)
+    replace_dir(tmp, root)
+    return root
+
+def write_partition(df: pd.DataFrame, month: str, root: Path = DATASET_DIR) -> Path:
+    # sostituisce un solo mese (modalità incrementale)
+    d = partition_dir(month, root)
+    d.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(d / PART_FILE)
+    _own_categories(apply_typed_schema(df)).drop(columns="mese_rif").to_parquet(tmp, index=False)
+    os.replace(tmp, d / PART_FILE)
+    return d / PART_FILE
+
+def drop_partition(month: str, root: Path = DATASET_DIR) -> None:
+    shutil.rmtree(partition_dir(month, root), ignore_errors=True)
+
+def read_dataset(columns=None, months=None, memory_map: bool = MEMORY_MAP,
+                 root: Path = DATASET_DIR) -> pd.DataFrame:
+    # legge solo le colonne e le partizioni richieste, in ordine di calendario
+    q = scan(root, memory_map)
+    if months is not None:
+        q = q.months(months)
+    if columns is not None:
+        q = q.select(*columns)
+    return q.to_pandas()
+
+# Interrogazioni pigre
+#
+#   q = scan().select("code", "stock").months(["GENNAIO", "FEBBRAIO"]).codes(["AB1234"])
+#   q.to_pandas()              # DataFrame tipizzato, come read_dataset
+#   q.iter_batches(100_000)    # blocchi di DataFrame
+#   q.head(15)
+#   q.count()                  # righe (senza filtri: dai soli metadati Parquet)
+#   q.null_counts()            # nulli per colonna (senza filtri: dalle statistiche)
+#   q.aggregate(["code"], giacenza=("stock", "sum"), righe=("stock", "size"))
+#
+# Ogni metodo restituisce una nuova Query e nulla viene letto finché non si chiede
+# un risultato. Le partizioni escluse da months() non vengono aperte; colonne,
+# colonne calcolate (derive) e filtri sulle righe (espressioni pyarrow.compute,
+# where(pc.field("stock") < 0)) passano allo scanner di pyarrow.dataset, che
+# decodifica solo le colonne usate e salta i row group esclusi dalle statistiche.
+# Le aggregazioni si calcolano in Arrow un blocco alla volta: in memoria restano
+# solo i parziali per gruppo, mai le righe. scan() accetta anche un singolo file
+# Parquet (per esempio la copia in cache di un workbook, excel_cache).
+
+AGGREGATES = ("sum", "count", "size", "min", "max", "mean")
+
+@dataclass(frozen=True)
+class Query:
+    sources: tuple            # (mese o None, file Parquet) in ordine di calendario
+    columns: tuple = None     # colonne del risultato (None: tutte, più mese_rif)
+    derived: tuple = ()       # (nome, espressione) calcolate durante la lettura
+    filter: object = None     # espressione pyarrow.compute sulle righe
+    memory_map: bool = MEMORY_MAP
+
+    def select(self, *columns) -> "Query":
+        return replace(self, columns=tuple(columns))
+
+    def months(self, months) -> "Query":
+        wanted = {str(m).upper().strip() for m in months}
+        return replace(self, sources=tuple(s for s in self.sources if s[0] in wanted))
+
+    def where(self, expr) -> "Query":
+        return replace(self, filter=expr if self.filter is None else self.filter & expr)
+
+    def codes(self, codes) -> "Query":
+        import pyarrow.compute as pc
+
+        return self.where(pc.field("code").isin([str(c) for c in codes]))
+
+    def derive(self, **exprs) -> "Query":
+        return replace(self, derived=self.derived + tuple(exprs.items()))
+
+    # Lettura
+
+    def _dataset(self, path: Path):
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+
+        return ds.dataset(str(path), format="parquet", filesystem=fs.LocalFileSystem(use_mmap=self.memory_map))
+
+    def _names(self, dataset) -> list:
+        # colonne del risultato per una sorgente
+        if self.columns is not None:
+            return list(self.columns)
+        return dataset.schema.names + [n for n, _ in self.derived] + ["mese_rif"]
+
+    def _scanner(self, dataset, names, batch_size: int = None):
+        # proiezione: solo le colonne dei file e le espressioni richieste
+        import pyarrow.compute as pc
+
+        derived = dict(self.derived)
+        proj = {n: derived[n] if n in derived else pc.field(n) for n in names if n != "mese_rif"}
+        kw = {} if batch_size is None else {"batch_size": batch_size}
+        return dataset.scanner(columns=proj, filter=self.filter, **kw)
+
+    def _frame(self, table, month, names) -> pd.DataFrame:
+        part = table.to_pandas()
+        if "mese_rif" in names and "mese_rif" not in part.columns and month is not None:
+            part["mese_rif"] = month
+        return part[[n for n in names if n in part.columns]]
+
+    def to_pandas(self) -> pd.DataFrame:
+        frames = []
+        for month, path in self.sources:
+            dataset = self._dataset(path)
+            names = self._names(dataset)
+            frames.append(self._frame(self._scanner(dataset, names).to_table(), month, names))
+        if not frames:
+            return apply_typed_schema(pd.DataFrame(columns=list(self.columns or [])))
+        return apply_typed_schema(_concat(frames))
+
+    def iter_batches(self, batch_size: int = 1_000_000):
+        for month, path in self.sources:
+            dataset = self._dataset(path)
+            names = self._names(dataset)
+            for batch in self._scanner(dataset, names, batch_size).to_batches():
+                if batch.num_rows:
+                    yield self._frame(batch, month, names)
+
+    def head(self, n: int = 5) -> pd.DataFrame:
+        # legge solo i primi blocchi
+        frames, rows = [], 0
+        for part in self.iter_batches(max(n, 1)):
+            frames.append(part)
+            rows += len(part)
+            if rows >= n:
+                break
+        if not frames:
+            return self.to_pandas()
+        return apply_typed_schema(_concat(frames).head(n))
+
+    def schema(self):
+        # schema Arrow delle colonne dei file (prima sorgente), senza leggere dati
+        import pyarrow as pa
+
+        return self._dataset(self.sources[0][1]).schema if self.sources else pa.schema([])
+
+    # Conteggi e aggregazioni
+
+    def count(self) -> int:
+        import pyarrow.parquet as pq
+
+        if self.filter is None:
+            return sum(pq.ParquetFile(path).metadata.num_rows for _, path in self.sources)
+        return sum(self._dataset(path).count_rows(filter=self.filter) for _, path in self.sources)
+
+    def null_counts(self) -> dict:
+        # nulli per colonna dei file; senza filtri dalle statistiche dei row group,
+        # leggendo solo le colonne che non le hanno
+        import pyarrow.parquet as pq
+
+        out = {}
+        for _, path in self.sources:
+            dataset = self._dataset(path)
+            names = [n for n in self._names(dataset) if n in dataset.schema.names]
+            missing = names
+            if self.filter is None:
+                md = pq.ParquetFile(path).metadata
+                stats, missing = {}, []
+                for n in names:
+                    i = md.schema.names.index(n) if n in md.schema.names else None
+                    chunks = [None if i is None else md.row_group(g).column(i).statistics
+                              for g in range(md.num_row_groups)]
+                    if all(s is not None and s.has_null_count for s in chunks):
+                        stats[n] = sum(s.null_count for s in chunks)
+                    else:
+                        missing.append(n)
+                for n, k in stats.items():
+                    out[n] = out.get(n, 0) + int(k)
+            if missing:
+                table = self._scanner(dataset, missing).to_table()
+                for n in missing:
+                    out[n] = out.get(n, 0) + int(table.column(n).null_count)
+        return out
+
+    def aggregate(self, by, **aggs) -> pd.DataFrame:
+        # aggs: nome=(colonna, funzione), funzione in AGGREGATES ("size": righe del
+        # gruppo, nulli compresi; le somme di soli nulli valgono 0). Gruppi con
+        # chiave nulla inclusi, risultato ordinato per chiave
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        by = [by] if isinstance(by, str) else list(by)
+        for name, (_, func) in aggs.items():
+            if func not in AGGREGATES:
+                raise ValueError(f"aggregazione non supportata per {name}: {func}")
+        # parziali per blocco: media come somma e conteggio
+        partial = []
+        for col, func in dict.fromkeys(aggs.values()):
+            partial += [(col, "sum"), (col, "count")] if func == "mean" else [(col, func)]
+        partial = list(dict.fromkeys(partial))
+        inputs = list(dict.fromkeys(by + [c for c, _ in partial]))
+
+        def group(table, specs):
+            return table.group_by(by).aggregate(specs)
+
+        def specs(op: str):
+            # funzione di Arrow per i parziali dei blocchi ("first") e per la loro unione
+            return [(f"_p{i}", *_arrow_agg(func if op == "first" else _COMBINE[func]))
+                    for i, (_, func) in enumerate(partial)]
+
+        def rename(table):
+            # _p0_sum -> _p0: stesso nome prima e dopo l'unione dei parziali
+            return table.rename_columns([c if c in by else "_" + c.split("_")[1] for c in table.column_names])
+
+        parts = []
+        for month, path in self.sources:
+            dataset = self._dataset(path)
+            chunks = []
+            for batch in self._scanner(dataset, inputs).to_batches():
+                if not batch.num_rows:
+                    continue
+                table = pa.Table.from_batches([batch])
+                if "mese_rif" in by:
+                    table = table.append_column("mese_rif", pa.array([month] * len(table), pa.string()))
+                table = pa.table([table.column(k) for k in by] + [table.column(c) for c, _ in partial],
+                                 names=by + [f"_p{i}" for i in range(len(partial))])
+                chunks.append(rename(_decode_keys(group(table, specs("first")), by)))
+            # tipi diversi tra partizioni (downcast_lossless: float32 in un mese, float64
+            # in un altro): i parziali si uniscono promuovendo al tipo comune
+            if chunks:
+                parts.append(rename(group(pa.concat_tables(chunks, promote_options="permissive"), specs("combine"))))
+        if parts:
+            table = rename(group(pa.concat_tables(parts, promote_options="permissive"), specs("combine")))
+            table = table.sort_by([(k, "ascending") for k in by])
+        else:
+            table = pa.table({n: pa.array([], pa.string() if n in by else pa.float64())
+                              for n in by + [f"_p{i}" for i in range(len(partial))]})
+        out = {k: table.column(k) for k in by}
+        for name, (col, func) in aggs.items():
+            if func == "mean":
+                s, n = (table.column(f"_p{partial.index((col, f))}") for f in ("sum", "count"))
+                out[name] = pc.divide(pc.cast(s, pa.float64()), pc.cast(n, pa.float64()))
+            else:
+                out[name] = table.column(f"_p{partial.index((col, func))}")
+        df = pa.table(out).to_pandas()
+        return df.astype({n: "float64" for n, (_, f) in aggs.items() if f == "mean"})
+
+# funzione Arrow (con opzioni) di ogni aggregazione e funzione che ne unisce i parziali
+_COMBINE = {"sum": "sum", "count": "sum", "size": "sum", "min": "min", "max": "max"}
+
+def _arrow_agg(func: str) -> tuple:
+    import pyarrow.compute as pc
+
+    if func == "sum":
+        return "sum", pc.ScalarAggregateOptions(min_count=0)
+    if func == "size":
+        return "count", pc.CountOptions(mode="all")
+    return func, None
+
+def _decode_keys(table, by: list):
+    # chiavi dictionary (dizionari diversi tra blocchi e partizioni) -> valori
+    import pyarrow as pa
+
+    for k in by:
+        col = table.column(k)
+        if pa.types.is_dictionary(col.type):
+            table = table.set_column(table.schema.get_field_index(k), k, col.cast(col.type.value_type))
+    return table
+
+def scan(root: Path = DATASET_DIR, memory_map: bool = MEMORY_MAP) -> Query:
+    # dataset partizionato per mese (tutti i mesi presenti) o singolo file Parquet
+    root = Path(root)
+    if root.is_file():
+        return Query(((None, root),), memory_map=memory_map)
+    return Query(tuple((m, partition_dir(m, root) / PART_FILE) for m in available_months(root)),
+                 memory_map=memory_map)
+
+def load_dataset(columns=None, months=None, memory_map: bool = MEMORY_MAP) -> pd.DataFrame:
+    # punto di accesso per gli script a valle; ripiega sull'xlsx per dataset prodotti
+    # da versioni precedenti della pipeline
+    if available_months():
+        return read_dataset(columns, months, memory_map)
+    if DATASET_XLSX.exists():
+        from excel_cache import read_excel_cached
+
+        cols = None if columns is None else list(dict.fromkeys(list(columns) + ["mese_rif"]))
+        df = apply_typed_schema(read_excel_cached(DATASET_XLSX, columns=cols))
+        if months is not None:
+            df = df[df["mese_rif"].isin([str(m).upper().strip() for m in months])]
+        return df if columns is None else df[list(columns)]
+    raise SystemExit(f"Dataset non trovato: {DATASET_DIR} (eseguire make_quality_report.py)")
+
+def export_xlsx(dst: Path = DATASET_XLSX, root: Path = DATASET_DIR, batch_size: int = 100_000) -> bool:
+    # esportazione Excel su richiesta per gli utenti di business
+    # (openpyxl write-only, una partizione e un blocco alla volta)
+    import pyarrow.parquet as pq
+    from openpyxl import Workbook
+
+    months = available_months(root)
+    files = [pq.ParquetFile(partition_dir(m, root) / PART_FILE) for m in months]
+    n = sum(f.metadata.num_rows for f in files)
+    if n > EXCEL_MAX_ROWS:
+        print(f"Attenzione: {n} righe oltre il limite di Excel, {Path(dst).name} non scritto")
+        return False
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    header = None
+    for m, f in zip(months, files):
+        names = f.schema_arrow.names
+        if header is None:
+            header = names + ["mese_rif"]
+            ws.append(header)
+        for batch in f.iter_batches(batch_size=batch_size):
+            for row in batch.to_pylist():
+                ws.append([None if (isinstance(v, float) and v != v) else v for v in row.values()] + [m])
+    if header is None:
+        return False
+    wb.save(dst)
+    return True
+
+if __name__ == "__main__":
+    import sys
+
+    if "--export-xlsx" in sys.argv:
+        if export_xlsx():
+            print("Creato:", DATASET_XLSX)
+    else:
+        for m in available_months():
+            f = partition_dir(m) / PART_FILE
+            print(f" - {m}: {f.stat().st_size / 1024:.0f} KB")
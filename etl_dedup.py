@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+from etl_common import QTY_COLS, downcast_lossless
+
+# Deduplica per hash della chiave normalizzata (code, description, mese_rif).
+# Ogni colonna chiave viene fattorizzata (per le categorie i codici esistono già)
+# e solo i valori distinti vengono hashati; gli hash a 64 bit delle colonne si
+# combinano riga per riga. Le righe con lo stesso hash vengono verificate sui
+# codici delle colonne: in caso di collisione si ripiega sul raggruppamento esatto.
+#
+# Politiche:
+#   first  tiene la prima riga di ogni chiave (come drop_duplicates)
+#   last   tiene l'ultima
+#   sum    tiene la prima riga con le quantità sommate sul gruppo
+#
+# Oltre al frame deduplicato viene restituita la provenienza dei duplicati:
+# una riga per ogni riga scartata con file e riga di origine (posizione nei dati
+# del file, 0 = prima riga sotto l'intestazione) e file e riga della riga tenuta.
+
+KEY = ["code", "description", "mese_rif"]
+POLICIES = ("first", "last", "sum")
+PROVENANCE_COLUMNS = ["file", "riga", "file_tenuto", "riga_tenuta"]
+
+_SEED = np.uint64(0xCBF29CE484222325)
+_MULT = np.uint64(0x100000001B3)
+
+def _factorize(s: pd.Series) -> tuple:
+    # codici interi (null = -1) e valori distinti
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.codes.to_numpy(dtype=np.int64), s.cat.categories
+    codes, uniques = pd.factorize(s)
+    return codes.astype(np.int64, copy=False), uniques
+
+def _column_hash(codes: np.ndarray, uniques) -> np.ndarray:
+    # hash dei soli valori distinti (più uno per il null), poi esteso alle righe
+    values = np.append(np.asarray(uniques, dtype=object), None)
+    hu = pd.util.hash_array(values, categorize=False)
+    return hu[np.where(codes < 0, len(values) - 1, codes)]
+
+def _combine(hashes) -> np.ndarray:
+    h = None
+    for hc in hashes:
+        if h is None:
+            h = np.full(len(hc), _SEED, dtype=np.uint64)
+        h = (h ^ hc) * _MULT
+    return h
+
+def column_hash(s: pd.Series) -> np.ndarray:
+    # hash a 64 bit dei valori di una colonna (i null hanno tutti lo stesso hash)
+    return _column_hash(*_factorize(s))
+
+def key_hash(df: pd.DataFrame, cols=KEY) -> np.ndarray:
+    # hash a 64 bit della chiave, stabile tra frame diversi (dipende solo dai valori)
+    return _combine(column_hash(df[c]) for c in cols)
+
+def group_ids(df: pd.DataFrame, key=KEY) -> tuple:
+    # id di gruppo per riga, numerati in ordine di prima occorrenza, e numero di gruppi
+    ids, n, _ = hash_groups(df, key)
+    return ids, n
+
+def hash_groups(df: pd.DataFrame, key=KEY) -> tuple:
+    # come group_ids, più l'hash della chiave di ogni gruppo (key_hash)
+    cols = [_factorize(df[c]) for c in key]
+    ids, uniques = pd.factorize(_combine(_column_hash(*c) for c in cols))
+    first = np.flatnonzero(~pd.Series(ids).duplicated().to_numpy())
+    rows = np.flatnonzero(first[ids] != np.arange(len(ids)))
+    if any((codes[rows] != codes[first[ids[rows]]]).any() for codes, _ in cols):
+        # collisione di hash: raggruppamento esatto sui valori
+        ids = df.groupby(key, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        first = np.flatnonzero(~pd.Series(ids).duplicated().to_numpy())
+        return ids, len(first), key_hash(df.iloc[first], key)
+    return ids.astype(np.int64, copy=False), len(uniques), np.asarray(uniques, dtype=np.uint64)
+
+def _locate(pos: np.ndarray, sources) -> tuple:
+    # posizioni nel frame integrato -> (file, riga nel file)
+    names = [str(n) for n, _ in sources]
+    categories = list(dict.fromkeys(names))
+    name_code = np.array([categories.index(n) for n in names], dtype=np.int64)
+    starts = np.cumsum([0] + [int(k) for _, k in sources])[:-1]
+    f = np.searchsorted(starts, pos, side="right") - 1
+    return pd.Categorical.from_codes(name_code[f], categories=categories), pos - starts[f]
+
+def provenance(dropped: np.ndarray, kept: np.ndarray, sources) -> pd.DataFrame:
+    # sources: [(nome file, righe), ...] nell'ordine in cui i file sono concatenati
+    f, r = _locate(dropped, sources)
+    fk, rk = _locate(kept, sources)
+    return pd.DataFrame({"file": f, "riga": r, "file_tenuto": fk, "riga_tenuta": rk})
+
+def dedup(df: pd.DataFrame, key=KEY, policy: str = "first", qty_cols=QTY_COLS, sources=None) -> tuple:
+    # restituisce (frame deduplicato, provenienza dei duplicati)
+    if policy not in POLICIES:
+        raise ValueError(f"Politica di deduplica sconosciuta: {policy} (disponibili: {', '.join(POLICIES)})")
+    n = len(df)
+    ids, n_groups = group_ids(df, key) if n else (np.empty(0, dtype=np.int64), 0)
+    keep = "last" if policy == "last" else "first"
+    kept = np.flatnonzero(~pd.Series(ids).duplicated(keep=keep).to_numpy())
+    rep = np.empty(n_groups, dtype=np.int64)
+    rep[ids[kept]] = kept
+    rep_of_row = rep[ids]
+    dropped = np.flatnonzero(rep_of_row != np.arange(n))
+
+    out = df.iloc[kept]
+    if policy == "sum" and len(dropped):
+        out = out.copy()
+        for c in qty_cols:
+            if c in out.columns:
+                v = pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+                sums = np.bincount(ids, weights=np.nan_to_num(v), minlength=n_groups)
+                out[c] = downcast_lossless(pd.Series(sums[ids[kept]], index=out.index))
+    return out, provenance(dropped, rep_of_row[dropped], sources or [("", n)])
+
+def add_dedup_arg(parser) -> None:
+    parser.add_argument("--dedup", choices=POLICIES, default="first",
+                        help="riga tenuta tra i duplicati: first (prima), last (ultima), "
+                             "sum (prima, con le quantità sommate); default first")
@@ -0,0 +1,197 @@
+import base64
+import json
+import os
+import shutil
+from html import escape
+from pathlib import Path
+
+import pandas as pd
+
+from etl_utils import tmp_path
+
+# Scrittura incrementale dei report HTML (qualità, KPI, Data Dictionary, magazzini).
+# Il report viene scritto su disco un frammento alla volta, senza comporre la
+# pagina in memoria:
+#
+#   with HtmlReport(OUT_HTML) as rep:
+#       rep.write(HEAD)                  # frammenti HTML del report
+#       rep.table(df)                    # tabella
+#       rep.image("grafico.png")         # immagine collegata (embed=True: inclusa in base64)
+#       rep.write("</body></html>")
+#
+# Le tabelle fino a INLINE_ROWS righe restano HTML statico (DataFrame.to_html).
+# Le più grandi (anche come iteratore di blocchi, per le tabelle per articolo)
+# sono divise in pagine di PAGE_ROWS righe scritte come file JSONP in
+# <report>_dati/: la pagina mostra la prima pagina in HTML e carica le altre su
+# richiesta con un tag <script> (funziona anche aprendo il file dal disco, senza
+# server). Tempo e memoria dipendono dalla pagina, non dal numero di righe.
+# Pagina e cartella dei dati sostituiscono le precedenti solo a scrittura finita.
+
+INLINE_ROWS = 500
+PAGE_ROWS = 1000
+IMAGE_CHUNK = 3 * 2**16   # multiplo di 3: i blocchi base64 si concatenano senza padding
+
+PAGER_STYLE = """<style>
+.pager{margin:6px 0}
+.pager button{margin-right:4px}
+</style>
+"""
+
+# caricamento delle pagine: etlPages.page() è chiamata dai file JSONP
+PAGER_SCRIPT = """<script>
+var etlPages = (function () {
+  var tables = {};
+  function load(t) {
+    var s = document.createElement("script");
+    s.src = t.src + "/p" + t.page + ".js";
+    s.onload = function () { s.remove(); };
+    document.head.appendChild(s);
+  }
+  function show(t, rows) {
+    var body = t.el.querySelector("tbody");
+    body.textContent = "";
+    rows.forEach(function (r) {
+      var tr = body.insertRow();
+      r.forEach(function (v) { tr.insertCell().textContent = v === null ? "" : v; });
+    });
+    t.el.querySelector(".pagina").textContent =
+      "pagina " + (t.page + 1) + " di " + t.pages + " (" + t.rows + " righe)";
+  }
+  return {
+    init: function (id, src, pages, rows) {
+      var t = tables[id] = {el: document.getElementById(id), src: src, pages: pages, rows: rows, page: 0};
+      t.el.querySelectorAll("button").forEach(function (b) {
+        b.onclick = function () {
+          var step = b.getAttribute("data-step");
+          var n = step === "first" ? 0 : step === "last" ? t.pages - 1 : t.page + parseInt(step, 10);
+          if (n >= 0 && n < t.pages && n !== t.page) { t.page = n; load(t); }
+        };
+      });
+      t.el.querySelector(".pagina").textContent = "pagina 1 di " + pages + " (" + rows + " righe)";
+    },
+    page: function (id, n, rows) {
+      var t = tables[id];
+      if (t && n === t.page) show(t, rows);
+    }
+  };
+})();
+</script>
+"""
+
+PAGER = """<p class="pager"><button data-step="first">&laquo;</button><button data-step="-1">&lsaquo;</button>\
+<button data-step="1">&rsaquo;</button><button data-step="last">&raquo;</button> <span class="pagina"></span></p>
+"""
+
+def _pages(data, page_rows: int):
+    # pagine di page_rows righe da un DataFrame o da un iteratore di DataFrame
+    frames = [data] if isinstance(data, pd.DataFrame) else data
+    buf, n = None, 0
+    for df in frames:
+        buf = df if buf is None or buf.empty else pd.concat([buf, df], ignore_index=True)
+        while len(buf) >= page_rows:
+            yield buf.iloc[:page_rows]
+            buf, n = buf.iloc[page_rows:], n + 1
+    if buf is not None and (len(buf) or n == 0):   # tabella vuota: una pagina senza righe
+        yield buf
+
+class HtmlReport:
+
+    def __init__(self, path: Path, inline_rows: int = INLINE_ROWS, page_rows: int = PAGE_ROWS):
+        self.path = Path(path)
+        self.inline_rows = inline_rows
+        self.page_rows = page_rows
+        self.data_dir = self.path.with_name(self.path.stem + "_dati")
+        self._tmp = tmp_path(self.path)
+        self._tmp_data = tmp_path(self.data_dir)
+        self._f = open(self._tmp, "w", encoding="utf-8")
+        self._tables = 0
+        self._paged = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, html: str) -> None:
+        self._f.write(html)
+
+    def table(self, data, float_format=None, end: str = "\n") -> None:
+        # DataFrame o iteratore di DataFrame (stesse colonne); float_format come in to_html
+        pages = _pages(data, self.page_rows)
+        if isinstance(data, pd.DataFrame) and len(data) <= self.inline_rows:
+            first, more = data, False
+        else:
+            first = next(pages, None)
+            if first is None:
+                return
+            nxt = next(pages, None)
+            more = nxt is not None or len(first) > self.inline_rows
+            if not more:
+                pages = iter(())
+            elif nxt is not None:
+                pages = _chain(nxt, pages)
+        if not more:
+            self.write(first.to_html(index=False, float_format=float_format) + end)
+            return
+        self._paged_table(first, pages, float_format, end)
+
+    def _paged_table(self, first: pd.DataFrame, rest, float_format, end: str) -> None:
+        self._tables += 1
+        tid = f"t{self._tables}"
+        if not self._paged:
+            self._paged = True
+            self._tmp_data.mkdir(parents=True)
+            self.write(PAGER_STYLE + PAGER_SCRIPT)
+        (self._tmp_data / tid).mkdir()
+        self.write(f'<div id="{tid}">\n{PAGER}')
+        self.write(first.to_html(index=False, float_format=float_format))
+        self.write("</div>\n")
+        rows, n = 0, 0
+        for n, page in enumerate(_chain(first, rest)):
+            self._write_page(tid, n, page)
+            rows += len(page)
+        src = f"{self.data_dir.name}/{tid}"
+        self.write(f'<script>etlPages.init("{tid}", {json.dumps(src)}, {n + 1}, {rows})</script>{end}')
+
+    def _write_page(self, tid: str, n: int, page: pd.DataFrame) -> None:
+        # JSON delle righe (to_json: NaN -> null, tipi numpy e date convertiti)
+        rows = page.to_json(orient="values", date_format="iso", default_handler=str)
+        with open(self._tmp_data / tid / f"p{n}.js", "w", encoding="utf-8") as f:
+            f.write(f'etlPages.page("{tid}", {n}, {rows});\n')
+
+    def image(self, src: Path, embed: bool = False, alt: str = "") -> None:
+        # collegata con un percorso relativo al report (nessuna copia), oppure inclusa
+        # in base64 leggendo il file a blocchi
+        src = Path(src)
+        alt = f' alt="{escape(alt)}"' if alt else ""
+        if not embed:
+            rel = os.path.relpath(src, self.path.parent) if src.is_absolute() else str(src)
+            self.write(f'<img src="{escape(Path(rel).as_posix())}"{alt}/>')
+            return
+        mime = "image/svg+xml" if src.suffix.lower() == ".svg" else f"image/{src.suffix.lower().lstrip('.')}"
+        self.write(f'<img{alt} src="data:{mime};base64,')
+        with open(src, "rb") as f:
+            while chunk := f.read(IMAGE_CHUNK):
+                self.write(base64.b64encode(chunk).decode("ascii"))
+        self.write('"/>')
+
+    def close(self) -> None:
+        # pagina e dati sostituiscono i precedenti insieme, a scrittura finita
+        self._f.close()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        if self._paged:
+            os.replace(self._tmp_data, self.data_dir)
+        os.replace(self._tmp, self.path)
+
+    def abort(self) -> None:
+        self._f.close()
+        Path(self._tmp).unlink(missing_ok=True)
+        shutil.rmtree(self._tmp_data, ignore_errors=True)
+
+def _chain(first, rest):
+    yield first
+    yield from rest
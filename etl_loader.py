@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+import etl_profile
+from etl_common import MONTH_LABEL, MONTH_ORDER, standardize_columns
+from excel_cache import read_excel_cached
+
+# Caricamento parallelo dei file mensili.
+# Ogni file è indipendente: lettura, standardizzazione e tag mese_rif avvengono
+# in un pool di processi. Al più `max_pending` file sono in lavorazione (o in
+# attesa di essere consumati) alla volta, e i risultati escono sempre
+# nell'ordine di input, qualunque sia l'ordine di completamento.
+
+DEFAULT_WORKERS = int(os.environ.get("ETL_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+
+def add_workers_arg(parser) -> None:
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"processi per la lettura dei file (default {DEFAULT_WORKERS}, 1 = sequenziale)")
+
+def map_files(func, paths, workers: int = DEFAULT_WORKERS, max_pending: int = None):
+    # equivalente ordinato e a memoria limitata di map(func, paths)
+    paths = list(paths)
+    if workers <= 1 or len(paths) <= 1:
+        for p in paths:
+            yield func(p)
+        return
+
+    max_pending = max_pending or 2 * workers
+    # da un thread secondario (stadi paralleli di run_pipeline.py) il fork non è
+    # sicuro, con altri thread attivi: i worker partono da un forkserver
+    ctx = None
+    if threading.current_thread() is not threading.main_thread() and os.name == "posix":
+        ctx = multiprocessing.get_context("forkserver")
+    # con la profilazione attiva i worker restituiscono anche i propri record
+    profile = etl_profile.enabled()
+    memory = etl_profile.memory_enabled()
+
+    def submit(p):
+        if profile:
+            return pool.submit(etl_profile.call_collect, func, p, memory)
+        return pool.submit(func, p)
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths)), mp_context=ctx) as pool:
+        pending = []
+        it = iter(paths)
+        for p in it:
+            pending.append(submit(p))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            result = pending.pop(0).result()
+            if profile:
+                result, recs = result
+                etl_profile.merge(recs)
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append(submit(nxt))
+            yield result
+
+def read_standardized(path: Path, month: str = None) -> pd.DataFrame:
+    # month: mese della partizione (input partizionati); altrimenti da MONTH_LABEL
+    df = read_excel_cached(path)
+    with etl_profile.stage("standardize_columns", item=Path(path).name, rows_in=len(df)) as st:
+        std = standardize_columns(df, Path(path).name)
+        st.rows_out = len(std)
+    std["mese_rif"] = month or MONTH_LABEL[Path(path).name]
+    return std
+
+def month_key(path: Path) -> int:
+    return MONTH_ORDER.index(MONTH_LABEL[Path(path).name])
+
+def load_months(paths, workers: int = DEFAULT_WORKERS) -> list:
+    # frame standardizzati in ordine MONTH_ORDER (stabile a parità di mese)
+    paths = sorted(paths, key=month_key)
+    for path in paths:
+        if not Path(path).exists():
+            raise SystemExit(f"File non trovato: {path}")
+    frames = []
+    for path, std in zip(paths, map_files(read_standardized, paths, workers)):
+        print(f"File elaborato: {Path(path).name} ({len(std)} righe)")
+        frames.append(std)
+    return frames
@@ -0,0 +1,95 @@
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+from etl_common import CALENDAR, HERE, INPUT_FILES, MONTH_LABEL, month_number
+
+# Input partizionati per magazzino, anno e mese:
+#
+#   <radice>/<magazzino>/<anno>/<mese>.xlsx     es. dati_magazzini/MILANO/2025/MARZO.xlsx
+#
+# Il mese si ricava dal nome del file: nome italiano (MARZO.xlsx, giacenze_marzo.xlsx)
+# oppure numero (03.xlsx, 2025-03.xlsx). Sono ammessi anche i nomi in stile hive
+# (magazzino=MILANO/anno=2025/mese=MARZO.xlsx). Ogni partizione è un file
+# indipendente: aggiungere magazzini o anni aggiunge partizioni, non righe a un
+# unico frame (vedi run_partitions.py). La radice si imposta con ETL_INPUT_ROOT.
+
+INPUT_ROOT = Path(os.environ.get("ETL_INPUT_ROOT", HERE / "dati_magazzini"))
+LEGACY_WAREHOUSE = "PRINCIPALE"
+LEGACY_YEAR = 2025
+
+@dataclass(frozen=True)
+class Partition:
+    warehouse: str
+    year: int
+    month: str
+    path: Path
+
+    @property
+    def label(self) -> str:
+        return f"{self.warehouse}/{self.year}/{self.month}"
+
+    def sort_key(self) -> tuple:
+        return self.warehouse, self.year, month_number(self.month)
+
+def _value(name: str) -> str:
+    # "anno=2025" -> "2025"
+    return name.split("=", 1)[-1].strip()
+
+def parse_month(name: str):
+    # nome del mese o numero 1-12 nel nome del file; None se assente
+    tokens = [t for t in re.split(r"[^A-Z0-9]+", _value(name).upper()) if t]
+    for t in tokens:
+        if t in CALENDAR:
+            return t
+    for t in tokens:
+        if t.isdigit() and len(t) <= 2 and 1 <= int(t) <= 12:
+            return CALENDAR[int(t) - 1]
+    return None
+
+def parse_year(name: str):
+    # anno a quattro cifre nel nome del file (MARZO_2025.xlsx, 2025-03.xlsx); None se assente
+    for t in re.split(r"[^0-9]+", _value(name)):
+        if len(t) == 4 and 1900 <= int(t) <= 2999:
+            return int(t)
+    return None
+
+def from_path(f: Path):
+    # partizione di un file <magazzino>/<anno>/<mese>.xlsx; None se anno o mese non riconosciuti
+    f = Path(f)
+    year, month = _value(f.parent.name), parse_month(f.stem)
+    if not year.isdigit() or month is None:
+        return None
+    return Partition(_value(f.parent.parent.name).upper(), int(year), month, f)
+
+def discover(root: Path = INPUT_ROOT) -> list:
+    # partizioni trovate sotto root, ordinate per magazzino, anno e mese
+    root = Path(root)
+    if not root.is_dir():
+        raise SystemExit(f"Cartella degli input partizionati non trovata: {root}")
+    found = {}
+    for f in sorted(root.glob("*/*/*.xlsx")):
+        if f.name.startswith("~$"):   # file di lock di Excel
+            continue
+        p = from_path(f)
+        if p is None:
+            print(f"File ignorato (anno o mese non riconosciuti): {f.relative_to(root)}")
+            continue
+        key = (p.warehouse, p.year, p.month)
+        if key in found:
+            raise SystemExit(f"Due file per la partizione {p.label}: {found[key].path} e {f}")
+        found[key] = p
+    return sorted(found.values(), key=Partition.sort_key)
+
+def legacy_partitions(warehouse: str = LEGACY_WAREHOUSE, year: int = LEGACY_YEAR) -> list:
+    # i file mensili di INPUT_FILES come partizioni di un solo magazzino e anno
+    return sorted((Partition(warehouse, year, MONTH_LABEL[p.name], p) for p in INPUT_FILES),
+                  key=Partition.sort_key)
+
+def groups(partitions) -> dict:
+    # {(magazzino, anno): [partizioni]}
+    out = {}
+    for p in partitions:
+        out.setdefault((p.warehouse, p.year), []).append(p)
+    return out
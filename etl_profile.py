@@ -0,0 +1,216 @@
+import csv
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from etl_utils import write_json_atomic
+
+try:
+    import resource   # non disponibile su Windows
+except ImportError:
+    resource = None
+
+# Strumentazione degli stadi della pipeline: tempo reale, tempo CPU, picco di
+# memoria e righe in ingresso/uscita per ogni stadio.
+#
+#   with stage("cleaning", rows_in=len(raw)) as st:
+#       ...
+#       st.rows_out = len(clean)
+#
+# La raccolta è disattivata per default (costo trascurabile); si attiva con
+# --profile negli script o con ETL_PROFILE=1. A fine esecuzione vengono scritti
+# run_profile.json (ultima esecuzione, dettaglio completo) e run_profile.csv
+# (storico: una riga per stadio per esecuzione, per confrontare le notturne),
+# nella stessa cartella di QA_summary.csv. --profile-memory aggiunge il picco
+# tracemalloc (più lento), --cprofile FILE un dump cProfile.
+
+OUT_JSON = "run_profile.json"
+OUT_CSV = "run_profile.csv"
+
+FIELDS = ["run_id", "script", "stage", "item", "parent", "pid", "thread", "start_s", "wall_s", "cpu_s",
+          "rss_peak_mb", "mem_peak_mb", "rows_in", "rows_out"]
+
+_enabled = os.environ.get("ETL_PROFILE", "0") == "1"
+_lock = threading.Lock()
+_local = threading.local()
+_records = []
+_active = set()
+_t0 = time.perf_counter()
+
+class StageRecord:
+
+    def __init__(self, name: str, item=None, rows_in=None):
+        self.stage = name
+        self.item = item
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.parent = None
+        self._peak = 0
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k, None) for k in FIELDS if k not in ("run_id", "script")}
+
+def enabled() -> bool:
+    return _enabled
+
+def memory_enabled() -> bool:
+    return _enabled and tracemalloc.is_tracing()
+
+def rss_peak_mb():
+    if resource is None:
+        return None
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(kb / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _fold_peak() -> int:
+    # il picco tracemalloc è globale: prima di ogni reset viene riportato su
+    # tutti gli stadi attivi (anche annidati o su altri thread)
+    cur, peak = tracemalloc.get_traced_memory()
+    for r in _active:
+        r._peak = max(r._peak, peak)
+    tracemalloc.reset_peak()
+    return cur
+
+@contextmanager
+def stage(name: str, item=None, rows_in=None):
+    rec = StageRecord(name, item, rows_in)
+    if not _enabled:
+        yield rec
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    rec.parent = stack[-1].stage if stack else None
+    rec.pid = os.getpid()
+    rec.thread = threading.current_thread().name
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        with _lock:
+            rec._base = rec._peak = _fold_peak()
+            _active.add(rec)
+    stack.append(rec)
+    t0, c0 = time.perf_counter(), time.process_time()
+    try:
+        yield rec
+    finally:
+        rec.wall_s = round(time.perf_counter() - t0, 4)
+        rec.cpu_s = round(time.process_time() - c0, 4)
+        rec.start_s = round(t0 - _t0, 4)
+        rec.rss_peak_mb = rss_peak_mb()
+        stack.pop()
+        with _lock:
+            if tracing:
+                _fold_peak()
+                _active.discard(rec)
+                rec.mem_peak_mb = round((rec._peak - rec._base) / 2**20, 2)
+            _records.append(rec.as_dict())
+
+# Worker del pool di processi: i record raccolti nel processo figlio tornano al
+# padre insieme al risultato (vedi etl_loader.map_files)
+
+def call_collect(func, arg, memory: bool = False):
+    global _enabled
+    _enabled = True
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    with _lock:
+        _records.clear()
+    out = func(arg)
+    with _lock:
+        recs = list(_records)
+        _records.clear()
+    return out, recs
+
+def enable(on: bool = True, memory: bool = False) -> None:
+    # attivazione da codice (benchmark), senza scrivere il profilo di esecuzione
+    global _enabled
+    _enabled = on
+    if on and memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not (on and memory) and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def reset() -> list:
+    # restituisce e azzera i record raccolti
+    with _lock:
+        out = list(_records)
+        _records.clear()
+    return out
+
+def merge(records) -> None:
+    with _lock:
+        _records.extend(records)
+
+def records() -> list:
+    with _lock:
+        return list(_records)
+
+# Sessione di profilazione per gli script
+
+def add_profile_args(parser) -> None:
+    parser.add_argument("--profile", action="store_true", default=_enabled,
+                        help=f"scrive {OUT_JSON} e {OUT_CSV} (tempi, CPU, memoria, righe per stadio)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="aggiunge il picco di memoria Python per stadio (tracemalloc, più lento)")
+    parser.add_argument("--cprofile", metavar="FILE",
+                        help="salva anche un dump cProfile (leggibile con pstats o snakeviz)")
+
+def write_profile(script: str, out_dir: Path = Path(".")) -> None:
+    recs = records()
+    run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    rows = [{"run_id": run_id, "script": script, **r} for r in recs]
+    out_dir = Path(out_dir)
+    write_json_atomic(out_dir / OUT_JSON, {
+        "run_id": run_id,
+        "script": script,
+        "wall_s": round(time.perf_counter() - _t0, 3),
+        "rss_peak_mb": rss_peak_mb(),
+        "stages": rows,
+    })
+    # lo storico si accumula: una riga per stadio per esecuzione
+    csv_path = out_dir / OUT_CSV
+    new = not csv_path.exists()
+    with open(csv_path, "a", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=FIELDS)
+        if new:
+            w.writeheader()
+        w.writerows(rows)
+
+@contextmanager
+def session(args, script: str):
+    # attiva la raccolta secondo le opzioni di add_profile_args e scrive i risultati a fine esecuzione
+    global _enabled, _t0
+    profile = getattr(args, "profile", False) or getattr(args, "profile_memory", False)
+    cprofile = getattr(args, "cprofile", None)
+    if not profile and not cprofile:
+        yield
+        return
+
+    _enabled = bool(profile)
+    _t0 = time.perf_counter()
+    if getattr(args, "profile_memory", False):
+        tracemalloc.start()
+    prof = None
+    if cprofile:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+    try:
+        with stage(script):
+            yield
+    finally:
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(cprofile)
+            print("Dump cProfile:", cprofile)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if _enabled:
+            write_profile(script)
+            print("Profilo di esecuzione:", OUT_JSON, "/", OUT_CSV)
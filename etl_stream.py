@@ -0,0 +1,330 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import qa_profile as qa
+from etl_common import (
+    DATASET_COLUMNS, MONTH_LABEL, standardize_columns, normalize_code, normalize_uom, clamp_non_negative,
+    downcast_lossless,
+)
+from etl_dataset import DATASET_DIR, PART_FILE, partition_dir, replace_dir
+from etl_dedup import KEY, hash_groups, provenance
+from etl_profile import stage
+
+# Esecuzione a blocchi (streaming) del cleaning, per dataset più grandi della RAM.
+# I file vengono letti a blocchi di `chunk_size` righe; normalizzazione, clamp e
+# deduplica avvengono blocco per blocco e le metriche sono profili QA parziali
+# (qa_profile) sommati blocco dopo blocco.
+# La deduplica usa un seen-set di hash a 64 bit della chiave (code, description,
+# mese_rif, vedi etl_dedup.key_hash) con i valori della chiave per verificare gli
+# hash uguali, come la deduplica in memoria: poiché mese_rif fa parte della
+# chiave e gli input arrivano in ordine di mese, in memoria resta solo l'insieme
+# del mese corrente. Si tiene sempre la prima occorrenza (politica first); il seen-set del
+# dataset pulito ricorda anche la riga tenuta, per la provenienza dei duplicati.
+# Le quantità si scrivono in float64 e, a fine mese, le colonne convertibili
+# senza perdita in tutti i blocchi passano a float32 (downcast_lossless): stessi
+# tipi delle partizioni scritte in modalità completa e incrementale.
+
+DEFAULT_CHUNK_SIZE = 100_000
+NUM_COLS = ["stock", "real", "outgoing"]
+STR_COLS = ["code", "description", "uom", "mese_rif"]
+
+def iter_excel_chunks(path: Path, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    # lettura in sola lettura con openpyxl: il workbook non viene mai caricato per intero
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [str(h) if h is not None else f"Unnamed: {i}" for i, h in enumerate(header)]
+        buf = []
+        for r in rows:
+            if all(v is None for v in r):
+                continue
+            buf.append(r[:len(header)])
+            if len(buf) >= chunk_size:
+                yield pd.DataFrame.from_records(buf, columns=header)
+                buf = []
+        if buf:
+            yield pd.DataFrame.from_records(buf, columns=header)
+    finally:
+        wb.close()
+
+def iter_parquet_chunks(path: Path, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+
+def iter_chunks(path: Path, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    path = Path(path)
+    if path.suffix.lower() == ".parquet":
+        return iter_parquet_chunks(path, chunk_size)
+    return iter_excel_chunks(path, chunk_size)
+
+class SeenSet:
+    # chiavi già viste nel mese corrente. Gli hash a 64 bit della chiave
+    # (etl_dedup.key_hash) stanno in array ordinati ("run"), ciascuno con la riga
+    # tenuta e i valori della chiave: un hash già visto è un duplicato solo se
+    # anche i valori coincidono. Le collisioni vere (stesso hash, chiave diversa)
+    # vanno in un piccolo dizionario a parte. Ogni blocco aggiunge un run e due run
+    # di dimensioni simili si fondono: ogni chiave viene copiata O(log n) volte,
+    # non a ogni blocco come con un solo array ordinato. mese_rif non si conserva:
+    # coincide con il mese dell'insieme.
+
+    def __init__(self, cols=KEY):
+        self.cols = list(cols)
+        self.values = [c for c in self.cols if c != "mese_rif"]
+        self._reset(None)
+
+    def _reset(self, month) -> None:
+        self.month = month
+        self.runs = []          # (hash ordinati, riga tenuta, valori della chiave)
+        self.collisions = {}    # (hash, valori della chiave) -> riga tenuta
+
+    def add(self, month: str, df: pd.DataFrame, rows: np.ndarray = None) -> tuple:
+        # (True per le righe la cui chiave non è ancora stata vista, riga tenuta per ogni riga)
+        if month != self.month:
+            self._reset(month)
+        rows = np.zeros(len(df), dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        # gruppi esatti nel blocco (valori verificati sugli hash uguali), in ordine di
+        # prima occorrenza: si cercano solo i rappresentanti, ordinati per hash
+        ids, _, h = hash_groups(df, self.cols)
+        first_pos = np.flatnonzero(~pd.Series(ids).duplicated().to_numpy())
+        order = np.argsort(h, kind="stable")
+        h, reps = h[order], first_pos[order]
+        keys = _key_values(df, self.values, reps)
+        kept = rows[reps]
+        seen = np.zeros(len(h), dtype=bool)
+        clash = np.zeros(len(h), dtype=bool)
+        for run_h, run_rows, run_keys in self.runs:
+            pos = np.minimum(np.searchsorted(run_h, h), len(run_h) - 1)
+            hit = np.flatnonzero(run_h[pos] == h)
+            same = _same_keys(keys.iloc[hit], run_keys.iloc[pos[hit]])
+            seen[hit[same]] = True
+            kept[hit[same]] = run_rows[pos[hit[same]]]
+            clash[hit[~same]] = True
+
+        # hash già presente con chiave diversa: verifica nel dizionario delle collisioni
+        added = np.zeros(len(h), dtype=bool)
+        for i in np.flatnonzero(clash & ~seen):
+            k = (int(h[i]), _key_tuple(keys, i))
+            if k in self.collisions:
+                seen[i], kept[i] = True, self.collisions[k]
+            else:
+                self.collisions[k] = kept[i]
+                added[i] = True
+
+        # chiavi nuove: un run ordinato per hash (hash ripetuti nel blocco: collisioni)
+        new = np.flatnonzero(~seen & ~added)
+        dup = np.zeros(len(new), dtype=bool)
+        dup[1:] = h[new][1:] == h[new][:-1]
+        for i in new[dup]:
+            self.collisions[(int(h[i]), _key_tuple(keys, i))] = kept[i]
+        new = new[~dup]
+        if len(new):
+            self.runs.append((h[new], kept[new], keys.iloc[new].reset_index(drop=True)))
+            self._merge_runs()
+
+        first = np.zeros(len(ids), dtype=bool)
+        first[reps[~seen]] = True
+        kept_by_group = np.empty(len(h), dtype=np.int64)
+        kept_by_group[order] = kept
+        return first, kept_by_group[ids]
+
+    def _merge_runs(self) -> None:
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            (h1, r1, k1), (h2, r2, k2) = self.runs.pop(-2), self.runs.pop()
+            h = np.concatenate([h1, h2])
+            order = np.argsort(h, kind="stable")
+            keys = pd.concat([k1, k2], ignore_index=True).take(order).reset_index(drop=True)
+            self.runs.append((h[order], np.concatenate([r1, r2])[order], keys))
+
+    def new_mask(self, month: str, df: pd.DataFrame) -> np.ndarray:
+        return self.add(month, df)[0]
+
+def _key_values(df: pd.DataFrame, cols: list, rows: np.ndarray) -> pd.DataFrame:
+    # valori della chiave alle righe date; le categorie come valori (dizionari
+    # diversi tra blocchi non si confrontano)
+    out = {}
+    for c in cols:
+        s = df[c].iloc[rows]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            s = s.astype(s.cat.categories.dtype)
+        out[c] = s.reset_index(drop=True)
+    return pd.DataFrame(out)
+
+def _same_keys(a: pd.DataFrame, b: pd.DataFrame) -> np.ndarray:
+    same = np.ones(len(a), dtype=bool)
+    for c in a.columns:
+        x, y = a[c].to_numpy(dtype=object), b[c].to_numpy(dtype=object)
+        same &= (x == y) | (pd.isna(x) & pd.isna(y))
+    return same
+
+def _key_tuple(keys: pd.DataFrame, i: int) -> tuple:
+    return tuple(None if pd.isna(v) else v for v in keys.iloc[i])
+
+class StreamingCleaner:
+
+    def __init__(self):
+        # duplicati e codici per mese non sono sommabili tra blocchi dello stesso
+        # mese: li contano i seen-set, il resto viene dai profili dei blocchi
+        self.p_before = qa.merge([])
+        self.p_after = qa.merge([])
+        self.p_before["dups"] = self.p_after["dups"] = 0
+        self._raw_seen = SeenSet()
+        self._clean_seen = SeenSet()
+        self._codes_seen = SeenSet(["code"])
+        # provenienza: righe numerate in ordine di lettura su tutti i file
+        self.sources = []
+        self._n_rows = 0
+        self._dropped = []
+        self._kept = []
+
+    @property
+    def before(self) -> dict:
+        return qa.to_metrics(self.p_before, "before")
+
+    @property
+    def after(self) -> dict:
+        return qa.to_metrics(self.p_after, "after")
+
+    @property
+    def dups(self) -> pd.DataFrame:
+        empty = np.empty(0, dtype=np.int64)
+        return provenance(np.concatenate(self._dropped or [empty]), np.concatenate(self._kept or [empty]),
+                          self.sources or [("", 0)])
+
+    def _add(self, p: dict, chunk: pd.DataFrame, month: str) -> dict:
+        part = qa.profile(chunk, key=None, month_col=None, name=month)   # senza dups né mesi
+        return qa.merge([p, part])
+
+    def process(self, raw: pd.DataFrame, month: str, source: str = "") -> pd.DataFrame:
+        rows = self._n_rows + np.arange(len(raw))
+        self._n_rows += len(raw)
+        if self.sources and self.sources[-1][0] == source:
+            self.sources[-1] = (source, self.sources[-1][1] + len(raw))
+        else:
+            self.sources.append((source, len(raw)))
+
+        # QA prima del cleaning
+        first = self._raw_seen.new_mask(month, raw)
+        self.p_before = self._add(self.p_before, raw, month)
+        self.p_before["dups"] += int((~first).sum())
+
+        # Cleaning del blocco
+        clean = raw.copy()
+        clean["code"] = normalize_code(clean["code"])
+        clean["uom"] = normalize_uom(clean["uom"])
+        for col in NUM_COLS:
+            clean[col] = clamp_non_negative(clean[col]).fillna(0)
+        first, kept = self._clean_seen.add(month, clean, rows)
+        self._dropped.append(rows[~first])
+        self._kept.append(kept[~first])
+        clean = clean[first]
+
+        # QA dopo il cleaning (dopo la deduplica i duplicati residui sono zero)
+        self.p_after = self._add(self.p_after, clean, month)
+        codes = clean[["code"]].dropna()
+        new_codes = int(self._codes_seen.new_mask(month, codes).sum())
+        m = self.p_after["months"].setdefault(month, {"rows": 0, "codes": 0})
+        m["rows"] += len(clean)
+        m["codes"] += new_codes
+        return clean
+
+def arrow_schema():
+    # colonne testuali dictionary-encoded: rilette da pandas come categorie;
+    # mese_rif non è nei file, è il nome della partizione
+    import pyarrow as pa
+
+    fields = []
+    for c in DATASET_COLUMNS:
+        if c == "mese_rif":
+            continue
+        typ = pa.float64() if c in NUM_COLS else pa.dictionary(pa.int32(), pa.string())
+        fields.append(pa.field(c, typ))
+    return pa.schema(fields)
+
+def to_arrow(chunk: pd.DataFrame, schema):
+    import pyarrow as pa
+
+    out = chunk.drop(columns="mese_rif")
+    for c in STR_COLS:
+        if c in out.columns:
+            s = out[c]
+            out[c] = s.where(s.isna(), s.astype(str)).astype(object)
+    return pa.Table.from_pandas(out, schema=schema, preserve_index=False)
+
+def lossless_cols(chunk: pd.DataFrame) -> set:
+    # quantità del blocco convertibili in float32 senza perdita
+    return {c for c in NUM_COLS if downcast_lossless(chunk[c]).dtype == np.float32}
+
+def downcast_file(path: Path, cols) -> None:
+    # riscrive una partizione con le colonne indicate in float32, un row group alla volta
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    src = pq.ParquetFile(path)
+    schema = src.schema_arrow.remove_metadata()
+    for c in cols:
+        i = schema.get_field_index(c)
+        schema = schema.set(i, schema.field(i).with_type(pa.float32()))
+    tmp = path.with_name(path.name + ".tmp")
+    with pq.ParquetWriter(tmp, schema) as w:
+        for i in range(src.num_row_groups):
+            w.write_table(src.read_row_group(i).replace_schema_metadata().cast(schema))
+    src.close()
+    os.replace(tmp, path)
+
+def stream_clean(paths, out_dir: Path = DATASET_DIR, chunk_size: int = DEFAULT_CHUNK_SIZE, head_rows: int = 15):
+    # percorre i file in ordine di mese e scrive il dataset pulito, partizionato
+    # per mese, a blocchi; la cartella finale viene sostituita solo a fine lavoro
+    import pyarrow.parquet as pq
+
+    cleaner = StreamingCleaner()
+    schema = arrow_schema()
+    head = []
+    n_head = 0
+    tmp = Path(out_dir).with_name(Path(out_dir).name + ".stream.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    writers, lossless = {}, {}
+    try:
+        for path in paths:
+            if not Path(path).exists():
+                raise SystemExit(f"File non trovato: {path}")
+            month = MONTH_LABEL[Path(path).name]
+            if month not in writers:
+                d = partition_dir(month, tmp)
+                d.mkdir(parents=True)
+                writers[month] = pq.ParquetWriter(d / PART_FILE, schema)
+                lossless[month] = set(NUM_COLS)
+            n_file = 0
+            with stage("stream_file", item=Path(path).name) as st:
+                for chunk in iter_chunks(path, chunk_size):
+                    std = standardize_columns(chunk, Path(path).name)
+                    std["mese_rif"] = month
+                    n_file += len(std)
+                    clean = cleaner.process(std, month, Path(path).name)
+                    writers[month].write_table(to_arrow(clean, schema))
+                    lossless[month] &= lossless_cols(clean)
+                    if n_head < head_rows:
+                        head.append(clean.head(head_rows - n_head))
+                        n_head += len(head[-1])
+                st.rows_in = n_file
+                st.rows_out = cleaner.p_after["months"].get(month, {}).get("rows", 0)
+            print(f"File elaborato: {Path(path).name} ({n_file} righe)")
+    finally:
+        for w in writers.values():
+            w.close()
+    for month, cols in lossless.items():
+        if cols:
+            downcast_file(partition_dir(month, tmp) / PART_FILE, sorted(cols))
+    replace_dir(tmp, out_dir)
+    head = pd.concat(head, ignore_index=True) if head else pd.DataFrame(columns=DATASET_COLUMNS)
+    return cleaner, head
@@ -0,0 +1,64 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Utilità per i file di stato JSON condivisi tra processi (cache, registri)
+
+def read_json(path: Path, default=None):
+    path = Path(path)
+    if path.exists():
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (json.JSONDecodeError, OSError):
+            pass
+    return {} if default is None else default
+
+def tmp_path(path: Path) -> Path:
+    # nome temporaneo univoco per processo e per thread (stadi paralleli della pipeline)
+    path = Path(path)
+    return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+def write_json_atomic(path: Path, data) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(path)
+    tmp.write_text(json.dumps(data, indent=1, sort_keys=True, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+@contextmanager
+def file_lock(lock: Path, timeout: float = 30.0, stale_after: float = 60.0):
+    # lock portabile basato su creazione esclusiva del file
+    lock = Path(lock)
+    lock.parent.mkdir(parents=True, exist_ok=True)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - lock.stat().st_mtime > stale_after:   # lock orfano
+                    lock.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError(f"Lock non disponibile: {lock}")
+            time.sleep(0.02)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        lock.unlink(missing_ok=True)
+
+@contextmanager
+def locked_json(path: Path, timeout: float = 30.0):
+    # lettura-modifica-scrittura di un file JSON sotto lock
+    path = Path(path)
+    with file_lock(path.with_suffix(".lock"), timeout):
+        data = read_json(path)
+        yield data
+        write_json_atomic(path, data)
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from etl_profile import stage
+from etl_utils import locked_json, read_json, tmp_path
+
+# Cache colonnare (Parquet) dei workbook Excel.
+# La prima lettura di un .xlsx lo converte in Parquet; le esecuzioni successive
+# (di qualunque script) caricano la copia in cache finché il sorgente non cambia.
+# Chiave: percorso del file + mtime + hash del contenuto.
+
+HERE = Path(__file__).resolve().parent
+CACHE_DIR = Path(os.environ.get("ETL_CACHE_DIR", HERE / ".cache" / "xlsx")).resolve()
+CACHE_MAX_MB = float(os.environ.get("ETL_CACHE_MAX_MB", "512"))
+CACHE_ENABLED = os.environ.get("ETL_CACHE", "1") != "0"
+MANIFEST = CACHE_DIR / "manifest.json"
+
+# Funzioni di supporto
+
+def file_hash(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _load_manifest() -> dict:
+    return read_json(MANIFEST)
+
+def _locked_manifest():
+    # il manifest è condiviso tra processi (loader parallelo): ogni
+    # lettura-modifica-scrittura avviene sotto lock
+    return locked_json(MANIFEST)
+
+def _entry_key(path: Path, sheet_name) -> str:
+    return f"{path}::{sheet_name}"
+
+def _arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    # Parquet vuole nomi di colonna stringa e colonne omogenee:
+    # le colonne "miste" (numeri + testo) vengono salvate come testo, nulli inclusi
+    import pyarrow as pa
+
+    out = df.copy()
+    out.columns = [str(c) for c in out.columns]
+    for c in out.columns:
+        if out[c].dtype == object:
+            try:
+                pa.array(out[c], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                out[c] = out[c].where(out[c].isna(), out[c].astype(str))
+    return out
+
+def _remove_file(manifest: dict, name: str) -> None:
+    # il file Parquet è indirizzato per contenuto: lo si cancella solo
+    # se nessun'altra voce lo usa
+    if any(e["file"] == name for e in manifest.values()):
+        return
+    try:
+        (CACHE_DIR / name).unlink()
+    except FileNotFoundError:
+        pass
+
+def evict(manifest: dict, max_mb: float = CACHE_MAX_MB) -> list:
+    # rimozione LRU finché la cache non rientra nel limite di dimensione
+    removed = []
+    limit = max_mb * 1024 * 1024
+    sizes = {}
+    for e in manifest.values():
+        sizes[e["file"]] = e["bytes"]
+    total = sum(sizes.values())
+    for key, e in sorted(manifest.items(), key=lambda kv: kv[1]["last_access"]):
+        if total <= limit:
+            break
+        del manifest[key]
+        if not any(x["file"] == e["file"] for x in manifest.values()):
+            total -= sizes.pop(e["file"], 0)
+            _remove_file(manifest, e["file"])
+        removed.append(key)
+    return removed
+
+def _lookup(path: Path, sheet_name=0):
+    # (percorso Parquet valido, DataFrame appena letto se c'è stata conversione)
+    path = Path(path).resolve()
+    st = path.stat()
+    key = _entry_key(path, sheet_name)
+
+    with _locked_manifest() as manifest:
+        entry = manifest.get(key)
+        if entry is not None and (CACHE_DIR / entry["file"]).exists():
+            if entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+                entry["last_access"] = time.time()
+                return CACHE_DIR / entry["file"], None
+            # mtime cambiato: si ricalcola l'hash, il contenuto può essere identico
+            digest = file_hash(path)
+            if digest == entry["sha256"]:
+                entry.update(mtime_ns=st.st_mtime_ns, size=st.st_size, last_access=time.time())
+                return CACHE_DIR / entry["file"], None
+        else:
+            digest = file_hash(path)
+
+    # voce assente o obsoleta: conversione xlsx -> Parquet (fuori dal lock)
+    df = pd.read_excel(path, sheet_name=sheet_name)
+    name = f"{digest[:32]}_{sheet_name}.parquet"
+    tmp = tmp_path(CACHE_DIR / name)
+    _arrow_safe(df).to_parquet(tmp, index=False)
+    os.replace(tmp, CACHE_DIR / name)
+
+    with _locked_manifest() as manifest:
+        old = manifest.pop(key, None)
+        if old is not None and old["file"] != name:
+            _remove_file(manifest, old["file"])
+        manifest[key] = {
+            "source": str(path),
+            "sheet": sheet_name,
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha256": digest,
+            "file": name,
+            "bytes": (CACHE_DIR / name).stat().st_size,
+            "rows": int(len(df)),
+            "last_access": time.time(),
+        }
+        evict(manifest)
+        kept = key in manifest
+    return (CACHE_DIR / name if kept else None), df
+
+def cache_lookup(path: Path, sheet_name=0):
+    # percorso Parquet valido per il workbook (convertendolo se serve)
+    return _lookup(path, sheet_name)[0]
+
+def read_excel_cached(path, sheet_name=0, columns=None) -> pd.DataFrame:
+    # sostituto di pd.read_excel(path) per i workbook mensili
+    with stage("read_excel", item=Path(path).name) as st:
+        df = _read_excel(path, sheet_name, columns)
+        st.rows_out = len(df)
+    return df
+
+def _read_excel(path, sheet_name=0, columns=None) -> pd.DataFrame:
+    if not CACHE_ENABLED:
+        df = pd.read_excel(path, sheet_name=sheet_name)
+        return df[columns] if columns is not None else df
+    cached, df = _lookup(path, sheet_name)
+    if cached is None:
+        # il file da solo supera il limite della cache: si usa la lettura appena fatta
+        return df[columns] if columns is not None else df
+    return pd.read_parquet(cached, columns=columns)
+
+def clear_cache() -> None:
+    with _locked_manifest() as manifest:
+        for e in manifest.values():
+            try:
+                (CACHE_DIR / e["file"]).unlink()
+            except FileNotFoundError:
+                pass
+        manifest.clear()
+
+if __name__ == "__main__":
+    import sys
+
+    if "--clear" in sys.argv:
+        clear_cache()
+        print("Cache svuotata:", CACHE_DIR)
+    elif "--evict" in sys.argv:
+        with _locked_manifest() as manifest:
+            removed = evict(manifest)
+        print(f"Voci rimosse: {len(removed)}")
+    else:
+        manifest = _load_manifest()
+        tot = sum({e["file"]: e["bytes"] for e in manifest.values()}.values())
+        print(f"Cache: {CACHE_DIR} ({len(manifest)} voci, {tot / 1024 / 1024:.1f} MB / {CACHE_MAX_MB:.0f} MB)")
+        for e in sorted(manifest.values(), key=lambda e: e["source"]):
+            print(f" - {Path(e['source']).name}: {e['rows']} righe, {e['bytes'] / 1024:.0f} KB")
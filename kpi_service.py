@@ -0,0 +1,217 @@
+import argparse
+import json
+import math
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+from kpi_engine import KpiThresholds, classify_level, classify_rotation, days_inventory, rotation_rate
+from kpi_store import SCHEMA_VERSION, STORE_PATH, KpiStore
+
+# Interrogazione dei KPI per articolo, senza rieseguire make_kpi_report.py.
+# Legge l'archivio di kpi_store (indici su code e mese): classe di scorta, soglie,
+# tasso di rotazione, classe di rotazione, DIO e storico mensile di un articolo,
+# sull'intero storico o sugli ultimi N mesi.
+#
+#   svc = KpiService()
+#   svc.item("AB1234")              # dict JSON-serializzabile (None se sconosciuto)
+#   svc.item("AB1234", window=3)
+#
+# Le risposte sono tenute in una cache LRU in memoria (CACHE_SIZE articoli),
+# svuotata quando l'archivio viene aggiornato da un altro processo.
+# L'archivio si apre in sola lettura, con una sola connessione condivisa dai
+# thread delle richieste: il servizio non crea né modifica file o tabelle.
+# Servizio HTTP locale (solo lettura, JSON):
+#
+#   python kpi_service.py --serve [--host 127.0.0.1] [--port 8765]
+#   GET /item/<code>[?finestra=N]   KPI dell'articolo
+#   GET /status                     mesi nell'archivio e statistiche della cache
+#
+# Da riga di comando: python kpi_service.py <code> [--finestra N]
+
+CACHE_SIZE = 4096
+DEFAULT_PORT = 8765
+
+def normalize(code: str) -> str:
+    # stessa normalizzazione dei codici del dataset (etl_common.normalize_code)
+    return re.sub(r"[^A-Z0-9]", "", str(code).upper())
+
+def _json_value(v):
+    if hasattr(v, "item"):
+        v = v.item()
+    return None if isinstance(v, float) and not math.isfinite(v) else v
+
+class KpiService:
+
+    def __init__(self, store_path: Path = STORE_PATH, th: KpiThresholds = KpiThresholds(),
+                 cache_size: int = CACHE_SIZE):
+        self.store_path = Path(store_path)
+        self.th = th
+        self._lock = threading.Lock()   # connessione e versione condivise tra i thread
+        self._store = None
+        self._version = None
+        self._lookup = lru_cache(maxsize=cache_size)(self._item)
+
+    def _open(self):
+        # una sola connessione in sola lettura (sotto self._lock); None se l'archivio
+        # manca o è di un'altra versione dello schema (lo ricrea il prossimo sync)
+        if self._store is None and self.store_path.exists():
+            store = KpiStore(self.store_path, read_only=True)
+            if store.con.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+                self._store = store
+            else:
+                store.close()
+        return self._store
+
+    def _check_version(self) -> None:
+        # ogni aggiornamento dell'archivio riscrive il file SQLite
+        st = self.store_path.stat() if self.store_path.exists() else None
+        version = (st.st_size, st.st_mtime_ns) if st else None
+        with self._lock:
+            if version != self._version:
+                self._lookup.cache_clear()
+                self._version = version
+                self.close_store()
+
+    def item(self, code: str, window: int = None):
+        if window is not None and window <= 0:
+            raise ValueError(f"finestra non valida: {window} (numero di mesi, almeno 1)")
+        self._check_version()
+        return self._lookup(normalize(code), window)
+
+    def _item(self, code: str, window: int):
+        with self._lock:
+            store = self._open()
+            if store is None:
+                return None
+            demand = store.demand(window, code=code)
+            if demand.empty:
+                return None
+            months = store.item_months(code)
+            if window is not None:
+                months = months[months["mese_rif"].isin(store.window_months(window))]
+        levels = classify_level(demand, self.th)
+        rate = rotation_rate(levels)
+        row = levels.iloc[0]
+        return {
+            "code": code,
+            "finestra": window,
+            "domanda_media": _json_value(row["domanda_media"]),
+            "giacenza_media": _json_value(row["giacenza_media"]),
+            "safety": _json_value(row["safety"]),
+            "target": _json_value(row["target"]),
+            "classe": row["classe"],
+            "tasso_mensile": _json_value(rate[0]),
+            "classe_rot": str(classify_rotation(rate, self.th)[0]),
+            "DIO": _json_value(days_inventory(rate * 12)[0]),
+            "storico": [{k: _json_value(v) for k, v in r.items()} for r in months.to_dict("records")],
+        }
+
+    def status(self) -> dict:
+        self._check_version()
+        info = self._lookup.cache_info()
+        with self._lock:
+            store = self._open()
+            months = store.window_months() if store else []
+        return {"archivio": str(self.store_path), "mesi": months,
+                "cache": {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max": info.maxsize}}
+
+    def close_store(self) -> None:
+        # chiamata con self._lock acquisito (o senza altri thread attivi)
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def clear_cache(self) -> None:
+        self._lookup.cache_clear()
+
+# Servizio HTTP
+
+def make_handler(service: KpiService):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            t0 = time.perf_counter()
+            url = urlparse(self.path)
+            parts = [unquote(p) for p in url.path.strip("/").split("/") if p]
+            query = parse_qs(url.query)
+            try:
+                if parts == ["status"]:
+                    self._send(200, service.status())
+                elif len(parts) == 2 and parts[0] == "item":
+                    window = int(query["finestra"][0]) if "finestra" in query else None
+                    found = service.item(parts[1], window)
+                    if found is None:
+                        self._send(404, {"errore": f"articolo non trovato: {parts[1]}"})
+                    else:
+                        self._send(200, found)
+                else:
+                    self._send(404, {"errore": "percorsi: /item/<code>[?finestra=N], /status"})
+            except ValueError as exc:
+                self._send(400, {"errore": str(exc)})
+            self.log_message('"%s" %.1f ms', self.requestline, (time.perf_counter() - t0) * 1000)
+
+        def _send(self, status: int, body) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_request(self, code="-", size="-"):
+            pass   # una riga per richiesta, con la latenza, da do_GET
+
+    return Handler
+
+def serve(service: KpiService, host: str = "127.0.0.1", port: int = DEFAULT_PORT) -> None:
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Servizio KPI su http://{host}:{server.server_port} (archivio {service.store_path}), Ctrl+C per terminare")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close_store()
+
+def main(argv=None):
+    d = KpiThresholds()
+    parser = argparse.ArgumentParser(description="KPI per articolo dall'archivio di kpi_store (API e servizio HTTP).")
+    parser.add_argument("code", nargs="?", help="articolo da interrogare (senza --serve)")
+    parser.add_argument("--finestra", type=int, help="solo gli ultimi N mesi")
+    parser.add_argument("--serve", action="store_true", help="avvia il servizio HTTP locale")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--sync", action="store_true",
+                        help="aggiorna prima l'archivio dai mesi cambiati del dataset")
+    parser.add_argument("--safety", type=float, default=d.safety)
+    parser.add_argument("--target", type=float, default=d.target)
+    parser.add_argument("--rot-bassa", type=float, default=d.rot_low)
+    parser.add_argument("--rot-alta", type=float, default=d.rot_high)
+    args = parser.parse_args(argv)
+    if args.finestra is not None and args.finestra <= 0:
+        parser.error("--finestra: numero di mesi, almeno 1")
+
+    if args.sync:
+        with KpiStore() as store:
+            changed = store.sync()
+        print(f"Archivio KPI: {len(changed)} mesi aggiornati ({', '.join(changed) or 'nessuno'})")
+    service = KpiService(th=KpiThresholds(args.safety, args.target, args.rot_bassa, args.rot_alta))
+    if args.serve:
+        serve(service, args.host, args.port)
+    elif args.code:
+        found = service.item(args.code, args.finestra)
+        if found is None:
+            raise SystemExit(f"Articolo non trovato: {args.code}")
+        print(json.dumps(found, ensure_ascii=False, indent=1))
+    else:
+        print(json.dumps(service.status(), ensure_ascii=False, indent=1))
+
+if __name__ == "__main__":
+    main()
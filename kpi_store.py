@@ -0,0 +1,301 @@
+import sqlite3
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from etl_common import CALENDAR, HERE, month_number
+from etl_dataset import DATASET_DIR, PART_FILE, Query, available_months, load_dataset, partition_dir, scan
+from etl_profile import stage
+from excel_cache import file_hash
+from kpi_engine import (LEVEL_CLASSES, ROTATION_CLASSES, KpiThresholds, annualized_turnover, classify_level,
+                        classify_rotation, distribution, kpis_from_aggregates, prepare, rotation_rate,
+                        turnover_from_totals)
+
+# Archivio persistente (SQLite) degli aggregati KPI per articolo e per mese.
+#
+#   item_month   (code, mese): somma di consumo e di stock_avg e righe del mese
+#   item_totals  (code): somme progressive su tutti i mesi
+#   months       (mese): totali del mese e impronta della partizione da cui derivano
+#
+# A ogni esecuzione sync() rilegge solo le partizioni del dataset nuove o con
+# contenuto cambiato (hash del file), sommando per articolo durante la lettura (scan_aggregates): per un
+# mese nuovo le somme progressive degli articoli vengono incrementate, per un
+# mese riscritto o rimosso vengono ricalcolate dalle righe item_month degli
+# articoli coinvolti. Domanda e giacenza media, soglie e classi
+# si ricavano dagli aggregati (una riga per articolo) senza rileggere le righe
+# del dataset, sia sull'intero storico sia sugli ultimi N mesi (finestre mobili).
+
+STORE_PATH = HERE / ".cache" / "kpi_store.sqlite"
+KPI_COLUMNS = ["code", "stock", "real", "outgoing", "mese_rif"]
+WINDOWS = (3, 6, 12)
+SCHEMA_VERSION = 2   # 2: mese_n = numero del mese di calendario
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS item_month (
+    mese_n INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    consumo_sum REAL NOT NULL,
+    stock_sum REAL NOT NULL,
+    n INTEGER NOT NULL,
+    PRIMARY KEY (mese_n, code)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS item_month_code ON item_month (code, mese_n);
+CREATE TABLE IF NOT EXISTS item_totals (
+    code TEXT PRIMARY KEY,
+    consumo_sum REAL NOT NULL,
+    stock_sum REAL NOT NULL,
+    n INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS months (
+    mese_rif TEXT PRIMARY KEY,
+    mese_n INTEGER NOT NULL,
+    consumo_tot REAL NOT NULL,
+    stock_sum REAL NOT NULL,
+    n INTEGER NOT NULL,
+    source TEXT,
+    updated TEXT
+);
+"""
+
+def _source_id(path: Path, stored: str = None) -> str:
+    # impronta della partizione: dimensione, mtime e hash del contenuto. L'hash si
+    # ricalcola solo se dimensione o mtime sono cambiati
+    st = Path(path).stat()
+    stat_id = f"{st.st_size}:{st.st_mtime_ns}"
+    if stored and stored.rsplit(":", 1)[0] == stat_id:
+        return stored
+    return f"{stat_id}:{file_hash(path)}"
+
+def _content_id(source: str):
+    return source.rsplit(":", 1)[-1] if source else None
+
+def month_aggregates(df: pd.DataFrame) -> pd.DataFrame:
+    # righe di un mese -> una riga per articolo (code, consumo_sum, stock_sum, n)
+    return (df.groupby("code", observed=True)
+              .agg(consumo_sum=("consumo", "sum"), stock_sum=("stock_avg", "sum"), n=("consumo", "size"))
+              .reset_index())
+
+def scan_aggregates(q: Query) -> pd.DataFrame:
+    # month_aggregates calcolato durante la lettura (Query.aggregate): si leggono solo
+    # code e quantità, nessuna riga passa da pandas. Include il gruppo dei code
+    # mancanti, che conta solo nei totali del mese
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    def qty(c):
+        return pc.coalesce(pc.field(c).cast(pa.float64()), pa.scalar(0.0))
+
+    return (q.derive(consumo=qty("outgoing"), stock_avg=(qty("stock") + qty("real")) / 2.0)
+             .aggregate("code", consumo_sum=("consumo", "sum"), stock_sum=("stock_avg", "sum"),
+                        n=("consumo", "size")))
+
+def demand_from_sums(agg: pd.DataFrame) -> pd.DataFrame:
+    # somme per articolo (code, consumo_sum, stock_sum, n) -> domanda e giacenza media
+    n = agg["n"].to_numpy(dtype=float)
+    return pd.DataFrame({"code": agg["code"],
+                         "domanda_media": agg["consumo_sum"].to_numpy(dtype=float) / n,
+                         "giacenza_media": agg["stock_sum"].to_numpy(dtype=float) / n})
+
+def turnover_from_months(m: pd.DataFrame) -> tuple:
+    # totali per mese (mese_rif, mese_n, consumo_tot, stock_sum, n) ->
+    # (turnover per mese, turnover annualizzato del periodo)
+    turn = turnover_from_totals(pd.DataFrame({
+        "mese_rif": m["mese_rif"], "consumo_tot": m["consumo_tot"],
+        "stock_med": m["stock_sum"] / m["n"], "mese_n": m["mese_n"]}).reset_index(drop=True))
+    rows = m["n"].sum()
+    period = annualized_turnover(m["consumo_tot"].sum(), m["stock_sum"].sum() / rows if rows else 0.0, len(m))
+    return turn, period
+
+def rollup_kpis(months: list, totals: list, th: KpiThresholds = KpiThresholds()) -> dict:
+    # KPI di più archivi insieme (magazzini, anni): totali per mese e somme per
+    # articolo vengono sommati, poi si procede come per un archivio solo.
+    # I mesi di anni diversi devono avere etichette e mese_n distinti.
+    m = (pd.concat(months, ignore_index=True)
+           .groupby(["mese_n", "mese_rif"], as_index=False)[["consumo_tot", "stock_sum", "n"]].sum())
+    t = (pd.concat(totals, ignore_index=True)
+           .groupby("code", as_index=False)[["consumo_sum", "stock_sum", "n"]].sum())
+    turn, period = turnover_from_months(m)
+    return kpis_from_aggregates(turn, demand_from_sums(t), period, th)
+
+class KpiStore:
+
+    def __init__(self, path: Path = STORE_PATH, read_only: bool = False):
+        self.path = Path(path)
+        if read_only:
+            # sola lettura (kpi_service): nessun file, cartella o tabella creata o rimossa;
+            # connessione usabile da più thread, serializzati dal chiamante
+            self.con = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True, timeout=30,
+                                       check_same_thread=False)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(self.path, timeout=30)
+        if self.con.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # archivio di una versione precedente: ricostruito dal prossimo sync()
+            self.con.executescript("DROP TABLE IF EXISTS item_month; DROP TABLE IF EXISTS item_totals;"
+                                   " DROP TABLE IF EXISTS months;")
+            self.con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.con.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.con.close()
+
+    # Aggiornamento
+
+    def months(self) -> pd.DataFrame:
+        return pd.read_sql_query("SELECT * FROM months ORDER BY mese_n", self.con)
+
+    def update_month(self, month: str, df: pd.DataFrame, source: str = None) -> int:
+        # sostituisce gli aggregati di un mese; df: righe del mese (code, stock, real, outgoing)
+        data = prepare(df, [month])
+        totals = (float(data["consumo"].sum()), float(data["stock_avg"].sum()), len(data))
+        return self._replace_month(month, month_aggregates(data), totals, source)
+
+    def update_month_scan(self, month: str, q: Query, source: str = None) -> int:
+        # come update_month, con le somme calcolate durante la lettura della partizione
+        agg = scan_aggregates(q)
+        totals = (float(agg["consumo_sum"].sum()), float(agg["stock_sum"].sum()), int(agg["n"].sum()))
+        return self._replace_month(month, agg[agg["code"].notna()], totals, source)
+
+    def _replace_month(self, month: str, agg: pd.DataFrame, totals: tuple, source: str) -> int:
+        # totals: consumo e stock_avg sommati su tutte le righe del mese, numero di righe
+        mese_n = month_number(month)
+        rows = list(zip(agg["code"].astype(str), agg["consumo_sum"].astype(float),
+                        agg["stock_sum"].astype(float), agg["n"].astype(int)))
+        with self.con:
+            replaced = self._drop(month)
+            self.con.executemany(
+                "INSERT INTO item_month VALUES (?, ?, ?, ?, ?)", [(mese_n, *r) for r in rows])
+            if replaced:
+                # anche gli articoli presenti solo nella nuova versione del mese
+                self.con.executemany("INSERT OR IGNORE INTO _touched VALUES (?)", [(r[0],) for r in rows])
+                self._recompute_totals()
+            else:
+                # mese nuovo: somme progressive incrementate
+                self.con.executemany(
+                    "INSERT INTO item_totals VALUES (?, ?, ?, ?) ON CONFLICT(code) DO UPDATE SET"
+                    " consumo_sum = consumo_sum + excluded.consumo_sum,"
+                    " stock_sum = stock_sum + excluded.stock_sum, n = n + excluded.n", rows)
+            self.con.execute(
+                "INSERT INTO months VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (month, mese_n, *totals, source, time.strftime("%Y-%m-%d %H:%M:%S")))
+        return totals[2]
+
+    def drop_month(self, month: str) -> None:
+        with self.con:
+            if self._drop(month):
+                self._recompute_totals()
+
+    def _drop(self, month: str) -> bool:
+        # rimuove le righe del mese; gli articoli coinvolti vanno in _touched
+        row = self.con.execute("SELECT mese_n FROM months WHERE mese_rif = ?", (month,)).fetchone()
+        if row is None:
+            return False
+        self.con.execute("CREATE TEMP TABLE IF NOT EXISTS _touched (code TEXT PRIMARY KEY)")
+        self.con.execute("INSERT OR IGNORE INTO _touched SELECT code FROM item_month WHERE mese_n = ?", row)
+        self.con.execute("DELETE FROM item_month WHERE mese_n = ?", row)
+        self.con.execute("DELETE FROM months WHERE mese_rif = ?", (month,))
+        return True
+
+    def _recompute_totals(self) -> None:
+        # somme degli articoli di un mese riscritto o rimosso, ricalcolate dai mesi
+        # (nessuna deriva da sottrazioni in virgola mobile)
+        self.con.execute("DELETE FROM item_totals WHERE code IN (SELECT code FROM _touched)")
+        self.con.execute(
+            "INSERT INTO item_totals SELECT code, SUM(consumo_sum), SUM(stock_sum), SUM(n) FROM item_month"
+            " WHERE code IN (SELECT code FROM _touched) GROUP BY code")
+        self.con.execute("DELETE FROM _touched")
+
+    def sync(self, root: Path = DATASET_DIR) -> list:
+        # allinea l'archivio al dataset su disco: mesi, impronte e aggregati vengono
+        # dalle stesse partizioni. Un mese è cambiato se ne cambia il contenuto: una
+        # partizione riscritta identica (cleaning completo) aggiorna solo l'impronta
+        stored = dict(self.con.execute("SELECT mese_rif, source FROM months").fetchall())
+        parts = {m: _source_id(partition_dir(m, root) / PART_FILE, stored.get(m))
+                 for m in available_months(root) if m in CALENDAR}
+        df = None
+        if not parts and Path(root) == DATASET_DIR:
+            # dataset solo in .xlsx (versioni precedenti): nessuna impronta, mesi sempre ricalcolati
+            df = load_dataset(columns=KPI_COLUMNS, months=CALENDAR)
+            parts = {m: None for m in CALENDAR if (df["mese_rif"] == m).any()}
+
+        changed = [m for m, src in parts.items() if src is None or _content_id(stored.get(m)) != _content_id(src)]
+        with self.con:
+            self.con.executemany("UPDATE months SET source = ? WHERE mese_rif = ?",
+                                 [(src, m) for m, src in parts.items()
+                                  if m in stored and m not in changed and stored[m] != src])
+        for m in [m for m in stored if m not in parts]:
+            self.drop_month(m)
+        for m in changed:
+            with stage("kpi_store", item=m) as st:
+                if df is not None:
+                    st.rows_in = self.update_month(m, df[df["mese_rif"] == m], parts[m])
+                else:
+                    st.rows_in = self.update_month_scan(m, scan(root).months([m]), parts[m])
+        return changed
+
+    # Lettura
+
+    def window_months(self, window: int = None) -> list:
+        # mesi dell'intero storico o degli ultimi `window` mesi presenti
+        months = [m for m, in self.con.execute("SELECT mese_rif FROM months ORDER BY mese_n")]
+        return months if window is None else months[-window:]
+
+    def demand(self, window: int = None, code: str = None) -> pd.DataFrame:
+        # domanda e giacenza media per articolo (come kpi_engine.demand_by_item);
+        # con code un solo articolo (ricerca sull'indice)
+        where, params = ("", []) if code is None else (" WHERE i.code = ?", [code])
+        if window is None:
+            sql = f"SELECT i.code, i.consumo_sum, i.stock_sum, i.n FROM item_totals i{where} ORDER BY i.code"
+        else:
+            months = self.window_months(window)
+            where = f"{where or ' WHERE 1'} AND m.mese_rif IN ({', '.join('?' * len(months))})"
+            params += months
+            sql = ("SELECT i.code, SUM(i.consumo_sum) AS consumo_sum, SUM(i.stock_sum) AS stock_sum, SUM(i.n) AS n"
+                   f" FROM item_month i JOIN months m ON m.mese_n = i.mese_n{where} GROUP BY i.code ORDER BY i.code")
+        return demand_from_sums(pd.read_sql_query(sql, self.con, params=params))
+
+    def item_totals(self) -> pd.DataFrame:
+        return pd.read_sql_query("SELECT code, consumo_sum, stock_sum, n FROM item_totals", self.con)
+
+    def item_months(self, code: str) -> pd.DataFrame:
+        # storico mensile di un articolo: consumo, giacenza media e righe per mese
+        return pd.read_sql_query(
+            "SELECT m.mese_rif, i.consumo_sum AS consumo, i.stock_sum / i.n AS giacenza_media, i.n AS righe"
+            " FROM item_month i JOIN months m ON m.mese_n = i.mese_n WHERE i.code = ? ORDER BY i.mese_n",
+            self.con, params=[code])
+
+    def turnover(self, window: int = None) -> tuple:
+        # (turnover per mese, turnover annualizzato del periodo)
+        m = self.months()
+        return turnover_from_months(m if window is None else m.tail(window))
+
+    def kpis(self, th: KpiThresholds = KpiThresholds()) -> dict:
+        # stesso risultato di kpi_engine.compute_kpis sull'intero storico
+        turn, period = self.turnover()
+        return kpis_from_aggregates(turn, self.demand(), period, th)
+
+    def window_summary(self, th: KpiThresholds = KpiThresholds(), windows=WINDOWS) -> pd.DataFrame:
+        # una riga per finestra: mesi coperti, rotazione annualizzata e articoli per classe
+        rows = []
+        for w in windows:
+            months = self.window_months(w)
+            levels = classify_level(self.demand(w), th)
+            rot = classify_rotation(rotation_rate(levels), th)
+            row = {"finestra": f"ultimi {w} mesi",
+                   "mesi": f"{months[0]}–{months[-1]}" if months else "",
+                   "n_mesi": len(months),
+                   "turnover_annuo": self.turnover(w)[1],
+                   "articoli": len(levels)}
+            for name, classes, order in (("livello", levels["classe"], LEVEL_CLASSES),
+                                         ("rotazione", rot, ROTATION_CLASSES)):
+                dist = distribution(pd.Series(classes, dtype=object), "classe", order)
+                row.update({f"{name} {c}": int(k) for c, k in zip(dist["classe"], dist["conteggio"])})
+            rows.append(row)
+        return pd.DataFrame(rows)
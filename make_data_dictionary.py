@@ -1,13 +1,21 @@
+import argparse
 from pathlib import Path
 import pandas as pd
 import numpy as np
 
+from column_profile import EXAMPLES, HLL_ERROR, TOPK_COUNTERS, frame_batches, profile_batches
+from etl_common import DATASET_COLUMNS, MONTH_ORDER
+from etl_dataset import DATASET_DIR, available_months, load_dataset, scan
+from etl_html import HtmlReport
+from etl_profile import add_profile_args, session, stage
+
 
 HERE = Path(__file__).resolve().parent
-DATASET_PATH = HERE / "dataset_finale_ETL_QA.xlsx"
 OUT_XLSX = HERE / "ETL_QA" / "Data_Dictionary.xlsx"
 OUT_HTML = HERE / "ETL_QA" / "Data_Dictionary.html"
 OUT_MD = HERE / "ETL_QA" / "Data_Dictionary.md"
+BATCH_SIZE = 1_000_000
+TOP_COLS = ("uom", "mese_rif")
 
 DESCR = {
     "code": "Codice materiale univoco (alfanumerico).",
@@ -47,54 +55,79 @@ def dtype_human(series):
         return "datetime"
     return "string"
 
-def summarize_column(df, col):
-    s = df[col]
+def summarize_column(p) -> dict:
+    # p: profilo della colonna (column_profile.ColumnProfile), esatto o approssimato
+    col = p.name
+    s = pd.Series([], dtype=p.dtype)
     d = {
         "Colonna": col,
         "Descrizione": DESCR.get(col, ""),
         "Tipo": dtype_human(s),
         "Unità": UNITS.get(col, ""),
-        "Cardinalità": int(s.nunique(dropna=True)),
-        "Null (n)": int(s.isna().sum()),
-        "Null (%)": round(100 * s.isna().mean(), 2),
-        "Esempi": ", ".join(map(lambda x: str(x)[:25], s.dropna().astype(str).unique()[:5])),
+        "Cardinalità": p.cardinality(),
+        "Null (n)": p.nulls,
+        "Null (%)": round(100 * p.nulls / p.rows, 2) if p.rows else np.nan,
+        "Esempi": ", ".join(map(lambda x: str(x)[:25], p.example_strings()[:EXAMPLES])),
         "Regole/Controlli": RULES.get(col, ""),
         "Note": ""
     }
 
     if pd.api.types.is_numeric_dtype(s):
-        s_num = pd.to_numeric(s, errors="coerce")
-        d["Min"] = float(np.nanmin(s_num)) if s_num.notna().any() else ""
-        d["Max"] = float(np.nanmax(s_num)) if s_num.notna().any() else ""
+        d["Min"] = p.min if p.min is not None else ""
+        d["Max"] = p.max if p.max is not None else ""
     else:
         d["Min"], d["Max"] = "", ""
 
-    if col == "uom":
-        vals = s.dropna().astype(str).str.upper().value_counts().head(10)
-        d["Valori ammessi (top10)"] = ", ".join(vals.index.tolist())
-    elif col == "mese_rif":
-        vals = s.dropna().astype(str).str.upper().value_counts()
-        order = ["GENNAIO", "FEBBRAIO", "APRILE", "MAGGIO", "GIUGNO", "LUGLIO", "AGOSTO"]
-        d["Valori ammessi (ordine)"] = ", ".join([m for m in order if m in vals.index])
-
+    if col in TOP_COLS:
+        vals = p.value_counts()
+        vals = vals.groupby(vals.index.astype(str).str.upper(), sort=False).sum().sort_values(ascending=False, kind="stable")
+        if col == "uom":
+            d["Valori ammessi (top10)"] = ", ".join(vals.head(10).index.tolist())
+        else:
+            d["Valori ammessi (ordine)"] = ", ".join([m for m in MONTH_ORDER if m in vals.index])
+
+    if p.approx:
+        notes = [f"Cardinalità stimata (HyperLogLog, errore standard {100 * HLL_ERROR:.1f}%)",
+                 "esempi campionati tra i valori distinti"]
+        if col in TOP_COLS and p.top_error:
+            notes.append(f"frequenze sottostimate al più di {p.top_error} (Misra-Gries, {TOPK_COUNTERS} contatori)")
+        d["Note"] = "; ".join(notes)
     return d
 
-def main():
-    if not DATASET_PATH.exists():
-        raise SystemExit(f"Dataset non trovato: {DATASET_PATH}")
-
-    df = pd.read_excel(DATASET_PATH)
-    ordered = [c for c in ["code", "description", "uom", "stock", "real", "outgoing", "mese_rif"] if c in df.columns]
-    for c in df.columns:
-        if c not in ordered:
-            ordered.append(c)
-    df = df[ordered]
-
-    rows = [summarize_column(df, c) for c in df.columns]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Data Dictionary del dataset consolidato.")
+    parser.add_argument("--approx", action="store_true",
+                        help="profilo approssimato a memoria costante (cardinalità HyperLogLog, "
+                             "esempi campionati, valori più frequenti Misra-Gries)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"righe lette per blocco (default {BATCH_SIZE})")
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+    with session(args, "make_data_dictionary"):
+        run(approx=args.approx, batch_size=args.batch_size)
+
+def run(df: pd.DataFrame = None, approx: bool = False, batch_size: int = BATCH_SIZE):
+    # df: dataset consolidato già in memoria (runner della pipeline); altrimenti il
+    # dataset si legge a blocchi, senza caricarlo per intero
+    if df is not None:
+        batches = frame_batches(df, batch_size)
+    elif available_months():
+        batches = scan().iter_batches(batch_size)
+    else:
+        with stage("load_dataset") as st:
+            df = load_dataset()
+            st.rows_out = len(df)
+        batches = frame_batches(df, batch_size)
+
+    with stage("summarize_columns", item="approx" if approx else "exact") as st:
+        profiles = profile_batches(batches, approx, TOP_COLS)
+        st.rows_in = next(iter(profiles.values())).rows if profiles else 0
+    ordered = [c for c in DATASET_COLUMNS if c in profiles]
+    ordered += [c for c in profiles if c not in ordered]
+    rows = [summarize_column(profiles[c]) for c in ordered]
     dd = pd.DataFrame(rows)
     dd.to_excel(OUT_XLSX, index=False)
 
-    
     style = """
     <style>
     body{font-family:Arial,Helvetica,sans-serif;margin:24px}
@@ -102,14 +135,17 @@ def main():
     td,th{border:1px solid #ddd;padding:6px} th{background:#eee}
     </style>
     """
-    html = f"""<!doctype html><html><head><meta charset="utf-8"><title>Data Dictionary</title>{style}</head>
+    mode_note = (f" – profilo approssimato: cardinalità con errore standard {100 * HLL_ERROR:.1f}%"
+                 if approx else "")
+    with stage("render_html", item=OUT_HTML.name), HtmlReport(OUT_HTML) as rep:
+        rep.write(f"""<!doctype html><html><head><meta charset="utf-8"><title>Data Dictionary</title>{style}</head>
     <body>
     <h1>Data Dictionary</h1>
-    {dd.to_html(index=False)}
-    <hr>
-    <p>Fonte: ETL_QA/dataset_finale_ETL_QA.xlsx</p>
-    </body></html>"""
-    OUT_HTML.write_text(html, encoding="utf-8")
+    """)
+        rep.table(dd)
+        rep.write(f"""    <hr>
+    <p>Fonte: {DATASET_DIR.name}/ (Parquet, partizionato per mese){mode_note}</p>
+    </body></html>""")
 
     md_lines = ["# Data Dictionary"]
     for _, r in dd.iterrows():
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+import argparse
 from pathlib import Path
 import pandas as pd
-import matplotlib.pyplot as plt
+
+from etl_charts import Chart, file_bars, render_charts
+from etl_dataset import Query, scan
+from etl_loader import DEFAULT_WORKERS, add_workers_arg, map_files
+from etl_profile import add_profile_args, session, stage
+from excel_cache import CACHE_ENABLED, cache_lookup, read_excel_cached
+import qa_profile as qa
 
 HERE = Path(__file__).resolve().parent
 RAW_DIR = (HERE / "dati_originali").resolve()   # può anche essere vuota
@@ -10,87 +17,91 @@ OUT_DIR = (HERE / "ETL_QA").resolve()
 OUT_DIR.mkdir(exist_ok=True)
 
 def summarize(df: pd.DataFrame, name: str) -> dict:
-    num_neg = 0
-    num_dup = int(df.duplicated().sum())
-    if not df.select_dtypes(include="number").empty:
-        num_neg = int((df.select_dtypes(include="number") < 0).sum().sum())
+    # profilo a passaggio unico: nulli su tutte le colonne, negativi sulle colonne
+    # numeriche, duplicati sull'intera riga
+    p = qa.profile(df, qty_cols=None, key=None, full_rows=True, name=name)
+    return qa.file_summary(p, name)
+
+def scan_stats(q: Query, name: str) -> dict:
+    # stessi conteggi di summarize senza caricare il file in pandas: righe dai
+    # metadati Parquet, nulli dalle statistiche dei row group, negativi con un
+    # filtro per colonna numerica (row group saltati se il minimo è >= 0),
+    # duplicati come righe meno combinazioni distinte (group by in Arrow)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    schema = q.schema()
+    numeric = [f.name for f in schema if pa.types.is_integer(f.type) or pa.types.is_floating(f.type)]
+    rows = q.count()
+    distinct = len(q.aggregate(schema.names)) if rows else 0
     return {
         "file": name,
-        "righe": int(len(df)),
-        "valori_nulli": int(df.isna().sum().sum()),
-        "duplicati": num_dup,
-        "negativi": num_neg,
+        "righe": rows,
+        "valori_nulli": sum(q.null_counts().values()),
+        "duplicati": rows - distinct,
+        "negativi": sum(q.where(pc.field(c) < 0).count() for c in numeric),
     }
 
-def load_stats(folder: Path):
-    stats = []
-    for f in sorted(folder.glob("*.xlsx")):
-        df = pd.read_excel(f)
-        stats.append(summarize(df, f.stem))
-    return pd.DataFrame(stats)
+def file_stats(path: Path) -> dict:
+    # i conteggi si calcolano sulla copia in cache del workbook (excel_cache)
+    cached = cache_lookup(path) if CACHE_ENABLED else None
+    if cached is None:
+        return summarize(read_excel_cached(path), path.stem)
+    with stage("scan_stats", item=path.name) as st:
+        q = scan(cached)
+        out = scan_stats(q, path.stem)
+        st.rows_in = out["righe"]
+    return out
 
-raw_df = load_stats(RAW_DIR) if RAW_DIR.exists() else pd.DataFrame()
-clean_df = load_stats(CLEAN_DIR)
+def load_stats(folder: Path, workers: int = DEFAULT_WORKERS):
+    files = sorted(folder.glob("*.xlsx"))
+    return pd.DataFrame(list(map_files(file_stats, files, workers)))
 
-# Se non ci sono i grezzi, crea un confronto “vuoto → pulito”
-if raw_df.empty:
-    raw_df = clean_df.copy()
-    raw_df[["righe","valori_nulli","duplicati","negativi"]] = 0
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grafici QA prima/dopo la pulizia.")
+    add_workers_arg(parser)
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+    with session(args, "make_graphs_report"):
+        run(args.workers)
 
-# allinea per nome file (outer nel caso i set non coincidano)
-compare = pd.merge(raw_df, clean_df, on="file", how="outer",
-                   suffixes=("_raw", "_clean")).fillna(0)
+def run(workers: int = DEFAULT_WORKERS):
+    raw_df = load_stats(RAW_DIR, workers) if RAW_DIR.exists() else pd.DataFrame()
+    clean_df = load_stats(CLEAN_DIR, workers)
 
-# Grafico 1: righe 
-plt.figure(figsize=(10,6))
-x = range(len(compare))
-plt.bar(x, compare["righe_raw"], label="Prima")
-plt.bar(x, compare["righe_clean"], bottom=None, alpha=0.6, label="Dopo")
-plt.title("Righe prima/dopo pulizia")
-plt.xlabel("File")
-plt.ylabel("Numero di righe")
-plt.xticks(x, compare["file"], rotation=45, ha="right")
-plt.legend()
-plt.tight_layout()
-plt.savefig(OUT_DIR / "confronto_righe.png")
-plt.close()
+    # Se non ci sono i grezzi, crea un confronto “vuoto → pulito”
+    if raw_df.empty:
+        raw_df = clean_df.copy()
+        raw_df[["righe","valori_nulli","duplicati","negativi"]] = 0
 
-# Grafico 2: valori nulli 
-plt.figure(figsize=(10,6))
-x = range(len(compare))
-plt.bar(x, compare["valori_nulli_raw"], label="Nulli prima")
-plt.bar(x, compare["valori_nulli_clean"], alpha=0.6, label="Nulli dopo")
-plt.title("Valori nulli prima e dopo")
-plt.xlabel("File")
-plt.ylabel("Conteggio")
-plt.xticks(x, compare["file"], rotation=45, ha="right")
-plt.legend()
-plt.tight_layout()
-plt.savefig(OUT_DIR / "confronto_nulli.png")
-plt.close()
+    # allinea per nome file (outer nel caso i set non coincidano)
+    compare = pd.merge(raw_df, clean_df, on="file", how="outer",
+                       suffixes=("_raw", "_clean")).fillna(0)
 
-#  Grafico 3: duplicati e negativi 
-plt.figure(figsize=(10,6))
-width = 0.2
-x = range(len(compare))
-x1 = [i - 1.5*width for i in x]
-x2 = [i - 0.5*width for i in x]
-x3 = [i + 0.5*width for i in x]
-x4 = [i + 1.5*width for i in x]
-plt.bar(x1, compare["duplicati_raw"], width=width, label="Duplicati prima")
-plt.bar(x2, compare["duplicati_clean"], width=width, label="Duplicati dopo")
-plt.bar(x3, compare["negativi_raw"], width=width, label="Negativi prima")
-plt.bar(x4, compare["negativi_clean"], width=width, label="Negativi dopo")
-plt.title("Duplicati e valori negativi (pre/post)")
-plt.xlabel("File")
-plt.ylabel("Conteggio")
-plt.xticks(x, compare["file"], rotation=45, ha="right")
-plt.legend()
-plt.tight_layout()
-plt.savefig(OUT_DIR / "confronto_duplicati_negativi.png")
-plt.close()
+    render_charts([
+        # Grafico 1: righe
+        Chart("confronto_righe.png", file_bars, compare,
+              "Righe prima/dopo pulizia", "File", "Numero di righe",
+              opts={"labels": "file", "series": [("righe_raw", "Prima", {}),
+                                                 ("righe_clean", "Dopo", {"alpha": 0.6})]}),
+        # Grafico 2: valori nulli
+        Chart("confronto_nulli.png", file_bars, compare,
+              "Valori nulli prima e dopo", "File", "Conteggio",
+              opts={"labels": "file", "series": [("valori_nulli_raw", "Nulli prima", {}),
+                                                 ("valori_nulli_clean", "Nulli dopo", {"alpha": 0.6})]}),
+        # Grafico 3: duplicati e negativi
+        Chart("confronto_duplicati_negativi.png", file_bars, compare,
+              "Duplicati e valori negativi (pre/post)", "File", "Conteggio",
+              opts={"labels": "file", "width": 0.2,
+                    "series": [("duplicati_raw", "Duplicati prima", {}),
+                               ("duplicati_clean", "Duplicati dopo", {}),
+                               ("negativi_raw", "Negativi prima", {}),
+                               ("negativi_clean", "Negativi dopo", {})]}),
+    ], OUT_DIR, workers)
 
-# salva anche una tabella di confronto
-compare.to_excel(OUT_DIR / "confronto_pre_post.xlsx", index=False)
-print("Grafici e confronto salvati in:", OUT_DIR)
+    # salva anche una tabella di confronto
+    compare.to_excel(OUT_DIR / "confronto_pre_post.xlsx", index=False)
+    print("Grafici e confronto salvati in:", OUT_DIR)
 
+if __name__ == "__main__":
+    main()
@@ -1,155 +1,251 @@
+import argparse
 import os
+from functools import partial
 from pathlib import Path
-from datetime import datetime
 
-import numpy as np
 import pandas as pd
 
-# Cartelle e file di input (ordine cronologico GEN - AGO)
-
-HERE = Path(__file__).resolve().parent
-INPUT_DIR = (HERE / "dati_puliti").resolve()
-
-INPUT_FILES = [
-    INPUT_DIR / "cleaned_dataG.xlsx",          # GENNAIO
-    INPUT_DIR / "cleaned_dataF.xlsx",          # FEBBRAIO
-    INPUT_DIR / "Copia di cleaned_dataA.xlsx", # APRILE
-    INPUT_DIR / "cleaned_dataM.xlsx",          # MAGGIO
-    INPUT_DIR / "cleaned_dataGIU.xlsx",        # GIUGNO
-    INPUT_DIR / "cleaned_dataL.xlsx",          # LUGLIO
-    INPUT_DIR / "cleaned_dataAGO.xlsx",        # AGOSTO
-]
+from etl_common import (
+    HERE, INPUT_FILES, MONTH_LABEL,
+    normalize_code, normalize_uom, clamp_non_negative,
+    apply_typed_schema, CATEGORY_COLS, DATASET_COLUMNS,
+)
+from etl_loader import (
+    DEFAULT_WORKERS, add_workers_arg, load_months, map_files, month_key, read_standardized,
+)
+from etl_dataset import (
+    DATASET_DIR, DATASET_XLSX, drop_partition, export_xlsx, scan, write_dataset, write_partition,
+)
+from etl_dedup import KEY, add_dedup_arg, dedup
+from etl_html import HtmlReport
+from etl_profile import add_profile_args, session, stage
+from etl_stream import DEFAULT_CHUNK_SIZE, stream_clean
+from etl_utils import read_json, tmp_path, write_json_atomic
+from excel_cache import file_hash
+import qa_profile as qa
+from qa_reconcile import TOP_ROWS, dataset_months, reconcile, split_months
 
-OUT_DATASET    = "dataset_finale_ETL_QA.xlsx"
 OUT_QA_SUMMARY = "QA_summary.csv"
 OUT_HTML       = "data_quality_report.html"
-
-MONTH_LABEL = {
-    "cleaned_dataG.xlsx": "GENNAIO",
-    "cleaned_dataF.xlsx": "FEBBRAIO",
-    "Copia di cleaned_dataA.xlsx": "APRILE",
-    "cleaned_dataM.xlsx": "MAGGIO",
-    "cleaned_dataGIU.xlsx": "GIUGNO",
-    "cleaned_dataL.xlsx": "LUGLIO",
-    "cleaned_dataAGO.xlsx": "AGOSTO",
-}
-MONTH_ORDER = ["GENNAIO","FEBBRAIO","APRILE","MAGGIO","GIUGNO","LUGLIO","AGOSTO"]
+OUT_DUPS       = "QA_duplicati.csv"
+OUT_RECON      = "QA_riconciliazione.csv"
 
 # Funzioni di supporto
 
-def standardize_columns(df: pd.DataFrame) -> pd.DataFrame:
-    lower = {c.lower().strip(): c for c in df.columns}
-
-    def pick(*cands):
-        for c in cands:
-            if c in lower:
-                return lower[c]
-        for key, orig in lower.items():
-            if any(c in key for c in cands):
-                return orig
-        return None
-
-    mapping = {
-        "code":        pick("code", "codice", "item_code"),
-        "description": pick("description", "descrizione"),
-        "uom":         pick("um", "uom", "unit_of_measure", "unit measure", "unit_measure"),
-        "stock":       pick("giacenza", "stock_quantity", "stock_level", "total_quantity", "total_stock"),
-        "real":        pick("reale", "real", "real_stock", "actual_quantity"),
-        "outgoing":    pick("scaricare", "to_download", "withdrawal_quantity", "ship_outgoing", "stock_scarico"),
-    }
-
-    out = pd.DataFrame(index=df.index)
-    for new, old in mapping.items():
-        out[new] = df[old] if (old is not None and old in df.columns) else np.nan
-    return out
-
-def to_num(s: pd.Series) -> pd.Series:
-    return pd.to_numeric(s, errors="coerce")
-
-def normalize_code(s: pd.Series) -> pd.Series:
-    s = s.astype(str).str.upper().str.replace(r"[^A-Z0-9]", "", regex=True)
-    return s.replace({"NAN": np.nan})
-
-def normalize_uom(s: pd.Series) -> pd.Series:
-    s = s.astype(str).str.upper().str.strip()
-    s = s.replace({"PAGINA": "KG", "PAGES": "KG", "": "KG", "NAN": "KG"}).fillna("KG")
-    return s
-
-def clamp_non_negative(s: pd.Series) -> pd.Series:
-    s = to_num(s)
-    return s.mask(s < 0, 0)
-
 def metrics(df: pd.DataFrame, tag: str) -> dict:
-    m = {f"{tag}_rows": len(df)}
-    for col in ["stock", "real", "outgoing"]:
-        if col in df.columns:
-            s = to_num(df[col])
-            m[f"{tag}_null_{col}"] = int(s.isna().sum())
-            m[f"{tag}_neg_{col}"]  = int((s < 0).sum())
-    if all(c in df.columns for c in ["code", "description", "mese_rif"]):
-        m[f"{tag}_dups"] = int(df.duplicated(subset=["code", "description", "mese_rif"]).sum())
-    return m
-
-# Caricamento, standardizzazione e integrazione (ordine fissato)
-
-frames = []
-for path in INPUT_FILES:
-    if not path.exists():
-        raise SystemExit(f"File non trovato: {path}")
-    df = pd.read_excel(path)
-    std = standardize_columns(df)
-    std["mese_rif"] = MONTH_LABEL[path.name]
-    frames.append(std)
-    print(f"File elaborato: {path.name} ({len(df)} righe)")
-
-raw_integrated = pd.concat(frames, ignore_index=True)
-
-
-# QA prima del cleaning
-m_before = metrics(raw_integrated, "before")
-
-
-# Cleaning
-clean = raw_integrated.copy()
-
-clean["code"] = normalize_code(clean["code"])
-clean["uom"]  = normalize_uom(clean["uom"])
-
-for col in ["stock", "real", "outgoing"]:
-    clean[col] = clamp_non_negative(clean[col]).fillna(0)
-
-clean = clean.drop_duplicates(subset=["code", "description", "mese_rif"])
-
-
-# QA dopo il cleaning
-
-m_after = metrics(clean, "after")
-
-# Salvataggi
-
-clean.to_excel(OUT_DATASET, index=False)
-
-qa_rows = []
-for k in sorted(set(m_before) | set(m_after)):
-    qa_rows.append({
-        "metric": k.replace("before_", "").replace("after_", ""),
-        "before": m_before.get(k, ""),
-        "after":  m_after.get(k,  ""),
-        "delta":  (m_after.get(k, 0) - m_before.get(k, 0)) if isinstance(m_after.get(k, 0), (int, float)) else ""
-    })
-qa_df = pd.DataFrame(qa_rows)
-qa_df.to_csv(OUT_QA_SUMMARY, index=False)
-
-# Tabelle di riepilogo per mese (per mostrare che ci sono tutti i mesi) 
-by_month = (
-    clean.groupby("mese_rif")
-         .agg(righe=("code","size"), codici_unici=("code","nunique"))
-)
-# ordina i mesi in modo cronologico
-by_month = by_month.reindex(MONTH_ORDER).reset_index().rename(columns={"mese_rif":"mese"})
+    # metriche QA di un frame (profilo a passaggio unico, vedi qa_profile)
+    with stage("metrics", item=tag, rows_in=len(df)):
+        return qa.to_metrics(qa.profile(df, name=tag), tag)
+
+def reconcile_months(months):
+    # riconciliazione tra mesi consecutivi (qa_reconcile): conteggi per QA_summary,
+    # coppie articolo/mese non riconciliate in OUT_RECON
+    with stage("reconcile") as st:
+        recon = reconcile(months, OUT_RECON)
+        st.rows_out = recon.counts["ricon_coppie"]
+    return recon
+
+def clean_frame(raw: pd.DataFrame, policy: str = "first", sources=None) -> tuple:
+    # restituisce (dataset pulito, provenienza dei duplicati scartati);
+    # sources: [(nome file, righe), ...] dei frame concatenati in raw
+    with stage("cleaning", rows_in=len(raw)) as st:
+        clean = raw.copy()
+
+        clean["code"] = normalize_code(clean["code"])
+        clean["uom"]  = normalize_uom(clean["uom"])
+
+        for col in ["stock", "real", "outgoing"]:
+            clean[col] = clamp_non_negative(clean[col]).fillna(0)
+
+        # lo schema tipizzato prima della deduplica: le chiavi sono già categorie
+        # e l'hash si calcola sui soli valori distinti
+        clean = apply_typed_schema(clean)
+        with stage("dedup", item=policy, rows_in=len(clean)) as dd:
+            clean, dups = dedup(clean, KEY, policy, sources=sources)
+            for col in CATEGORY_COLS:
+                clean[col] = clean[col].cat.remove_unused_categories()
+            dd.rows_out = len(clean)
+        st.rows_out = len(clean)
+    return clean, dups
+
+def null_table(nulls: pd.Series) -> pd.DataFrame:
+    return nulls.reset_index().rename(columns={"index":"colonna",0:"null_count"})
+
+def dup_table(dups: pd.DataFrame) -> pd.DataFrame:
+    # duplicati scartati per file di origine
+    counts = dups["file"].value_counts(sort=False)
+    return counts[counts > 0].rename_axis("file").reset_index(name="duplicati_scartati")
+
+# Modalità incrementale: stato intermedio per mese
+# Per ogni mese si conservano la partizione del dataset pulito, i profili QA parziali
+# e la provenienza dei duplicati scartati. Lo stato registra anche dimensione, mtime
+# e hash della partizione scritta: se un'esecuzione completa o a blocchi la
+# riscrive (ad esempio con un'altra politica di deduplica) il mese si rielabora.
+# La chiave di deduplica contiene mese_rif, quindi tutte le metriche sono
+# additive sui mesi e il QA complessivo si ricompone senza rileggere lo storico.
+
+STATE_DIR = HERE / ".cache" / "mesi"
+STATE_FILE = STATE_DIR / "state.json"
+
+def load_state() -> dict:
+    return read_json(STATE_FILE)
+
+def save_state(state: dict) -> None:
+    write_json_atomic(STATE_FILE, state)
+
+def dups_path(label: str) -> Path:
+    return STATE_DIR / f"duplicati_{label}.parquet"
+
+def file_id(path: Path) -> dict:
+    st = path.stat()
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": file_hash(path)}
+
+def file_changed(path: Path, ref: dict) -> bool:
+    # dimensione e mtime invariati: file invariato; altrimenti decide l'hash. Se il
+    # contenuto è lo stesso si aggiornano dimensione e mtime in ref (stato da salvare)
+    st = path.stat()
+    if ref["mtime_ns"] == st.st_mtime_ns and ref["size"] == st.st_size:
+        return False
+    if file_hash(path) != ref["sha256"]:
+        return True
+    ref.update(mtime_ns=st.st_mtime_ns, size=st.st_size)
+    return False
+
+def source_changed(path: Path, entry, policy: str = "first") -> bool:
+    # gli stati senza profilo QA ("qa"), senza politica di deduplica o senza
+    # impronta della partizione sono di una versione precedente: mese da rielaborare
+    if (entry is None or "qa" not in entry or "partition" not in entry or entry.get("dedup") != policy
+            or not (DATASET_DIR / entry["file"]).exists() or not dups_path(entry["label"]).exists()):
+        return True
+    # partizione riscritta da un'esecuzione completa o a blocchi
+    if file_changed(DATASET_DIR / entry["file"], entry["partition"]):
+        return True
+    return file_changed(path, entry)
+
+def process_month(path: Path, policy: str = "first"):
+    # eseguita nei worker: un mese letto, pulito e scritto come partizione del dataset
+    label = MONTH_LABEL[path.name]
+    raw = read_standardized(path)
+    clean, dups = clean_frame(raw, policy, [(path.name, len(raw))])
+    part = write_partition(clean, label)
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(dups_path(label))
+    dups.to_parquet(tmp, index=False)
+    os.replace(tmp, dups_path(label))
+    st = path.stat()
+    return label, {
+        "label": label,
+        "source": path.name,
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "sha256": file_hash(path),
+        "file": part.relative_to(DATASET_DIR).as_posix(),
+        "partition": file_id(part),
+        "rows_raw": int(len(raw)),
+        "dedup": policy,
+        "qa": {"before": qa.profile(raw, name=label), "after": qa.profile(clean, name=label)},
+    }
 
-# HTML senza data di generazione 
-html = f"""<!DOCTYPE html>
+def run_incremental(workers: int = DEFAULT_WORKERS, xlsx: bool = False, policy: str = "first"):
+    state = load_state()
+    inputs = sorted(INPUT_FILES, key=month_key)
+    labels = [MONTH_LABEL[p.name] for p in inputs]
+
+    for path in inputs:
+        if not path.exists():
+            raise SystemExit(f"File non trovato: {path}")
+    todo = [p for p in inputs if source_changed(p, state.get(MONTH_LABEL[p.name]), policy)]
+    changed = []
+    for label, entry in map_files(partial(process_month, policy=policy), todo, workers):
+        print(f"File elaborato: {entry['source']} ({entry['rows_raw']} righe)")
+        state[label] = entry
+        changed.append(label)
+
+    # mesi non più presenti tra gli input
+    removed = [m for m in state if m not in labels]
+    for m in removed:
+        state.pop(m)
+        drop_partition(m)
+        dups_path(m).unlink(missing_ok=True)
+    save_state(state)
+    print(f"Mesi rielaborati: {', '.join(changed) if changed else 'nessuno'}")
+
+    # QA complessivo dai profili parziali dei mesi
+    p_before = qa.merge(state[m]["qa"]["before"] for m in labels)
+    p_after = qa.merge(state[m]["qa"]["after"] for m in labels)
+    dups = pd.concat([pd.read_parquet(dups_path(m)) for m in labels], ignore_index=True)
+
+    # le partizioni dei mesi invariati non vengono toccate; per l'anteprima
+    # si leggono solo le prime righe
+    head = scan().months(labels).head(15)
+
+    outputs = [DATASET_DIR]
+    if xlsx and (changed or removed or not DATASET_XLSX.exists()) and export_xlsx():
+        outputs.append(DATASET_XLSX)
+    write_reports(qa.to_metrics(p_before, "before"), qa.to_metrics(p_after, "after"), qa.month_table(p_after),
+                  qa.null_counts(p_after, DATASET_COLUMNS), p_after["rows"], head, outputs, dups,
+                  reconcile_months(dataset_months()))
+
+def run_full(workers: int = DEFAULT_WORKERS, xlsx: bool = False, policy: str = "first"):
+    # Caricamento, standardizzazione e integrazione (ordine fissato)
+    paths = sorted(INPUT_FILES, key=month_key)
+    frames = load_months(paths, workers)
+
+    # QA prima del cleaning: un profilo per file (mese), sommati
+    p_before = qa.merge(qa.profile(f, name=p.name) for p, f in zip(paths, frames))
+    raw_integrated = pd.concat(frames, ignore_index=True)
+
+    # Cleaning (la provenienza dei duplicati riporta file e riga di origine)
+    clean, dups = clean_frame(raw_integrated, policy, [(p.name, len(f)) for p, f in zip(paths, frames)])
+
+    # QA dopo il cleaning: un solo profilo per metriche, mesi e null
+    p_after = qa.profile(clean, name="clean")
+
+    # Salvataggi: dataset Parquet partizionato per mese, .xlsx solo su richiesta
+    with stage("write_dataset", rows_in=len(clean)):
+        write_dataset(clean)
+    outputs = [DATASET_DIR]
+    if xlsx and export_xlsx():
+        outputs.append(DATASET_XLSX)
+
+    write_reports(qa.to_metrics(p_before, "before"), qa.to_metrics(p_after, "after"), qa.month_table(p_after),
+                  qa.null_counts(p_after), len(clean), clean.head(15), outputs, dups,
+                  reconcile_months(split_months(clean)))
+    # il dataset pulito resta disponibile in memoria per gli stadi a valle
+    return clean
+
+def run_streaming(chunk_size: int = DEFAULT_CHUNK_SIZE, xlsx: bool = False):
+    # picco di memoria limitato a un blocco (più il seen-set del mese corrente)
+    inputs = sorted(INPUT_FILES, key=month_key)
+    cleaner, head = stream_clean(inputs, DATASET_DIR, chunk_size)
+    outputs = [DATASET_DIR]
+    if xlsx and export_xlsx(batch_size=chunk_size):
+        outputs.append(DATASET_XLSX)
+
+    p_after = cleaner.p_after
+    write_reports(cleaner.before, cleaner.after, qa.month_table(p_after),
+                  qa.null_counts(p_after, DATASET_COLUMNS).fillna(0).astype("int64"), p_after["rows"], head, outputs,
+                  cleaner.dups, reconcile_months(dataset_months()))
+
+def write_reports(m_before, m_after, by_month, nulls, n_rows, head, outputs, dups, recon):
+    qa_rows = []
+    for k in sorted(set(m_before) | set(m_after)):
+        qa_rows.append({
+            "metric": k.replace("before_", "").replace("after_", ""),
+            "before": m_before.get(k, ""),
+            "after":  m_after.get(k,  ""),
+            "delta":  (m_after.get(k, 0) - m_before.get(k, 0)) if isinstance(m_after.get(k, 0), (int, float)) else ""
+        })
+    # riconciliazione tra mesi: solo sul dataset pulito
+    qa_rows += [{"metric": k, "before": "", "after": v, "delta": ""} for k, v in recon.counts.items()]
+    qa_df = pd.DataFrame(qa_rows)
+    qa_df.to_csv(OUT_QA_SUMMARY, index=False)
+    dups.to_csv(OUT_DUPS, index=False)
+
+    # HTML senza data di generazione, scritto a frammenti (etl_html): l'elenco
+    # completo dei duplicati, se lungo, va in pagine JSON caricate dal browser
+    with stage("render_html", item=OUT_HTML), HtmlReport(OUT_HTML) as rep:
+        rep.write(f"""<!DOCTYPE html>
 <html><head><meta charset="utf-8"><title>Data Cleaning & QA Summary</title>
 <style>
 body{{font-family:Arial;margin:24px}}
@@ -159,26 +255,63 @@ h2{{margin-top:28px}}
 </style></head>
 <body>
 <h1>Data Cleaning & QA Summary</h1>
-<p>Righe finali nel dataset integrato: {len(clean)}</p>
+<p>Righe finali nel dataset integrato: {n_rows}</p>
 
 <h2>Distribuzione per mese (righe e codici unici)</h2>
-{by_month.to_html(index=False)}
-
-<h2>QA Summary (prima/dopo)</h2>
-{qa_df.to_html(index=False)}
-
-<h2>Null per colonna (post-cleaning)</h2>
-{clean.isna().sum().reset_index().rename(columns={"index":"colonna",0:"null_count"}).to_html(index=False)}
-<h2>Esempio dati finali (prime 15 righe)</h2>
-{clean.head(15).to_html(index=False)}
-</body></html>
-"""
-
-with open(OUT_HTML, "w", encoding="utf-8") as f:
-    f.write(html)
-
-print("Creati:")
-print(f" - {OUT_DATASET}")
-print(f" - {OUT_QA_SUMMARY}")
-print(f" - {OUT_HTML}")
-
+""")
+        rep.table(by_month, end="\n\n")
+        rep.write("<h2>QA Summary (prima/dopo)</h2>\n")
+        rep.table(qa_df, end="\n\n")
+        rep.write(f"<h2>Duplicati scartati per file</h2>\n<p>Dettaglio (file e riga di origine, riga tenuta): {OUT_DUPS}</p>\n")
+        rep.table(dup_table(dups), end="\n\n")
+        rep.write("<h2>Null per colonna (post-cleaning)</h2>\n")
+        rep.table(null_table(nulls))
+        rep.write("<h2>Esempio dati finali (prime 15 righe)</h2>\n")
+        rep.table(head)
+        rep.write("<h2>Elenco dei duplicati scartati</h2>\n")
+        rep.table(dups)
+        rep.write(f"<h2>Riconciliazione tra mesi consecutivi</h2>\n<p>Giacenza attesa = stock - outgoing "
+                  f"del mese precedente, confrontata con lo stock del mese successivo. Dettaglio: {OUT_RECON}</p>\n")
+        rep.table(recon.by_pair)
+        rep.write(f"<p>Scostamenti maggiori (primi {TOP_ROWS} in valore assoluto)</p>\n")
+        rep.table(recon.top, float_format="{:.2f}".format)
+        rep.write("</body></html>\n")
+
+    print("Creati:")
+    for out in outputs:
+        print(f" - {out.name}")
+    print(f" - {OUT_QA_SUMMARY}")
+    print(f" - {OUT_DUPS}")
+    print(f" - {OUT_RECON}")
+    print(f" - {OUT_HTML}")
+    if Path(OUT_HTML).with_name(Path(OUT_HTML).stem + "_dati").exists():
+        print(f" - {Path(OUT_HTML).stem}_dati/")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Integrazione, cleaning e QA dei file mensili.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--incrementale", action="store_true",
+                      help="rielabora solo i mesi il cui file sorgente è cambiato")
+    mode.add_argument("--streaming", action="store_true",
+                      help="elaborazione a blocchi per dataset più grandi della memoria")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"righe per blocco in modalità --streaming (default {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument("--xlsx", action="store_true",
+                        help=f"esporta anche {DATASET_XLSX.name} per gli utenti di business")
+    add_dedup_arg(parser)
+    add_workers_arg(parser)
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+    if args.streaming and args.dedup != "first":
+        parser.error("--streaming supporta solo --dedup first")
+
+    with session(args, "make_quality_report"):
+        if args.incrementale:
+            run_incremental(args.workers, args.xlsx, args.dedup)
+        elif args.streaming:
+            run_streaming(args.chunk_size, args.xlsx)
+        else:
+            run_full(args.workers, args.xlsx, args.dedup)
+
+if __name__ == "__main__":
+    main()
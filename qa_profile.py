@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+from etl_common import MONTH_ORDER, QTY_COLS, to_num
+from etl_profile import stage
+
+# Profilatore QA a passaggio unico: per ogni colonna una sola lettura dei valori
+# (null; per le quantità anche null dopo la conversione numerica e negativi),
+# una scansione per i duplicati e un groupby per le righe e i codici per mese.
+# Il risultato è un parziale (dict di contatori, serializzabile in JSON) che si
+# somma con merge(): il QA per file, per mese e dell'intero dataset si ricava
+# dagli stessi parziali senza rileggere i dati. I conteggi di duplicati e codici
+# per mese sono esatti se i parziali uniti non dividono uno stesso mese (un file
+# mensile, una partizione): la chiave di deduplica contiene mese_rif.
+
+KEY = ["code", "description", "mese_rif"]
+
+def _codes(s: pd.Series) -> tuple:
+    # codici interi della colonna (null compresi, come gruppo a sé) e numero di gruppi;
+    # per le categorie i codici esistono già
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        n = len(s.cat.categories)
+        codes = s.cat.codes.to_numpy(dtype=np.int64)
+        return np.where(codes < 0, n, codes), n + 1
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    return codes.astype(np.int64, copy=False), max(len(uniques), 1)
+
+def _dups(ids: list) -> int:
+    # duplicati sulla combinazione di colonne già fattorizzate (come DataFrame.duplicated)
+    key = np.zeros(len(ids[0][0]), dtype=np.int64)
+    for codes, n in ids:
+        key = key * n + codes
+    return int(pd.Series(key).duplicated().sum())
+
+def profile(df: pd.DataFrame, qty_cols=QTY_COLS, key=KEY, full_rows: bool = False,
+            month_col: str = "mese_rif", code_col: str = "code", name=None) -> dict:
+    # qty_cols=None: tutte le colonne di tipo numerico, senza conversione
+    # full_rows: conta anche i duplicati sull'intera riga
+    with stage("qa_profile", item=name, rows_in=len(df)):
+        p = {"rows": int(len(df)), "null": {}, "qty_null": {}, "neg": {},
+             "dups": None, "dup_rows": None, "months": {}}
+        qty = (list(df.select_dtypes(include="number").columns) if qty_cols is None
+               else [c for c in qty_cols if c in df.columns])
+        for c in df.columns:
+            s = df[c]
+            p["null"][str(c)] = int(s.isna().sum())
+            if c in qty:
+                v = (s if qty_cols is None else to_num(s)).to_numpy(dtype=float, na_value=np.nan)
+                p["qty_null"][str(c)] = int(np.isnan(v).sum())
+                p["neg"][str(c)] = int(np.count_nonzero(v < 0))
+
+        # colonne chiave fattorizzate una sola volta, per duplicati e conteggi per mese
+        ids = {}
+        def col_ids(c):
+            if c not in ids:
+                ids[c] = _codes(df[c])
+            return ids[c]
+
+        if key and all(c in df.columns for c in key) and len(df):
+            sizes = [col_ids(c)[1] for c in key]
+            if np.prod(np.array(sizes, dtype=float)) < 2**62:
+                p["dups"] = _dups([col_ids(c) for c in key])
+            else:
+                p["dups"] = int(df.duplicated(subset=key).sum())
+        elif key and all(c in df.columns for c in key):
+            p["dups"] = 0
+        if full_rows:
+            p["dup_rows"] = int(df.duplicated().sum())
+        if month_col in df.columns and len(df):
+            m_ids, n_m = col_ids(month_col)
+            rows = np.bincount(m_ids, minlength=n_m)
+            codes = np.zeros(n_m, dtype=np.int64)
+            if code_col in df.columns:
+                # codici distinti (non nulli) per mese: coppie mese/codice distinte
+                c_ids, n_c = col_ids(code_col)
+                valid = df[code_col].notna().to_numpy()
+                pairs = pd.unique(m_ids[valid] * n_c + c_ids[valid])
+                codes = np.bincount(pairs // n_c, minlength=n_m)
+            present, first = np.unique(m_ids, return_index=True)
+            for i, pos in zip(present, first):
+                m = df[month_col].iloc[pos]
+                if pd.notna(m):
+                    p["months"][str(m)] = {"rows": int(rows[i]), "codes": int(codes[i])}
+    return p
+
+def _add(a, b):
+    if a is None or b is None:
+        return b if a is None else a
+    return a + b
+
+def merge(partials) -> dict:
+    out = {"rows": 0, "null": {}, "qty_null": {}, "neg": {}, "dups": None, "dup_rows": None, "months": {}}
+    for p in partials:
+        out["rows"] += p["rows"]
+        for part in ("null", "qty_null", "neg"):
+            for c, n in p[part].items():
+                out[part][c] = out[part].get(c, 0) + n
+        out["dups"] = _add(out["dups"], p["dups"])
+        out["dup_rows"] = _add(out["dup_rows"], p["dup_rows"])
+        for m, e in p["months"].items():
+            cur = out["months"].setdefault(m, {"rows": 0, "codes": 0})
+            cur["rows"] += e["rows"]
+            cur["codes"] += e["codes"]
+    return out
+
+# Viste sui parziali
+
+def to_metrics(p: dict, tag: str) -> dict:
+    # formato di QA_summary: <tag>_rows, <tag>_null_<col>, <tag>_neg_<col>, <tag>_dups
+    m = {f"{tag}_rows": p["rows"]}
+    for col in QTY_COLS:
+        if col in p["qty_null"]:
+            m[f"{tag}_null_{col}"] = p["qty_null"][col]
+            m[f"{tag}_neg_{col}"] = p["neg"][col]
+    if p["dups"] is not None:
+        m[f"{tag}_dups"] = p["dups"]
+    return m
+
+def month_table(p: dict, months=MONTH_ORDER) -> pd.DataFrame:
+    # righe e codici unici per mese, in ordine cronologico
+    by_month = pd.DataFrame.from_dict(p["months"], orient="index", columns=["rows", "codes"])
+    by_month = by_month.rename(columns={"rows": "righe", "codes": "codici_unici"})
+    return by_month.reindex(months).rename_axis("mese").reset_index()
+
+def null_counts(p: dict, columns=None) -> pd.Series:
+    s = pd.Series(p["null"], dtype="int64")
+    return s if columns is None else s.reindex(columns)
+
+def file_summary(p: dict, name: str) -> dict:
+    # riga del confronto pre/post di make_graphs_report
+    return {
+        "file": name,
+        "righe": p["rows"],
+        "valori_nulli": sum(p["null"].values()),
+        "duplicati": p["dup_rows"] or 0,
+        "negativi": sum(p["neg"].values()),
+    }
@@ -0,0 +1,161 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from etl_dataset import DATASET_DIR, scan
+
+# Riconciliazione delle giacenze tra mesi consecutivi (ordine dei mesi del dataset,
+# MONTH_ORDER). Nei file mensili outgoing (Scaricare) è la differenza tra giacenza
+# contabile (stock) e reale (real): la giacenza attesa nel mese successivo è
+# stock - outgoing del mese precedente, da confrontare con lo stock osservato.
+# Gli ingressi di merce non sono nei file: uno scostamento positivo è un'entrata
+# implicita, uno negativo un calo non spiegato dagli scarichi.
+#
+# Per ogni mese si sommano le quantità per articolo (indice code ordinato); le
+# coppie di mesi si confrontano con un join sugli indici ordinati, senza cicli
+# per articolo. In memoria restano solo due mesi alla volta: la stessa funzione
+# serve il cleaning completo, incrementale e in streaming.
+#
+# Esiti per articolo e coppia di mesi:
+#   OK                   scostamento entro la tolleranza
+#   CALO NON SPIEGATO    stock osservato minore dell'atteso
+#   ENTRATA IMPLICITA    stock osservato maggiore dell'atteso (carichi non registrati)
+#   ARTICOLO SCOMPARSO   assente nel mese successivo con giacenza attesa positiva
+#   ARTICOLO NUOVO       presente nel mese successivo ma non nel precedente
+# Inoltre, per ogni articolo e mese, stock - outgoing deve coincidere con real.
+# Le quantità mancanti contano come 0.
+
+QTY = ["stock", "real", "outgoing"]
+TOL_ABS = 0.01    # tolleranza assoluta (arrotondamenti)
+TOL_REL = 1e-4    # e relativa alla giacenza del mese precedente
+TOP_ROWS = 1000   # scostamenti maggiori riportati nel report HTML
+
+OK = "OK"
+OUTCOMES = {
+    "CALO NON SPIEGATO": "ricon_calo_non_spiegato",
+    "ENTRATA IMPLICITA": "ricon_entrata_implicita",
+    "ARTICOLO SCOMPARSO": "ricon_articoli_scomparsi",
+    "ARTICOLO NUOVO": "ricon_articoli_nuovi",
+}
+ESITI = [OK, *OUTCOMES]   # codici della categoria esito
+DETAIL_COLUMNS = ["code", "mese", "mese_successivo", "giacenza", "scarico", "giacenza_attesa",
+                  "giacenza_osservata", "scostamento", "esito"]
+
+def _tolerance(stock, tol_abs: float, tol_rel: float):
+    return np.maximum(tol_abs, tol_rel * np.abs(stock))
+
+def month_totals(df: pd.DataFrame) -> pd.DataFrame:
+    # quantità sommate per articolo (righe con descrizioni diverse), indice code ordinato.
+    # Somme con bincount sui codici della categoria (o di factorize)
+    if isinstance(df["code"].dtype, pd.CategoricalDtype):
+        codes, cats = df["code"].cat.codes.to_numpy(), df["code"].cat.categories
+    else:
+        codes, cats = pd.factorize(df["code"])
+    keep = codes >= 0   # code mancante
+    codes, n = codes[keep], len(cats)
+    seen = np.bincount(codes, minlength=n) > 0
+    sums = {q: np.bincount(codes, weights=np.nan_to_num(df[q].to_numpy(dtype="float64")[keep]), minlength=n)[seen]
+            for q in QTY}
+    out = pd.DataFrame(sums, index=pd.Index(cats[seen].astype(str), name="code"))
+    return out if out.index.is_monotonic_increasing else out.sort_index()
+
+def reconcile_pair(prev: pd.DataFrame, cur: pd.DataFrame, month: str, next_month: str,
+                   tol_abs: float = TOL_ABS, tol_rel: float = TOL_REL) -> pd.DataFrame:
+    # una riga per articolo presente in almeno uno dei due mesi (join degli indici ordinati)
+    index, li, ri = prev.index.join(cur.index, how="outer", return_indexers=True)
+    n = len(index)
+    li = np.arange(n) if li is None else li
+    ri = np.arange(n) if ri is None else ri
+    in_prev, in_cur = li >= 0, ri >= 0
+
+    def take(frame, col, ix, present):
+        return np.where(present, frame[col].to_numpy()[ix], np.nan)
+
+    stock, outgoing = take(prev, "stock", li, in_prev), take(prev, "outgoing", li, in_prev)
+    expected = stock - outgoing
+    observed = take(cur, "stock", ri, in_cur)
+    diff = observed - expected
+    tol = _tolerance(stock, tol_abs, tol_rel)
+    # esiti in ordine di priorità crescente: le assegnazioni successive prevalgono
+    esito = np.zeros(n, dtype=np.int8)
+    with np.errstate(invalid="ignore"):
+        esito[diff > tol] = ESITI.index("ENTRATA IMPLICITA")
+        esito[diff < -tol] = ESITI.index("CALO NON SPIEGATO")
+        esito[~in_prev] = ESITI.index("ARTICOLO NUOVO")
+        esito[~in_cur & (expected > tol)] = ESITI.index("ARTICOLO SCOMPARSO")
+    return pd.DataFrame({
+        "code": index, "mese": month, "mese_successivo": next_month,
+        "giacenza": stock, "scarico": outgoing, "giacenza_attesa": expected,
+        "giacenza_osservata": observed, "scostamento": diff,
+        "esito": pd.Categorical.from_codes(esito, ESITI),
+    })
+
+def incoherent_months(totals: pd.DataFrame, tol_abs: float = TOL_ABS, tol_rel: float = TOL_REL) -> int:
+    # articoli del mese per cui stock - outgoing differisce da real
+    gap = (totals["stock"] - totals["outgoing"] - totals["real"]).abs()
+    return int((gap > _tolerance(totals["stock"], tol_abs, tol_rel)).sum())
+
+def _detail_table(pairs: pd.DataFrame):
+    # coppie non OK come tabella Arrow (filtro e conversioni senza passare da oggetti Python)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = pa.Table.from_pandas(pairs[DETAIL_COLUMNS], preserve_index=False)
+    table = table.filter(pa.array((pairs["esito"].cat.codes != 0).to_numpy()))
+    cols = [pc.round(c, 4) if pa.types.is_floating(c.type) else c.cast(pa.string()) for c in table.columns]
+    return pa.table(cols, names=DETAIL_COLUMNS)
+
+@dataclass
+class Reconciliation:
+    counts: dict              # metriche per QA_summary
+    by_pair: pd.DataFrame     # esiti per coppia di mesi
+    top: pd.DataFrame         # TOP_ROWS scostamenti maggiori in valore assoluto
+
+def reconcile(months, out_csv: Path = None, tol_abs: float = TOL_ABS, tol_rel: float = TOL_REL) -> Reconciliation:
+    # months: (mese, DataFrame con code e quantità) in ordine di mese. Le coppie non
+    # OK vanno in out_csv con il writer CSV di pyarrow, una coppia di mesi alla volta
+    import pyarrow.csv as pcsv
+
+    counts = {"ricon_coppie": 0, **dict.fromkeys(OUTCOMES.values(), 0), "ricon_mesi_incoerenti": 0}
+    by_pair, top = [], _EMPTY
+    writer = pcsv.CSVWriter(str(out_csv), _detail_table(_EMPTY).schema) if out_csv else None
+    try:
+        prev = None
+        for month, df in months:
+            cur = month_totals(df)
+            counts["ricon_mesi_incoerenti"] += incoherent_months(cur, tol_abs, tol_rel)
+            if prev is not None:
+                pairs = reconcile_pair(prev[1], cur, prev[0], str(month), tol_abs, tol_rel)
+                n = np.bincount(pairs["esito"].cat.codes, minlength=len(ESITI))
+                by_pair.append({"mese": prev[0], "mese_successivo": str(month), "articoli": len(pairs),
+                                **{e: int(k) for e, k in zip(ESITI, n)}})
+                largest = pairs.loc[pairs["scostamento"].abs().nlargest(TOP_ROWS).index]
+                top = pd.concat([top, largest], ignore_index=True)
+                top = top.loc[top["scostamento"].abs().nlargest(TOP_ROWS).index]
+                if writer:
+                    writer.write_table(_detail_table(pairs))
+            prev = (str(month), cur)
+    finally:
+        if writer:
+            writer.close()
+    by_pair = pd.DataFrame(by_pair, columns=["mese", "mese_successivo", "articoli", *ESITI])
+    counts["ricon_coppie"] = int(by_pair["articoli"].sum())
+    for esito, key in OUTCOMES.items():
+        counts[key] = int(by_pair[esito].sum())
+    return Reconciliation(counts, by_pair, top.reset_index(drop=True))
+
+_EMPTY = pd.DataFrame({c: pd.Series(dtype="float64") for c in DETAIL_COLUMNS}).assign(
+    code="", mese="", mese_successivo="", esito=pd.Categorical([], ESITI))
+
+def split_months(df: pd.DataFrame):
+    # mesi di un frame in memoria, nell'ordine della categoria mese_rif
+    for month, g in df.groupby("mese_rif", observed=True, sort=True):
+        yield month, g
+
+def dataset_months(root: Path = DATASET_DIR):
+    # mesi del dataset su disco, letti uno alla volta (solo code e quantità)
+    q = scan(root).select("code", *QTY)
+    for month, _ in q.sources:
+        yield month, q.months([month]).to_pandas()
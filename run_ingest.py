@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from functools import partial
+from pathlib import Path
+
+import etl_profile
+import run_partitions
+from etl_common import HERE
+from etl_dedup import add_dedup_arg
+from etl_loader import DEFAULT_WORKERS, add_workers_arg
+from etl_dataset import PART_FILE, partition_dir
+from etl_partitions import INPUT_ROOT, LEGACY_WAREHOUSE, Partition, discover, from_path, parse_month, parse_year
+from etl_profile import add_profile_args, session
+from etl_utils import read_json, write_json_atomic
+from kpi_engine import KpiThresholds
+from run_partitions import STATE_DIR, STATE_FILE, dataset_root, process_partition
+
+# Acquisizione continua dei file mensili da una cartella di arrivo, senza
+# modificare INPUT_FILES/MONTH_LABEL e senza rieseguire l'intera pipeline:
+#
+#   python run_ingest.py [--landing arrivi] [--intervallo 5] [--once]
+#
+# Un ciclo asyncio controlla la cartella ogni `--intervallo` secondi; un workbook
+# è pronto quando dimensione e data di modifica non cambiano per un intervallo
+# (copia terminata). Ogni file pronto viene letto, standardizzato e pulito subito
+# in un pool di processi (run_partitions.process_partition) in una cartella di
+# appoggio; poi il file viene spostato tra gli input partizionati (etl_partitions),
+# la partizione pulita entra nel dataset e lo stato di run_partitions la registra.
+# Se questo passo fallisce il file viene scartato e il dataset resta com'era.
+# Quando non ci sono file in elaborazione si aggiornano solo gli archivi KPI e i
+# riepiloghi di ETL_QA/magazzini (run_partitions.run: le partizioni già
+# registrate non vengono rilette), in background: i file arrivati nel frattempo
+# vengono elaborati subito e attendono solo per la registrazione nello stato.
+#
+#   arrivi/<magazzino>/<anno>/<file>.xlsx   stessa struttura di dati_magazzini
+#   arrivi/<file>.xlsx                      magazzino --magazzino, anno dal nome
+#                                           del file (MARZO_2025.xlsx) o --anno
+#
+# Il mese si ricava dal nome del file (etl_partitions.parse_month); un file per
+# una partizione già presente la sostituisce. I file non riconosciuti o illeggibili
+# vengono spostati in arrivi/scartati, con il motivo in <file>.errore.txt.
+
+LANDING_DIR = Path(os.environ.get("ETL_LANDING_DIR", HERE / "arrivi"))
+REJECT_DIR = "scartati"
+DEFAULT_INTERVAL = 5.0
+STAGING_DIR = STATE_DIR / "arrivi"   # partizioni pulite in attesa di entrare nel dataset
+
+def partitions_in(root: Path) -> list:
+    # discover termina il programma (SystemExit) su input incoerenti, ad esempio due
+    # file per la stessa partizione: qui è un errore da gestire, non la fine del processo
+    try:
+        return discover(root) if Path(root).is_dir() else []
+    except SystemExit as exc:
+        raise ValueError(str(exc)) from None
+
+def destination(p: Partition, root: Path, existing: dict) -> Path:
+    # file della stessa partizione già presente (sostituito), altrimenti <MESE>.xlsx
+    # nella cartella del magazzino/anno (quella esistente, se c'è)
+    key = (p.warehouse, p.year, p.month)
+    if key in existing:
+        return existing[key].path
+    for q in existing.values():
+        if (q.warehouse, q.year) == (p.warehouse, p.year):
+            return q.path.parent / f"{p.month}.xlsx"
+    return Path(root) / p.warehouse / str(p.year) / f"{p.month}.xlsx"
+
+class Ingestor:
+
+    def __init__(self, landing: Path = LANDING_DIR, root: Path = INPUT_ROOT, workers: int = DEFAULT_WORKERS,
+                 policy: str = "first", th: KpiThresholds = KpiThresholds(),
+                 warehouse: str = LEGACY_WAREHOUSE, year: int = None, interval: float = DEFAULT_INTERVAL):
+        self.landing = Path(landing)
+        self.root = Path(root)
+        self.workers = max(1, workers)
+        self.policy = policy
+        self.th = th
+        self.warehouse = warehouse.upper()
+        self.year = year or date.today().year
+        self.interval = interval
+        self.seen = {}      # file in arrivo -> (dimensione e mtime, ultimo cambiamento, primo avvistamento)
+        self.busy = {}      # file in elaborazione -> (partizione, primo avvistamento)
+        self.dirty = False  # partizioni acquisite dopo l'ultimo aggiornamento dei riepiloghi
+        self.state_lock = asyncio.Lock()   # stato di run_partitions: acquisizione o riepiloghi
+
+    # Cartella di arrivo
+
+    def scan(self) -> list:
+        # file pronti: dimensione e mtime invariati da almeno un intervallo
+        now, ready, seen = time.monotonic(), [], {}
+        for f in sorted(self.landing.rglob("*.xlsx")):
+            rel = f.relative_to(self.landing).parts
+            if f.name.startswith("~$") or rel[0] == REJECT_DIR or f in self.busy:
+                continue
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            sig = (st.st_size, st.st_mtime_ns)
+            prev_sig, changed, first = self.seen.get(f, (None, now, time.time()))
+            if sig != prev_sig:
+                changed = now
+            seen[f] = (sig, changed, first)
+            if st.st_size > 0 and now - changed >= self.interval:
+                ready.append(f)
+        self.seen = seen
+        return ready
+
+    def partition(self, f: Path) -> Partition:
+        # partizione di un file in arrivo (path resta il file in arrivo)
+        rel = f.relative_to(self.landing)
+        if len(rel.parts) == 3:
+            p = from_path(f)
+            if p is None:
+                raise ValueError("anno o mese non riconosciuti nel percorso")
+            return p
+        if len(rel.parts) != 1:
+            raise ValueError("percorso atteso: <file>.xlsx oppure <magazzino>/<anno>/<file>.xlsx")
+        month = parse_month(f.stem)
+        if month is None:
+            raise ValueError("mese non riconosciuto nel nome del file")
+        return Partition(self.warehouse, parse_year(f.stem) or self.year, month, f)
+
+    def reject(self, f: Path, reason) -> None:
+        target = self.landing / REJECT_DIR / f.name
+        if target.exists():
+            target = target.with_name(f"{f.stem}_{datetime.now():%Y%m%d%H%M%S}{f.suffix}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(f, target)
+        target.with_name(target.name + ".errore.txt").write_text(f"{reason}\n", encoding="utf-8")
+        print(f"File scartato: {f.relative_to(self.landing)} ({reason})")
+
+    # Acquisizione
+
+    def staging(self, p: Partition) -> Path:
+        # una sola elaborazione per partizione alla volta: cartella per magazzino/anno/mese
+        return STAGING_DIR / f"{p.warehouse}_{p.year}_{p.month}"
+
+    def commit(self, p: Partition, entry: dict) -> Path:
+        # il file entra tra gli input partizionati, la partizione pulita nel dataset
+        # e lo stato di run_partitions la registra
+        self.root.mkdir(parents=True, exist_ok=True)
+        existing = {(q.warehouse, q.year, q.month): q for q in partitions_in(self.root)}
+        dest = destination(p, self.root, existing)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        part = partition_dir(p.month, dataset_root(p.warehouse, p.year))
+        part.mkdir(parents=True, exist_ok=True)
+        shutil.move(p.path, dest)
+        try:
+            st = dest.stat()
+            os.replace(partition_dir(p.month, self.staging(p)) / PART_FILE, part / PART_FILE)
+        except OSError:
+            shutil.move(dest, p.path)   # il file torna in arrivo per essere scartato
+            raise
+        entry.update(source=str(dest), mtime_ns=st.st_mtime_ns, size=st.st_size)
+        state = read_json(STATE_FILE)
+        state[p.label] = entry
+        write_json_atomic(STATE_FILE, state)
+        self.dirty = True
+        return dest
+
+    async def ingest(self, pool, p: Partition) -> None:
+        _, first = self.busy[p.path]
+        staging = self.staging(p)
+        func = partial(process_partition, p, policy=self.policy, root=staging)
+        if etl_profile.enabled():   # i record dei worker tornano con il risultato, come in map_files
+            func = partial(etl_profile.call_collect, partial(process_partition, policy=self.policy, root=staging),
+                           p, etl_profile.memory_enabled())
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, func)
+            if etl_profile.enabled():
+                result, recs = result
+                etl_profile.merge(recs)
+            async with self.state_lock:   # non durante l'aggiornamento dei riepiloghi
+                dest = self.commit(p, result[1])
+        except Exception as exc:   # workbook illeggibile, senza le colonne attese o partizione doppia
+            self.reject(p.path, f"{type(exc).__name__}: {exc}")
+        else:
+            print(f"Partizione acquisita: {p.label} <- {p.path.name} ({result[1]['rows_raw']} righe, "
+                  f"{time.time() - first:.1f} s dall'arrivo) in {dest}")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+            self.busy.pop(p.path, None)
+
+    async def refresh(self) -> None:
+        # solo archivi KPI e riepiloghi: le partizioni acquisite sono già nello stato
+        async with self.state_lock:
+            self.dirty = False
+            try:
+                partitions = partitions_in(self.root)
+                if partitions:
+                    t0 = time.perf_counter()
+                    await asyncio.to_thread(run_partitions.run, partitions, self.workers, self.policy, self.th)
+                    print(f"Riepiloghi QA/KPI aggiornati in {time.perf_counter() - t0:.1f} s")
+            except Exception as exc:   # l'acquisizione continua; si riprova alla prossima partizione
+                print(f"Aggiornamento dei riepiloghi non riuscito: {type(exc).__name__}: {exc}")
+
+    async def run(self, once: bool = False) -> None:
+        self.landing.mkdir(parents=True, exist_ok=True)
+        print(f"In attesa di file in {self.landing} (controllo ogni {self.interval:g} s)")
+        await self.refresh()   # allineamento con gli input già presenti
+        ctx = multiprocessing.get_context("forkserver") if os.name == "posix" else None
+        tasks, refreshing = set(), None
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx) as pool:
+            while True:
+                for f in self.scan():
+                    try:
+                        p = self.partition(f)
+                    except ValueError as exc:
+                        self.reject(f, exc)
+                        continue
+                    # una sola elaborazione per partizione alla volta: l'altro file attende
+                    if any(label == p.label for label, _ in self.busy.values()):
+                        continue
+                    self.busy[f] = (p.label, self.seen.pop(f)[2])
+                    tasks.add(asyncio.create_task(self.ingest(pool, p)))
+                if self.dirty and not tasks and refreshing is None:
+                    refreshing = asyncio.create_task(self.refresh())
+                pending = tasks | ({refreshing} if refreshing else set())
+                if pending:
+                    done, _ = await asyncio.wait(pending, timeout=self.interval,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    tasks -= done
+                    if refreshing in done:
+                        refreshing = None
+                elif once and not self.seen:
+                    return
+                else:
+                    await asyncio.sleep(self.interval)
+
+def main(argv=None):
+    d = KpiThresholds()
+    parser = argparse.ArgumentParser(description="Acquisizione continua dei file mensili da una cartella di arrivo.")
+    parser.add_argument("--landing", type=Path, default=LANDING_DIR,
+                        help=f"cartella di arrivo dei file (default {LANDING_DIR}, ETL_LANDING_DIR)")
+    parser.add_argument("--input-root", type=Path, default=INPUT_ROOT,
+                        help=f"radice degli input partizionati (default {INPUT_ROOT})")
+    parser.add_argument("--magazzino", default=LEGACY_WAREHOUSE,
+                        help=f"magazzino dei file direttamente nella cartella di arrivo (default {LEGACY_WAREHOUSE})")
+    parser.add_argument("--anno", type=int, help="anno dei file senza anno nel nome (default anno corrente)")
+    parser.add_argument("--intervallo", type=float, default=DEFAULT_INTERVAL,
+                        help=f"secondi tra due controlli della cartella (default {DEFAULT_INTERVAL:g})")
+    parser.add_argument("--once", action="store_true",
+                        help="acquisisce i file presenti, aggiorna i riepiloghi e termina")
+    parser.add_argument("--safety", type=float, default=d.safety)
+    parser.add_argument("--target", type=float, default=d.target)
+    parser.add_argument("--rot-bassa", type=float, default=d.rot_low)
+    parser.add_argument("--rot-alta", type=float, default=d.rot_high)
+    add_dedup_arg(parser)
+    add_workers_arg(parser)
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+
+    ingestor = Ingestor(args.landing, args.input_root, args.workers, args.dedup,
+                        KpiThresholds(args.safety, args.target, args.rot_bassa, args.rot_alta),
+                        args.magazzino, args.anno, args.intervallo)
+    with session(args, "run_ingest"):
+        try:
+            asyncio.run(ingestor.run(args.once))
+        except KeyboardInterrupt:
+            print("Acquisizione interrotta")
+
+if __name__ == "__main__":
+    main()
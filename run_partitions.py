@@ -0,0 +1,219 @@
+import argparse
+import shutil
+from functools import partial
+from pathlib import Path
+
+import pandas as pd
+
+import qa_profile as qa
+from etl_common import HERE, QTY_COLS
+from etl_dataset import PART_FILE, drop_partition, partition_dir, write_partition
+from etl_dedup import add_dedup_arg
+from etl_html import HtmlReport
+from etl_loader import DEFAULT_WORKERS, add_workers_arg, map_files, read_standardized
+from etl_partitions import INPUT_ROOT, Partition, discover, groups, legacy_partitions
+from etl_profile import add_profile_args, session, stage
+from etl_utils import read_json, write_json_atomic
+from kpi_engine import LEVEL_CLASSES, ROTATION_CLASSES, KpiThresholds
+from kpi_store import KpiStore, rollup_kpis
+from make_quality_report import clean_frame
+
+# Elaborazione per partizioni (magazzino/anno/mese, vedi etl_partitions).
+# Ogni partizione viene letta, pulita e scritta in modo indipendente, in un pool
+# di processi:
+#
+#   dataset_magazzini/magazzino=MILANO/anno=2025/mese_rif=MARZO/part-0.parquet
+#
+# Per ogni partizione si conservano i profili QA parziali (.cache/magazzini) e
+# per ogni magazzino/anno un archivio KPI (kpi_store). Le partizioni invariate
+# non vengono rielaborate. QA e KPI si calcolano per partizione e si sommano
+# per magazzino/anno, per magazzino e sul totale senza formare un frame unico:
+#
+#   ETL_QA/magazzini/QA_partizioni.csv    QA prima/dopo il cleaning per ogni livello
+#   ETL_QA/magazzini/kpi_magazzini.csv    rotazione, DIO e classi per ogni livello
+
+OUT_ROOT = HERE / "dataset_magazzini"
+OUT_DIR = HERE / "ETL_QA" / "magazzini"
+STATE_DIR = HERE / ".cache" / "magazzini"
+STATE_FILE = STATE_DIR / "state.json"
+OUT_QA = "QA_partizioni.csv"
+OUT_KPI = "kpi_magazzini.csv"
+OUT_HTML = "report_magazzini.html"
+
+TOTAL = "TOTALE"
+
+def dataset_root(warehouse: str, year: int) -> Path:
+    # radice del dataset di un magazzino/anno: stesso layout per mese di etl_dataset
+    return OUT_ROOT / f"magazzino={warehouse}" / f"anno={year}"
+
+def store_path(warehouse: str, year: int) -> Path:
+    return STATE_DIR / f"kpi_{warehouse}_{year}.sqlite"
+
+# Partizioni
+
+def source_changed(p: Partition, entry, policy: str) -> bool:
+    if entry is None or entry.get("dedup") != policy or entry.get("source") != str(p.path):
+        return True
+    if not (partition_dir(p.month, dataset_root(p.warehouse, p.year)) / PART_FILE).exists():
+        return True
+    st = p.path.stat()
+    return entry["mtime_ns"] != st.st_mtime_ns or entry["size"] != st.st_size
+
+def process_partition(p: Partition, policy: str = "first", root: Path = None):
+    # eseguita nei worker: una partizione letta, pulita e scritta (sotto root, se
+    # indicata, invece che nel dataset del magazzino/anno)
+    raw = read_standardized(p.path, p.month)
+    clean, dups = clean_frame(raw, policy, [(p.path.name, len(raw))])
+    write_partition(clean, p.month, root or dataset_root(p.warehouse, p.year))
+    st = p.path.stat()
+    return p.label, {
+        "source": str(p.path),
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "dedup": policy,
+        "rows_raw": int(len(raw)),
+        "qa": {"before": qa.profile(raw, name=p.label), "after": qa.profile(clean, name=p.label)},
+    }
+
+def sync_kpis(group: tuple):
+    # eseguita nei worker: archivio KPI di un magazzino/anno allineato alle sue partizioni
+    warehouse, year = group
+    with KpiStore(store_path(warehouse, year)) as store:
+        changed = store.sync(root=dataset_root(warehouse, year))
+        months, totals = store.months(), store.item_totals()
+    # mesi di anni diversi restano distinti nei totali complessivi
+    months["mese_rif"] = f"{year} " + months["mese_rif"]
+    months["mese_n"] = year * 100 + months["mese_n"]
+    return group, changed, months, totals
+
+# Riepiloghi
+
+def _levels(keys) -> list:
+    # livelli di aggregazione: (livello, magazzino, anno, mese, chiavi incluse)
+    keys = list(keys)
+    out = [("partizione", *k, [k]) for k in keys if len(k) == 3]
+    for w, y in dict.fromkeys((k[0], k[1]) for k in keys):
+        out.append(("magazzino-anno", w, y, "", [k for k in keys if k[:2] == (w, y)]))
+    for w in dict.fromkeys(k[0] for k in keys):
+        out.append(("magazzino", w, "", "", [k for k in keys if k[0] == w]))
+    out.append(("totale", TOTAL, "", "", keys))
+    return out
+
+def qa_table(state: dict, partitions) -> pd.DataFrame:
+    profiles = {(p.warehouse, p.year, p.month): state[p.label]["qa"] for p in partitions}
+    rows = []
+    for level, w, y, m, keys in _levels(profiles):
+        before = qa.merge(profiles[k]["before"] for k in keys)
+        after = qa.merge(profiles[k]["after"] for k in keys)
+        row = {"livello": level, "magazzino": w, "anno": y, "mese": m,
+               "righe_prima": before["rows"], "righe_dopo": after["rows"],
+               "duplicati_scartati": before["rows"] - after["rows"]}
+        for col in QTY_COLS:
+            row[f"null_{col}_prima"] = before["qty_null"].get(col, 0)
+            row[f"neg_{col}_prima"] = before["neg"].get(col, 0)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def kpi_table(results: dict, th: KpiThresholds) -> pd.DataFrame:
+    # results: {(magazzino, anno): (mesi, somme per articolo)}
+    rows = []
+    for level, w, y, _, keys in _levels(results):
+        k = rollup_kpis([results[g][0] for g in keys], [results[g][1] for g in keys], th)
+        row = {"livello": level, "magazzino": w, "anno": y,
+               "mesi": len(k["turn_by_month"]), "articoli": len(k["demand_mean"]),
+               "turnover_annuo": k["turnover_periodo_annuo"], "DIO_medio": k["DIO_medio"]}
+        levels = k["over_under_dist"].set_index("classe")["conteggio"]
+        row.update({f"livello {c}": int(levels.get(c, 0)) for c in LEVEL_CLASSES})
+        rot = k["rot_dist"].set_index("classe_rot")["conteggio"]
+        row.update({f"rotazione {c}": int(rot.get(c, 0)) for c in ROTATION_CLASSES})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+# Esecuzione
+
+def run(partitions: list, workers: int = DEFAULT_WORKERS, policy: str = "first",
+        th: KpiThresholds = KpiThresholds(), out_dir: Path = OUT_DIR):
+    if not partitions:
+        raise SystemExit("Nessuna partizione di input trovata")
+    state = read_json(STATE_FILE)
+    labels = {p.label for p in partitions}
+
+    todo = [p for p in partitions if source_changed(p, state.get(p.label), policy)]
+    for label, entry in map_files(partial(process_partition, policy=policy), todo, workers):
+        print(f"Partizione elaborata: {label} ({entry['rows_raw']} righe)")
+        state[label] = entry
+
+    # partizioni non più presenti tra gli input
+    for label in [l for l in state if l not in labels]:
+        warehouse, year, month = label.split("/")
+        drop_partition(month, dataset_root(warehouse, int(year)))
+        state.pop(label)
+    by_group = groups(partitions)
+    for d in OUT_ROOT.glob("magazzino=*/anno=*") if OUT_ROOT.exists() else []:
+        group = (d.parent.name.split("=", 1)[1], int(d.name.split("=", 1)[1]))
+        if group not in by_group:
+            shutil.rmtree(d, ignore_errors=True)
+            store_path(*group).unlink(missing_ok=True)
+    write_json_atomic(STATE_FILE, state)
+    print(f"Partizioni rielaborate: {len(todo)} di {len(partitions)}")
+
+    # KPI: un archivio per magazzino/anno, aggiornato solo per i mesi cambiati
+    results = {}
+    for group, changed, months, totals in map_files(sync_kpis, list(by_group), workers):
+        if changed:
+            print(f"Archivio KPI {group[0]}/{group[1]}: {', '.join(changed)}")
+        results[group] = (months, totals)
+
+    with stage("rollup", rows_in=len(partitions)):
+        qa_df = qa_table(state, partitions)
+        kpi_df = kpi_table(results, th)
+    write_reports(qa_df, kpi_df, out_dir)
+    return qa_df, kpi_df
+
+def write_reports(qa_df: pd.DataFrame, kpi_df: pd.DataFrame, out_dir: Path) -> None:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    qa_df.to_csv(out_dir / OUT_QA, index=False)
+    kpi_df.to_csv(out_dir / OUT_KPI, index=False)
+    with stage("render_html", item=OUT_HTML), HtmlReport(out_dir / OUT_HTML) as rep:
+        rep.write("""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>QA e KPI per magazzino</title>
+<style>
+body{font-family:Arial;margin:24px}
+table{border-collapse:collapse;width:100%}
+td,th{border:1px solid #ddd;padding:6px} th{background:#eee}
+h2{margin-top:28px}
+</style></head>
+<body>
+<h1>QA e KPI per magazzino</h1>
+<h2>KPI per magazzino/anno, magazzino e totale</h2>
+""")
+        rep.table(kpi_df, float_format="{:.2f}".format)
+        rep.write("<h2>QA per partizione (prima/dopo il cleaning)</h2>\n")
+        rep.table(qa_df)
+        rep.write("</body></html>\n")
+    print("Creati:")
+    for name in (OUT_QA, OUT_KPI, OUT_HTML):
+        print(" -", out_dir / name)
+
+def main(argv=None):
+    d = KpiThresholds()
+    parser = argparse.ArgumentParser(description="Cleaning, QA e KPI per partizioni magazzino/anno/mese.")
+    parser.add_argument("--input-root", type=Path, default=INPUT_ROOT,
+                        help=f"radice degli input <magazzino>/<anno>/<mese>.xlsx (default {INPUT_ROOT})")
+    parser.add_argument("--legacy", action="store_true",
+                        help="usa i file mensili di dati_puliti come partizioni di un solo magazzino")
+    parser.add_argument("--safety", type=float, default=d.safety)
+    parser.add_argument("--target", type=float, default=d.target)
+    parser.add_argument("--rot-bassa", type=float, default=d.rot_low)
+    parser.add_argument("--rot-alta", type=float, default=d.rot_high)
+    add_dedup_arg(parser)
+    add_workers_arg(parser)
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+
+    partitions = legacy_partitions() if args.legacy else discover(args.input_root)
+    with session(args, "run_partitions"):
+        run(partitions, args.workers, args.dedup, KpiThresholds(args.safety, args.target, args.rot_bassa, args.rot_alta))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import hashlib
+import json
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import make_data_dictionary
+import make_graphs_report
+import make_kpi_report
+import make_quality_report
+from etl_common import HERE, INPUT_FILES
+from etl_dataset import DATASET_DIR
+from etl_dedup import add_dedup_arg
+from etl_loader import add_workers_arg
+from etl_profile import add_profile_args, session, stage as profile_stage
+from etl_utils import read_json, write_json_atomic
+from kpi_engine import KpiThresholds
+
+# Esecuzione della pipeline in un solo processo, come DAG di stadi:
+#
+#   quality ──┬── dictionary
+#             └── kpi
+#   graphs            (indipendente: legge i file mensili)
+#   partitions        (indipendente, solo se esiste la cartella degli input
+#                      per magazzino/anno/mese: run_partitions.py)
+#
+# Il dataset pulito passa in memoria da quality agli stadi a valle; gli stadi
+# indipendenti girano in parallelo su thread. Ogni stadio ha un'impronta
+# (stat dei file di input, sorgenti del codice, parametri): se coincide con
+# quella dell'ultima esecuzione riuscita e gli output esistono, lo stadio viene
+# saltato e gli stadi a valle, se devono girare, rileggono il dataset da disco.
+
+STATE_FILE = HERE / ".cache" / "pipeline_state.json"
+
+@dataclass
+class Stage:
+    name: str
+    run: object                        # run(artefatti, args) -> artefatto (o None)
+    deps: tuple = ()
+    inputs: object = lambda args: []   # inputs(args) -> percorsi dei file letti
+    code: tuple = ()                   # moduli il cui sorgente entra nell'impronta
+    outputs: tuple = ()
+    params: object = lambda args: {}   # params(args) -> parametri che cambiano l'output
+
+def _files(paths) -> list:
+    out = []
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            out += sorted(f for f in p.rglob("*") if f.is_file())
+        else:
+            out.append(p)
+    return out
+
+def fingerprint(stage: Stage, args) -> str:
+    h = hashlib.sha1()
+    for f in _files(stage.inputs(args)):
+        st = f.stat() if f.exists() else None
+        h.update(f"{f}|{st.st_size if st else -1}|{st.st_mtime_ns if st else -1}\n".encode("utf-8"))
+    for mod in stage.code:
+        h.update(Path(mod.__file__).read_bytes())
+    h.update(json.dumps(stage.params(args), sort_keys=True).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+def thresholds(args) -> KpiThresholds:
+    return KpiThresholds(args.safety, args.target, args.rot_bassa, args.rot_alta)
+
+def build_stages() -> dict:
+    import column_profile
+    import etl_charts
+    import etl_common
+    import etl_dataset
+    import etl_dedup
+    import etl_html
+    import etl_loader
+    import etl_partitions
+    import etl_profile
+    import excel_cache
+    import kpi_engine
+    import kpi_store
+    import qa_profile
+    import qa_reconcile
+    import run_partitions
+    import schema_registry
+
+    stages = [
+        Stage("quality",
+              run=lambda art, args: make_quality_report.run_full(args.workers, policy=args.dedup),
+              inputs=lambda args: [*INPUT_FILES, schema_registry.SEED],
+              code=(make_quality_report, etl_common, etl_loader, etl_dataset, etl_dedup, qa_profile,
+                    qa_reconcile, etl_html, schema_registry, excel_cache, etl_profile),
+              params=lambda args: {"dedup": args.dedup},
+              outputs=(Path(make_quality_report.OUT_QA_SUMMARY), Path(make_quality_report.OUT_HTML),
+                       Path(make_quality_report.OUT_DUPS), Path(make_quality_report.OUT_RECON), DATASET_DIR)),
+        Stage("dictionary", deps=("quality",),
+              run=lambda art, args: make_data_dictionary.run(art.get("quality")),
+              inputs=lambda args: [DATASET_DIR],
+              code=(make_data_dictionary, column_profile, etl_dataset, etl_html),
+              outputs=(make_data_dictionary.OUT_XLSX, make_data_dictionary.OUT_HTML, make_data_dictionary.OUT_MD)),
+        Stage("kpi", deps=("quality",),
+              run=lambda art, args: make_kpi_report.run(thresholds(args), workers=args.workers),
+              inputs=lambda args: [DATASET_DIR],
+              code=(make_kpi_report, kpi_engine, kpi_store, etl_dataset, excel_cache, etl_charts, etl_html),
+              params=lambda args: asdict(thresholds(args)),
+              outputs=(make_kpi_report.OUT_DIR / "kpi_summary.xlsx", make_kpi_report.OUT_DIR / "kpi_report.html")),
+        Stage("graphs",
+              run=lambda art, args: make_graphs_report.run(args.workers),
+              inputs=lambda args: [make_graphs_report.RAW_DIR, make_graphs_report.CLEAN_DIR],
+              code=(make_graphs_report, etl_dataset, excel_cache, etl_charts, qa_profile),
+              outputs=(make_graphs_report.OUT_DIR / "confronto_pre_post.xlsx",)),
+    ]
+    if etl_partitions.INPUT_ROOT.is_dir():
+        stages.append(Stage("partitions",
+              run=lambda art, args: run_partitions.run(etl_partitions.discover(), args.workers, args.dedup,
+                                                       thresholds(args)),
+              inputs=lambda args: [etl_partitions.INPUT_ROOT, schema_registry.SEED],
+              code=(run_partitions, etl_partitions, make_quality_report, etl_common, etl_loader, etl_dataset,
+                    etl_dedup, qa_profile, kpi_engine, kpi_store, schema_registry, excel_cache, etl_profile),
+              params=lambda args: {"dedup": args.dedup, **asdict(thresholds(args))},
+              outputs=(run_partitions.OUT_DIR / run_partitions.OUT_QA, run_partitions.OUT_DIR / run_partitions.OUT_KPI,
+                       run_partitions.OUT_ROOT)))
+    return {s.name: s for s in stages}
+
+def select(stages: dict, only) -> dict:
+    # con --only si eseguono gli stadi indicati e quelli da cui dipendono
+    if not only:
+        return stages
+    keep, todo = set(), list(only)
+    while todo:
+        name = todo.pop()
+        if name not in stages:
+            raise SystemExit(f"Stadio sconosciuto: {name} (disponibili: {', '.join(stages)})")
+        if name not in keep:
+            keep.add(name)
+            todo += stages[name].deps
+    return {n: s for n, s in stages.items() if n in keep}
+
+def run_dag(stages: dict, args, force: bool = False, jobs: int = 2) -> dict:
+    state = read_json(STATE_FILE)
+    artifacts, status = {}, {}
+    pending = dict(stages)
+    running = {}
+
+    def execute(stage: Stage):
+        t0 = time.perf_counter()
+        with profile_stage(stage.name):
+            out = stage.run(artifacts, args)
+        return out, time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(d in pending or d in running.values() for d in stage.deps):
+                    continue
+                pending.pop(name)
+                if any(status.get(d) in ("errore", "annullato") for d in stage.deps):
+                    status[name] = "annullato"
+                    continue
+                # l'impronta si calcola solo ora: gli input possono essere output degli stadi a monte
+                fp = fingerprint(stage, args)
+                if (not force and state.get(name, {}).get("fingerprint") == fp
+                        and all(Path(o).exists() for o in stage.outputs)):
+                    status[name] = "saltato"
+                    print(f"[{name}] invariato, saltato")
+                    continue
+                print(f"[{name}] avvio")
+                running[pool.submit(execute, stage)] = name
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                try:
+                    artifacts[name], secs = fut.result()
+                except Exception as exc:
+                    status[name] = "errore"
+                    state.pop(name, None)
+                    print(f"[{name}] errore: {exc!r}")
+                    traceback.print_exception(exc)
+                    continue
+                status[name] = "eseguito"
+                # impronta ricalcolata a fine stadio: se lo stadio riscrive i propri
+                # input (es. la cache), la prossima esecuzione lo salta comunque
+                state[name] = {"fingerprint": fingerprint(stages[name], args),
+                               "seconds": round(secs, 3), "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+                print(f"[{name}] completato in {secs:.1f} s")
+            write_json_atomic(STATE_FILE, state)
+    return status
+
+def main(argv=None):
+    d = KpiThresholds()
+    parser = argparse.ArgumentParser(description="Esegue la pipeline (quality, dictionary, kpi, graphs) come DAG.")
+    parser.add_argument("--only", nargs="+", metavar="STADIO",
+                        help="esegue solo gli stadi indicati (con le loro dipendenze)")
+    parser.add_argument("--force", action="store_true",
+                        help="riesegue tutti gli stadi anche se gli input sono invariati")
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="stadi eseguiti in parallelo (thread, default 2)")
+    parser.add_argument("--safety", type=float, default=d.safety)
+    parser.add_argument("--target", type=float, default=d.target)
+    parser.add_argument("--rot-bassa", type=float, default=d.rot_low)
+    parser.add_argument("--rot-alta", type=float, default=d.rot_high)
+    add_dedup_arg(parser)
+    add_workers_arg(parser)
+    add_profile_args(parser)
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    with session(args, "run_pipeline"):
+        status = run_dag(select(build_stages(), args.only), args, args.force, args.jobs)
+    print(f"Pipeline completata in {time.perf_counter() - t0:.1f} s:")
+    for name, st in status.items():
+        print(f" - {name}: {st}")
+    if any(st in ("errore", "annullato") for st in status.values()):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
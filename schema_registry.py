@@ -0,0 +1,135 @@
+import hashlib
+import json
+from datetime import date
+from pathlib import Path
+
+from etl_utils import locked_json, read_json
+
+# Registro delle varianti di intestazione dei file sorgente.
+# Ogni intestazione viene ridotta a un'impronta (nomi normalizzati e ordinati,
+# quindi indipendente dall'ordine delle colonne); il mapping verso lo schema
+# canonico code/description/uom/stock/real/outgoing viene risolto una sola volta.
+# schema_registry.json (versionato, modificabile a mano) è solo il seed: le sue
+# varianti usano sempre il mapping scritto lì. Le varianti apprese durante le
+# esecuzioni e i file in cui compaiono vanno in .cache/schema_registry.json,
+# insieme all'impronta di CANDIDATES: se CANDIDATES cambia, i mapping appresi
+# vengono ricalcolati. Le varianti mai viste vengono segnalate.
+
+HERE = Path(__file__).resolve().parent
+SEED = HERE / "schema_registry.json"
+REGISTRY = HERE / ".cache" / "schema_registry.json"
+
+# candidati in ordine di priorità per ciascuna colonna canonica
+CANDIDATES = {
+    "code":        ("code", "codice", "item_code"),
+    "description": ("description", "descrizione"),
+    "uom":         ("um", "uom", "unit_of_measure", "unit measure", "unit_measure"),
+    "stock":       ("giacenza", "stock_quantity", "stock_level", "total_quantity", "total_stock"),
+    "real":        ("reale", "real", "real_stock", "actual_quantity"),
+    "outgoing":    ("scaricare", "to_download", "withdrawal_quantity", "ship_outgoing", "stock_scarico"),
+}
+
+_memo = {}
+_registry = None
+
+def normalize_header(columns) -> list:
+    return [str(c).lower().strip() for c in columns]
+
+def fingerprint(keys) -> str:
+    return hashlib.sha1("\x1f".join(sorted(keys)).encode("utf-8")).hexdigest()[:16]
+
+def resolve(keys) -> dict:
+    # prima le corrispondenze esatte, poi le sottostringhe; a parità di candidato
+    # vince la colonna col nome più corto (poi alfabetico), non la posizione
+    present = set(keys)
+    ordered = sorted(present, key=lambda k: (len(k), k))
+    mapping = {}
+    for canon, cands in CANDIDATES.items():
+        hit = next((c for c in cands if c in present), None)
+        if hit is None:
+            hit = next((k for c in cands for k in ordered if c in k), None)
+        mapping[canon] = hit
+    return mapping
+
+def candidates_hash() -> str:
+    return hashlib.sha1(json.dumps(CANDIDATES, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def _remap(reg: dict) -> dict:
+    # varianti apprese, con i mapping ricalcolati se CANDIDATES è cambiato
+    variants = reg.setdefault("variants", {})
+    h = candidates_hash()
+    if reg.get("candidates") != h:
+        for fp, e in variants.items():
+            mapping = resolve(e["columns"])
+            if mapping != e["mapping"]:
+                print(f"Mapping ricalcolato per la variante [{fp}] (CANDIDATES modificato)")
+                e["mapping"] = mapping
+        reg["candidates"] = h
+    return variants
+
+def _merge(fp: str, entry: dict, seed: dict) -> dict:
+    # per le varianti del seed vale il mapping del seed; i file sono quelli di entrambi
+    if fp not in seed:
+        return entry
+    files = seed[fp].get("files", [])
+    return {**seed[fp], "files": files + [f for f in entry.get("files", []) if f not in files]}
+
+def _known() -> dict:
+    global _registry
+    if _registry is None:
+        seed, reg = read_json(SEED), read_json(REGISTRY)
+        if reg and reg.get("candidates") != candidates_hash():
+            with locked_json(REGISTRY) as reg:
+                _remap(reg)
+        _registry = {fp: {**e, "files": list(e.get("files", []))} for fp, e in seed.items()}
+        for fp, e in reg.get("variants", {}).items():
+            _registry[fp] = _merge(fp, e, seed)
+    return _registry
+
+def describe(fp: str, mapping: dict, source=None) -> str:
+    missing = [c for c, k in mapping.items() if k is None]
+    return (f"Nuova variante di intestazione [{fp}] in {source or '?'}: "
+            + ", ".join(f"{c}<-{k}" for c, k in mapping.items() if k is not None)
+            + (f" (mancanti: {', '.join(missing)})" if missing else ""))
+
+def register(keys, fp: str, mapping: dict, source=None) -> dict:
+    # la segnalazione avviene sotto lock: con il loader parallelo ogni
+    # variante nuova viene riportata una sola volta
+    seed = read_json(SEED)
+    with locked_json(REGISTRY) as reg:
+        variants = _remap(reg)
+        entry = variants.get(fp)
+        if entry is None:
+            if fp not in seed:
+                print(describe(fp, mapping, source))
+            entry = variants[fp] = {
+                "columns": sorted(set(keys)),
+                "mapping": mapping,
+                "first_seen": date.today().isoformat(),
+                "files": [],
+            }
+        if source and source not in entry["files"]:
+            entry["files"].append(source)
+    entry = _known()[fp] = _merge(fp, entry, seed)
+    return entry
+
+def lookup(columns, source=None) -> dict:
+    # mapping canonico -> chiave normalizzata (o None) per l'intestazione data
+    keys = normalize_header(columns)
+    fp = fingerprint(keys)
+    if fp in _memo:
+        return _memo[fp]
+
+    entry = _known().get(fp)
+    if entry is None or (source and source not in entry["files"]):
+        entry = register(keys, fp, resolve(keys) if entry is None else entry["mapping"], source)
+    _memo[fp] = entry["mapping"]
+    return entry["mapping"]
+
+if __name__ == "__main__":
+    reg = _known()
+    print(f"Varianti di intestazione registrate: {len(reg)} ({SEED.name} e {REGISTRY.relative_to(HERE)})")
+    for fp, e in sorted(reg.items(), key=lambda kv: kv[1]["first_seen"]):
+        print(f"[{fp}] dal {e['first_seen']} - file: {', '.join(e['files'])}")
+        for canon in CANDIDATES:
+            print(f"    {canon:<12} <- {e['mapping'].get(canon)}")